@@ -0,0 +1,205 @@
+#!/usr/bin/python
+"""Benchmarks the server game loop over a matrix of seeded workloads.
+
+Every combination of the given map sizes, orb densities, player and bot
+counts, and radius distributions is run headlessly for a fixed nr of ticks
+of simulated time, and the time of the loop is attributed to its phases,
+see server.replay.PhaseProfiler. Players are served as connected clients,
+whose messages are sent to a socket that is never read. The results are
+printed as JSON, and may be compared to those of an earlier run to flag
+regressions, for example:
+
+    python benchmark.py --map-factors 4 8 --players 0 50 --output base.json
+    python benchmark.py --map-factors 4 8 --players 0 50 --baseline base.json
+"""
+
+import argparse
+import itertools
+import json
+import random
+import statistics
+import sys
+import time
+import source.config as cfg
+from source.containers import Leaderboard
+from source.entities import Player, UserInputs
+from server.server import Connection, Server
+from server.server_game import ServerGame
+from server.replay import PhaseProfiler, SinkLink
+
+
+# Draws the starting radius of a player or bot from an rng
+RADIUS_DISTRIBUTIONS = {
+    'start': lambda rng: cfg.START_RADIUS,
+    'uniform': lambda rng: rng.uniform(cfg.START_RADIUS, cfg.MAX_RADIUS//3),
+    'skewed': lambda rng: min(cfg.MAX_RADIUS, cfg.START_RADIUS*rng.paretovariate(1.2)),
+}
+INPUT_INTERVAL = 50  # Ticks between new inputs of each simulated player
+REGRESSION_FLOOR = 0.05  # Changes in milliseconds per tick below this are noise
+
+
+class BenchmarkServer(Server):
+    """Serves simulated clients on the simulated clock of a benchmark.
+
+    The game is synced once cfg.SERVER_SYNC_INTERVAL of simulated time has
+    passed, and every client is then due, as are those that are not
+    congested.
+    """
+    def __init__(self, map_size, orb_seed, network_link):
+        super().__init__(map_size, orb_seed, network_link)
+        self.ticks_since_sync = 0
+
+    def needs_sync(self):
+        self.ticks_since_sync += 1
+        if self.ticks_since_sync/cfg.SERVER_GAME_REFRESH_RATE > cfg.SERVER_SYNC_INTERVAL:
+            self.ticks_since_sync = 0
+            return True
+        return False
+
+    def _find_due_ids(self):
+        self.last_sync_time = self.server_time = time.time()
+        return set(self.id_map)
+
+
+def create_workload(seed, map_factor, orb_density, player_count, bot_count, radii):
+    """Returns a game filled with orbs, players, and bots, along with its link.
+
+    The map spans map_factor by map_factor screens, each holding orb_density
+    orbs, and every player and bot is given a radius drawn from the
+    distribution radii, see RADIUS_DISTRIBUTIONS.
+    """
+    random.seed(seed)
+    rng = random.Random(seed)
+    map_size = (map_factor*cfg.BASE_WIDTH, map_factor*cfg.BASE_HEIGHT)
+    link = SinkLink()
+    game = ServerGame(player_count + bot_count, bot_count,
+        orb_density*map_factor*map_factor, map_size, seed, headless=True,
+        server=BenchmarkServer(map_size, seed, link))
+    for player_id in range(1, player_count + 1):
+        game.server.player_id = player_id
+        game._add_player(Player(str(player_id), player_id))
+        game.server.adopt_connection(player_id,
+            Connection(('127.0.0.1', player_id), float('Inf')))
+
+    game.leaderboard = Leaderboard(cfg.LEADERBOARD_SIZE)
+    for player in game.id_to_player.values():
+        game.players.remove(player)
+        player.radius = RADIUS_DISTRIBUTIONS[radii](rng)
+        player.scale = (player.radius/cfg.START_RADIUS)**cfg.VIEW_GROWTH_RATE
+        game.players.add(player)
+        game.leaderboard.add(player)
+    game._replenish_orbs()
+    game.orb_additions = []
+    return game, link
+
+def post_inputs(game, rng):
+    """Steers every simulated player towards a random point"""
+    for player_id in game.server.id_map:
+        game.server._post_inputs(player_id, UserInputs(
+            (rng.randint(-cfg.BASE_WIDTH, cfg.BASE_WIDTH),
+            rng.randint(-cfg.BASE_HEIGHT, cfg.BASE_HEIGHT))))
+
+def run_workload(workload, seed, warmup_ticks, tick_count):
+    """Runs a workload, and returns its tick and phase times in milliseconds"""
+    game, link = create_workload(seed, **workload)
+    rng = random.Random(seed)
+    profiler = PhaseProfiler()
+    profiler.wrap_game(game)
+
+    time_delta = 1/cfg.SERVER_GAME_REFRESH_RATE
+    tick_times = []
+    for tick in range(warmup_ticks + tick_count):
+        if tick%INPUT_INTERVAL == 0:
+            post_inputs(game, rng)
+        if tick == warmup_ticks:
+            profiler.phase_times = dict.fromkeys(profiler.phase_times, 0)
+        start_time = time.perf_counter()
+        game.main_loop(time_delta)
+        tick_times.append(1000*(time.perf_counter() - start_time))
+    link.close()
+
+    tick_times = sorted(tick_times[warmup_ticks:])
+    phases = {phase: 1000*phase_time/tick_count
+        for phase, phase_time in profiler.phase_times.items()}
+    phases['other'] = max(0, statistics.mean(tick_times) - sum(phases.values()))
+    return {
+        'workload': workload,
+        'tick_ms': {
+            'mean': statistics.mean(tick_times),
+            'median': statistics.median(tick_times),
+            'p99': tick_times[int(0.99*len(tick_times))],
+        },
+        'phase_ms': phases,
+        'players': len(game.id_to_player),
+        'orbs': game.orbs.item_count,
+        'orb_id': game.orb_id,  # Tells whether runs simulated the same game
+    }
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns a description of each time that regressed from the baseline.
+
+    A time has regressed when it grew by more than tolerance, as a share of
+    the baseline time, and by more than REGRESSION_FLOOR. Workloads missing
+    from the baseline are skipped.
+    """
+    baseline_results = {json.dumps(result['workload'], sort_keys=True): result
+        for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        base = baseline_results.get(json.dumps(result['workload'], sort_keys=True))
+        if base is None: continue
+        times = [('tick median', result['tick_ms']['median'], base['tick_ms']['median'])]
+        times.extend((phase, phase_time, base['phase_ms'].get(phase, 0))
+            for phase, phase_time in result['phase_ms'].items())
+        for name, curr_time, base_time in times:
+            if curr_time - base_time > max(tolerance*base_time, REGRESSION_FLOOR):
+                regressions.append(f"{result['workload']} {name}: "
+                    f"{base_time:.3f} ms -> {curr_time:.3f} ms")
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--map-factors', type=int, nargs='+', default=[4],
+        help="screens along each side of the map")
+    parser.add_argument('--orb-densities', type=int, nargs='+', default=[50],
+        help="orbs per screen")
+    parser.add_argument('--players', type=int, nargs='+', default=[20],
+        help="simulated clients")
+    parser.add_argument('--bots', type=int, nargs='+', default=[20])
+    parser.add_argument('--radii', nargs='+', default=['uniform'],
+        choices=sorted(RADIUS_DISTRIBUTIONS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warmup', type=int, default=50, help="ticks left untimed")
+    parser.add_argument('--ticks', type=int, default=500, help="ticks timed")
+    parser.add_argument('--output', help="file to write the results to")
+    parser.add_argument('--baseline', help="results of an earlier run to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="share by which times may grow before they count as regressions")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    # Views are computed in the game loop, such that they are timed as a phase
+    cfg.VIEW_WORKERS = 0
+    results = {'seed': args.seed, 'warmup': args.warmup, 'ticks': args.ticks, 'results': []}
+    for map_factor, orb_density, player_count, bot_count, radii in itertools.product(
+            args.map_factors, args.orb_densities, args.players, args.bots, args.radii):
+        workload = {'map_factor': map_factor, 'orb_density': orb_density,
+            'player_count': player_count, 'bot_count': bot_count, 'radii': radii}
+        results['results'].append(run_workload(workload, args.seed, args.warmup, args.ticks))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("[BENCHMARK] Regression:", regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,7 +1,6 @@
 """Provides a Client interface for communication with the server."""
 
 import socket
-import pickle
 import time
 import random
 import math
@@ -10,6 +9,7 @@ import sys
 import pygame as pg
 import source.config as cfg
 import source.network
+from source.entities import generate_orb
 
 
 class Client:
@@ -26,6 +26,7 @@ class Client:
     """
     def __init__(self):
         self.server_address = ("0.0.0.0", cfg.NETWORK_PORT)
+        self.room_id = None
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.client_socket.bind(('0.0.0.0', 0))
         self.client_socket.settimeout(0)
@@ -39,6 +40,8 @@ class Client:
         self.past_player_queue = collections.deque([], 1024)
         self.packets_queue = collections.deque([], 1024)
         self.acked_packets = set()
+        self.input_history = collections.deque([], cfg.INPUT_HISTORY_LENGTH)
+        self.input_sequence = 0
 
         self.data_load = 0
         self.added_ping = 0
@@ -55,16 +58,22 @@ class Client:
         self.heartbeat = 0
 
         self.map_size = (0,0)
+        self.orb_seed = 0
         self.leaders = []
+        self.leader_ids = []
+        self.leaders_version = -1
+        self.metadata = {}  # Maps player ids to (name, color_idx) pairs
+        self.metadata_requests = {}  # Maps player ids to the time requested
         self.server_players = {}
         self.past_player = None
         self.player_id = 0
         self.end_game_state = ''
 
-    def connect(self, player_name, server_ip):
-        """Connects to the server"""
+    def connect(self, player_name, server_ip, room_id=None):
+        """Connects to the server, in the given room if it hosts several"""
         if not self.connected:
             self.server_address = (server_ip, cfg.NETWORK_PORT)
+            self.room_id = room_id
             for _ in range(cfg.CONNECTION_ATTEMPTS):
                 self._add_message(cfg.CONNECT_CODE, player_name)
                 self._send_messages()
@@ -129,7 +138,7 @@ class Client:
         time_passed = time.time() - self.last_sync_time
         return time_passed > cfg.CLIENT_SYNC_INTERVAL
 
-    def sync_state(self, time_delta, players, orbs, trackers):
+    def sync_state(self, time_delta, players, orbs, orb_cells, trackers):
         """Synchronizes the client game state with the server game state"""
         self._retrieve_messages()
         self.last_sync_time = curr_time = time.time()
@@ -139,13 +148,18 @@ class Client:
             update = self.server_players_queue.popleft()
             _, round_trip_time, server_pulse, player_update = update
             if server_pulse <= self.heartbeat: continue
+            time_passed = server_pulse - self.heartbeat
             self.heartbeat = server_pulse
-            self.leaders, new_players = player_update
-            self._apply_player_update(players, new_players)
+            leader_update, view_ids, new_players = player_update
+            if leader_update is not None:
+                self.leaders_version, self.leader_ids = leader_update
+            self._apply_player_update(players, view_ids, new_players, time_passed)
             new_server_time = curr_time - round_trip_time
             self.server_time = max(self.server_time, new_server_time)
             self.latency = curr_time - self.server_time
-            self._add_message(cfg.PING_CODE, server_pulse)
+            self._add_message(cfg.PING_CODE, (server_pulse, self.leaders_version))
+        self.leaders = [self.metadata[player_id][0]
+            for player_id in self.leader_ids if player_id in self.metadata]
 
         effective_server_time = self.server_time - cfg.SERVER_SYNC_INTERVAL/2
         while self.past_player_queue:
@@ -153,20 +167,31 @@ class Client:
             if past_time > effective_server_time: break
             _, self.past_player = self.past_player_queue.popleft()
 
-        self._acknowledge_updates(curr_time, players, orbs)
+        self._acknowledge_updates(curr_time, orbs, orb_cells)
         self._verify_connection(curr_time, players)
         if self.synced:
             player = players[self.player_id]
             curr_player_info = (player.x, player.y, player.radius)
             self.past_player_queue.append((curr_time, curr_player_info))
-            message = source.network.encode_inputs(player.inputs)
-            self._add_message(cfg.INPUTS_CODE, message)
+            self._add_input_message(player.inputs)
             self._sync_player_positions(time_delta, players)
             self._update_trackers(trackers)
 
         self._send_messages()
         self._update_connection_statistics(curr_time)
 
+    def _add_input_message(self, inputs):
+        """Sends the current inputs along with the most recent past inputs.
+
+        Repeating past inputs lets the server recover any inputs lost in
+        transit without waiting for retransmission.
+        """
+        self.input_sequence += 1
+        self.input_history.appendleft(source.network.encode_inputs(inputs))
+        message = source.network.encode_input_history(
+            self.input_sequence, self.input_history)
+        self._add_message(cfg.INPUTS_CODE, message)
+
     def _update_trackers(self, trackers):
         """dd"""
         if self.player_id in self.server_players and 'server' in trackers:
@@ -207,7 +232,7 @@ class Client:
                 player.x += gravity*(self.server_players[player_id].x - player.x)
                 player.y += gravity*(self.server_players[player_id].y - player.y)
 
-    def _acknowledge_updates(self, curr_time, players, orbs):
+    def _acknowledge_updates(self, curr_time, orbs, orb_cells):
         """"""
         while self.packets_queue:
             past_time = self.packets_queue[0][0]
@@ -237,12 +262,13 @@ class Client:
             if packet_id in self.acked_packets:
                 self._add_message(cfg.ACK_CODE, packet_id)
                 continue
-            if all(orb.id in orbs for orb in removals):
+            if all(orb_id in orbs for orb_id in removals):
                 if all(orb.id not in orbs for orb in additions):
                     for orb in additions:
                         orbs[orb.id] = orb
-                    for orb in removals:
-                        orbs.pop(orb.id)
+                        orb_cells.add(orb)
+                    for orb_id in removals:
+                        orb_cells.remove(orbs.pop(orb_id))
                     self._add_message(cfg.ACK_CODE, packet_id)
                     self._ack_update(curr_time, packet_id)
 
@@ -265,8 +291,21 @@ class Client:
             self._reset_players(players)
         self.synced = synchronized
 
-    def _apply_player_update(self, players, new_players):
-        self.server_players = {p.id : p for p in new_players}
+    def _apply_player_update(self, players, view_ids, new_players, time_passed):
+        """Updates the players in view, of which only some are sent.
+
+        Players in view that were not sent keep moving by their last known
+        inputs, while players no longer in view are removed.
+        """
+        server_players = {}
+        for player_id in view_ids:
+            if player_id in self.server_players:
+                player = self.server_players[player_id]
+                player.move(self.map_size, min(time_passed, cfg.PLAYER_INTERRUPT_LIMIT))
+                server_players[player_id] = player
+        for player in new_players:
+            server_players[player.id] = player
+        self.server_players = server_players
         for player_id, player in self.server_players.items():
             if player_id not in players:
                 players[player_id] = player
@@ -301,9 +340,11 @@ class Client:
             send_time = self.send_queue[0][0]
             if curr_time - send_time < self.added_ping/2: break
             try:
-                _, data = self.send_queue.popleft()
+                _, (code, message) = self.send_queue.popleft()
                 self._simulate_connection_instability()
-                data = pickle.dumps(data)
+                data = source.network.frame_message(
+                    source.network.pack_message(code, message),
+                    cfg.COMPRESSION_THRESHOLD, self.room_id)
                 self.data_load += sys.getsizeof(data)+28
                 self.client_socket.sendto(data, self.server_address)
             except Exception as exc:
@@ -316,7 +357,7 @@ class Client:
                 data, addr = self.client_socket.recvfrom(16384)
                 self._simulate_connection_instability()
                 self.data_load += sys.getsizeof(data)+28
-                code, data = pickle.loads(data)
+                code, data = source.network.decode_message(data)
                 reception_time = time.time() + self.added_ping/2
 
                 if code == cfg.CONNECT_CODE:
@@ -325,10 +366,14 @@ class Client:
                     self._update_players(data, reception_time)
                 elif code == cfg.UPD_ORBS_CODE:
                     self._update_orbs(data, reception_time)
+                elif code == cfg.METADATA_CODE:
+                    self._update_metadata(data)
                 elif code == cfg.DEATH_CODE:
                     self._handle_death(data, reception_time)
                 elif code == cfg.DISCONNECT_CODE:
                     self._accept_disconnection(addr)
+                elif code == cfg.REDIRECT_CODE:
+                    self._accept_redirection(data, addr)
 
             except socket.error:
                 break
@@ -337,26 +382,78 @@ class Client:
 
     def _accept_connection(self, data):
         if not self.connected:
-            self.player_id, player, self.map_size = data
-            player = source.network.decode_player(player)
+            self.player_id, metadata, player, self.map_size, self.orb_seed = data
+            player_id, metadata = source.network.decode_metadata(metadata)
+            self.metadata[player_id] = metadata
+            player = source.network.decode_players(player)[0]
+            player = source.network.decode_player(player, metadata)
             self.server_players[self.player_id] = player
             self.connected = True
 
+    def _accept_redirection(self, port, addr):
+        """Connects to the server on port instead, as told by a lobby"""
+        # Only the lobby that the client is connecting to may redirect it
+        server_ip, server_port = self.server_address
+        if addr != (socket.gethostbyname(server_ip), server_port): return
+        if not self.connected:
+            self.server_address = (server_ip, port)
+
     def _update_players(self, data, curr_time):
-        (leaders, received_players, server_pulse), round_trip_time = data
-        new_players, new_leaders = [], []
-        for player in received_players:
-            new_players.append(source.network.decode_player(player))
-        for player in leaders:
-            new_leaders.append(source.network.decode_name(player))
-        player_update = (new_leaders, new_players)
+        (leader_update, view_ids, received_players, server_pulse), round_trip_time = data
+        view_ids = source.network.decode_ids(view_ids)
+        new_players, missing_ids = [], []
+        for player in source.network.decode_players(received_players):
+            if player[0] in self.metadata:
+                metadata = self.metadata[player[0]]
+                new_players.append(source.network.decode_player(player, metadata))
+            else:
+                missing_ids.append(player[0])
+        if leader_update is not None:
+            leaders_version, leader_ids = leader_update
+            assert(isinstance(leaders_version, int))
+            assert(all(isinstance(player_id, int) for player_id in leader_ids))
+            missing_ids.extend(player_id for player_id in leader_ids
+                if player_id not in self.metadata)
+        self._request_metadata(missing_ids)
+        player_update = (leader_update, view_ids, new_players)
         update = (curr_time, round_trip_time, server_pulse, player_update)
         self.server_players_queue.append(update)
 
+    def _update_metadata(self, data):
+        """Caches the names and colors of players, which are fixed per id"""
+        packet_id, entries = data
+        if len(self.metadata) > cfg.METADATA_CACHE_SIZE:
+            self.metadata = {player_id: self.metadata[player_id]
+                for player_id in self.server_players if player_id in self.metadata}
+            self.metadata_requests.clear()
+        for entry in entries:
+            player_id, metadata = source.network.decode_metadata(entry)
+            self.metadata[player_id] = metadata
+            self.metadata_requests.pop(player_id, None)
+        self._add_message(cfg.ACK_CODE, packet_id)
+
+    def _request_metadata(self, player_ids):
+        """Asks the server to resend metadata missing from the cache.
+
+        Metadata is normally received ahead of the players it belongs to,
+        so each player is requested at most once per interval.
+        """
+        curr_time = time.time()
+        player_ids = [player_id for player_id in player_ids
+            if curr_time - self.metadata_requests.get(player_id, 0)
+            > cfg.METADATA_REQUEST_INTERVAL]
+        if not player_ids: return
+        for player_id in player_ids:
+            self.metadata_requests[player_id] = curr_time
+        self._add_message(cfg.METADATA_REQUEST_CODE, player_ids)
+
     def _update_orbs(self, data, curr_time):
+        # Orbs are generated within the map, which is given on connection
+        if not self.connected: return
         packet_id, updates = data
-        orb_additions = [source.network.decode_orb(orb) for orb in updates[0]]
-        orb_removals = [source.network.decode_orb(orb) for orb in updates[1]]
+        orb_additions = [generate_orb(self.orb_seed, orb_id, self.map_size)
+            for orb_id in source.network.decode_orb_ids(updates[0])]
+        orb_removals = source.network.decode_orb_ids(updates[1])
         orb_updates = (orb_additions, orb_removals)
         update = (curr_time, packet_id, orb_updates)
         self.server_orbs_queue.append(update)
@@ -5,6 +5,7 @@ import time
 import socket
 import pygame as pg
 from source.animation import GameWindow
+from source.containers import CellContainer
 from client.client import Client
 import source.config as cfg
 from source.entities import Player, Tracker, UserInputs
@@ -36,7 +37,7 @@ class ClientMenu:
             local_addr = ""
         self.address_box = InputField(
             window_center_position, 445, 320, "Server IP Address:",
-            local_addr, 15)  # Supports only ipv4 addresses
+            local_addr, 21)  # Supports only ipv4 addresses, optionally followed by /room
 
         self.background = pg.image.load("assets/menu_background.png")
         self.menu_message = cfg.MENU_FONT_3.render('', True, cfg.RED)
@@ -65,7 +66,9 @@ class ClientMenu:
             self.play_button.clicked = False
             self._set_menu_message("Connecting...")
             self._update_display()
-            self.client.connect(self.name_box.text, self.address_box.text)
+            server_ip, _, room = self.address_box.text.partition('/')
+            room_id = int(room) if room.isdigit() else None
+            self.client.connect(self.name_box.text, server_ip, room_id)
             if self.client.is_connected(): return True
             self._set_menu_message("Error: Could not connect to server.")
         return False
@@ -180,6 +183,7 @@ class ClientGame:
         self.window = GameWindow(
             self.player, "Netblob - Client", self.map_size)
         self.orbs = {}
+        self.orb_cells = CellContainer(self.map_size)
         past_tracker = Tracker("past player position", cfg.BLUE)
         server_tracker = Tracker("server player position", cfg.RED)
         self.trackers = {"past" : past_tracker, "server" : server_tracker}
@@ -205,7 +209,7 @@ class ClientGame:
 
         if self.client.needs_sync():
             self.client.sync_state(time_delta, self.players,
-                    self.orbs, self.trackers)
+                    self.orbs, self.orb_cells, self.trackers)
 
         if not self.client.is_connected():
             self.end_game_state = self.client.get_end_state()
@@ -270,7 +274,8 @@ class ClientGame:
 
         # draw each player/orb/tracker
         sort_players = sorted(self.players.values(), key=lambda x: x.radius)
-        for orb in self.orbs.values():
+        visible_area = self.window.get_visible_area()
+        for orb in self.orb_cells.get_area(*visible_area):
             self.window.draw_orb(orb)
 
         for player in sort_players:
@@ -280,7 +285,7 @@ class ClientGame:
 
         self._draw_scoreboard(sort_players)
         self._draw_statistics(time_delta)
-        pg.display.flip()
+        self.window.update_display()
 
     def _draw_scoreboard(self, sort_players):
         """dd"""
@@ -289,10 +294,12 @@ class ClientGame:
         for i, text in enumerate(cfg.SCOREBOARD_TEXTS):
             self.window.draw_text(text, top_left_x + 5, top_left_y + 5 + delta_y*i)
 
-        for i, player_name in enumerate(reversed(self.client.leaders)):
-            if i not in self.window.scoreboard_texts or self.window.scoreboard_texts[i][0] != text:
+        for i, player_name in enumerate(self.client.leaders):
+            if i not in self.window.scoreboard_texts or self.window.scoreboard_texts[i][0] != player_name:
                 surface = cfg.SCORE_FONT.render(player_name, 1, cfg.BLACK)
                 self.window.scoreboard_texts[i] = (player_name, surface, 210, top_left_y + 5 + delta_y*(i+1), True)
+        for i in range(len(self.client.leaders), len(self.window.scoreboard_texts)):
+            del self.window.scoreboard_texts[i]
         for _, surface, pos_x, pos_y, x_offset in self.window.scoreboard_texts.values():
             self.window.draw_text(surface, pos_x, pos_y, x_offset)
 
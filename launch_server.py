@@ -5,28 +5,152 @@ The server player limit, orb density, map size, and bot count is
 specified herein.
 """
 
+import multiprocessing as mp
+import os
 import sys
+import time
 import pygame as pg
 from server.server_game import ServerGame
+from server.sharding import ShardedServer
+from server.rooms import RoomManager
+from server.lobby import Lobby
+from server.standby import Replicator, Standby
+from server.checkpoint import load_checkpoint, save_checkpoint
+from server.replay import PhaseProfiler, ReplayGame, record_game
 import source.config as cfg
 
 
-def run_server_game(player_limit, bot_count, orb_count, field_size):
+def run_server_game(player_limit, bot_count, orb_count, field_size,
+        headless=False, port=None):
     """dd"""
-    game = ServerGame(player_limit, bot_count, orb_count, field_size)
+    if cfg.CHECKPOINT_PATH and os.path.exists(cfg.CHECKPOINT_PATH):
+        start_time = time.perf_counter()
+        game = load_checkpoint(cfg.CHECKPOINT_PATH, headless, port=port)
+        print(f"[SERVER] Restored {cfg.CHECKPOINT_PATH} in "
+            f"{time.perf_counter() - start_time:.3f} seconds")
+    elif cfg.REPLAY_PATH:
+        game = record_game(cfg.REPLAY_PATH, player_limit, bot_count, orb_count,
+            field_size, headless, port=port)
+    else:
+        game = ServerGame(player_limit, bot_count, orb_count, field_size,
+            headless=headless, port=port)
+    if cfg.STANDBY_ADDRESS:
+        game.replicator = Replicator(cfg.STANDBY_ADDRESS)
     game.start()
+    run_game_loop(game)
+    if cfg.CHECKPOINT_PATH:
+        save_checkpoint(game, cfg.CHECKPOINT_PATH)
+
+
+def run_game_loop(game):
     clock = pg.time.Clock()
     while game.is_running():
         time_delta = clock.tick(cfg.SERVER_GAME_REFRESH_RATE)/1000
         game.main_loop(time_delta)
 
 
+def run_standby_server():
+    """Mirrors the server streaming to cfg.STANDBY_ADDRESS, and takes over once it fails"""
+    # Orb views are rebuilt from the updates of the primary, not by a view pool
+    cfg.VIEW_WORKERS = 0
+    standby = Standby(cfg.STANDBY_ADDRESS)
+    standby.mirror()
+    game, start_duration = standby.take_over()
+    print(f"[SERVER] Took over from the failed server in {start_duration:.3f} seconds")
+    run_game_loop(game)
+
+
+def run_replay(path, profile=False):
+    """Replays the session recorded at path, and prints its timings"""
+    game = ReplayGame(path)
+    profiler = None
+    if profile:
+        profiler = PhaseProfiler()
+        profiler.wrap_game(game)
+    tick_count, replay_time, session_time, divergent_tick = game.replay()
+    game.stop()
+    print(f"[REPLAY] Replayed {tick_count} ticks in {replay_time:.3f} seconds, "
+        f"which took {session_time:.3f} seconds in the session")
+    if divergent_tick is not None:
+        print("[REPLAY] The replay diverged from the session at tick", divergent_tick)
+    if profiler:
+        for phase, phase_time in profiler.phase_times.items():
+            print(f"[REPLAY] {phase}: {1000*phase_time/max(1, tick_count):.3f} ms per tick")
+
+
+def run_sharded_server(shard_count, player_limit, bot_count, orb_count, field_size):
+    """Runs the game headless, split among shard_count processes"""
+    server = ShardedServer(shard_count, player_limit, bot_count, orb_count, field_size)
+    server.start()
+    try:
+        while server.is_running():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+
+
+def run_room_server(room_count, player_limit, orb_count, field_size):
+    """Runs room_count headless games without bots behind one socket"""
+    # The rooms share one loop, which their view pools would compete with
+    cfg.VIEW_WORKERS = 0
+    manager = RoomManager(room_count, player_limit, orb_count, field_size)
+    manager.start()
+    try:
+        while manager.is_running():
+            manager.main_loop()
+    except KeyboardInterrupt:
+        pass
+    manager.stop()
+
+
+def run_lobby_server(server_count, player_limit, bot_count, orb_count, field_size):
+    """Runs server_count headless servers behind a lobby on cfg.NETWORK_PORT"""
+    lobby = Lobby()
+    lobby.start()
+    context = mp.get_context('spawn')
+    processes = [context.Process(target=run_reporting_server, daemon=True,
+        args=(('127.0.0.1', lobby.port), player_limit, bot_count, orb_count,
+            field_size, lobby.port + 1 + idx)) for idx in range(server_count)]
+    for process in processes:
+        process.start()
+    try:
+        while any(process.is_alive() for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for process in processes:
+        process.terminate()
+    lobby.stop()
+
+
+def run_reporting_server(lobby_address, player_limit, bot_count, orb_count,
+        field_size, port):
+    """Runs a headless server that reports its load to the lobby"""
+    cfg.LOBBY_ADDRESS = lobby_address
+    run_server_game(player_limit, bot_count, orb_count, field_size, True, port)
+
+
 if __name__ == '__main__':
     player_limit = 100
     orb_density = 70
     size_factor = 4
     bot_count = 8
     field_size = (size_factor*cfg.BASE_WIDTH, size_factor*cfg.BASE_HEIGHT)
-    run_server_game(player_limit, bot_count, orb_density*(size_factor**2), field_size)
+    if sys.argv[1:] == ['standby']:
+        run_standby_server()
+    elif sys.argv[1:2] == ['replay']:
+        run_replay(sys.argv[2], profile=sys.argv[3:] == ['profile'])
+    elif cfg.LOBBY_SERVERS:
+        run_lobby_server(cfg.LOBBY_SERVERS, player_limit, bot_count,
+            orb_density*(size_factor**2), field_size)
+    elif cfg.SERVER_ROOMS:
+        run_room_server(cfg.SERVER_ROOMS, player_limit,
+            orb_density*(size_factor**2), field_size)
+    elif cfg.SERVER_SHARDS > 1:
+        run_sharded_server(cfg.SERVER_SHARDS, player_limit, bot_count,
+            orb_density*(size_factor**2), field_size)
+    else:
+        run_server_game(player_limit, bot_count, orb_density*(size_factor**2), field_size)
     pg.quit()
     sys.exit()
@@ -0,0 +1,171 @@
+"""Provides checkpoints of the full state of a server game.
+
+A checkpoint is a binary file made of a header followed by sections of
+fixed size records, all little endian:
+
+    header          CHECKPOINT_HEADER, which gives the counts of the rest
+    players         PLAYER_RECORD for each player
+    player names    the utf-8 names of the players, in the same order
+    cell sizes      the nr of orbs that occupy only the cell, for each cell
+    orbs            ORB_RECORD for each orb
+    connections     CONNECTION_RECORD for each connected client
+    orb views       the ids of the orbs known to each client, in order
+
+Orbs are stored whole rather than by id, such that restoring them needs no
+orb generation. They are ordered by the cell that they occupy, row by row,
+followed by those that occupy several cells. Restoring memory maps the
+file, and fills the cells of the orb index a whole cell at a time, see
+CellContainer.fill_cell, unless the cell size has since changed.
+"""
+
+import mmap
+import os
+import socket
+import struct
+import time
+import source.config as cfg
+from source.containers import Leaderboard
+from source.entities import Orb, Player, generate_orb
+from server.server import Connection
+from server.server_game import ServerGame
+
+
+CHECKPOINT_MAGIC = b'NBCP'
+CHECKPOINT_VERSION = 1
+# magic, version, map width, map height, cell width, cell height, orb
+# seed, player limit, target orb count, last player id, packet id, orb id,
+# and bot id, leaderboard version, and the nr of players, orbs,
+# connections, and orb view ids
+CHECKPOINT_HEADER = struct.Struct('<4sHIIIIIIIqqqqqIIII')
+PLAYER_RECORD = struct.Struct('<iddddiiBB')  # id, x, y, radius, scale, inputs, color, name length
+CELL_SIZE = struct.Struct('<I')
+ORB_RECORD = struct.Struct('<IiiBB')  # id, x, y, radius, color
+CONNECTION_RECORD = struct.Struct('<4sHiII')  # ip, port, player id, input sequence, orb view size
+ORB_ID = struct.Struct('<I')
+
+
+def save_checkpoint(game, path):
+    """Writes the state of the game to path, replacing any previous file"""
+    server = game.server
+    players = list(game.id_to_player.values())
+    names = [player.name.encode()[:255] for player in players]
+    cell_orbs = [[] for row in game.orbs.cells for cell in row]
+    spanning_orbs = []
+    column_count = len(game.orbs.cells[0])
+    # Orbs occupying several cells are iterated over repeatedly
+    for orb in set(game.orbs):
+        top_row, left_col, bot_row, right_col = game.orbs.find_cell_range(orb)
+        if top_row == bot_row and left_col == right_col:
+            cell_orbs[top_row*column_count + left_col].append(orb)
+        else:
+            spanning_orbs.append(orb)
+    orbs = [orb for orbs in cell_orbs for orb in orbs] + spanning_orbs
+    connections = list(server.id_map.items())
+    orb_view_size = sum(len(connection.orb_view) for _, connection in connections)
+
+    chunks = [CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION,
+        *game.map_size, *cfg.MAP_CELL_SIZE, game.orb_seed, game.player_limit,
+        game.target_orb_count,
+        server.player_id, server.packet_id, game.orb_id, game.bot_id,
+        game.leaderboard.version, len(players), len(orbs), len(connections),
+        orb_view_size)]
+    chunks.extend(PLAYER_RECORD.pack(player.id, player.x, player.y,
+            player.radius, player.scale, player.inputs.x, player.inputs.y,
+            player.color_idx, len(name))
+        for player, name in zip(players, names))
+    chunks.extend(names)
+    chunks.extend(CELL_SIZE.pack(len(orbs)) for orbs in cell_orbs)
+    chunks.extend(ORB_RECORD.pack(orb.id, orb.x, orb.y, orb.radius, orb.color_idx)
+        for orb in orbs)
+    chunks.extend(CONNECTION_RECORD.pack(socket.inet_aton(connection.addr[0]),
+            connection.addr[1], player_id, connection.input_sequence,
+            len(connection.orb_view))
+        for player_id, connection in connections)
+    chunks.extend(ORB_ID.pack(orb.id)
+        for _, connection in connections for orb in connection.orb_view)
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(b''.join(chunks))
+    os.replace(temp_path, path)
+
+def load_checkpoint(path, headless=False, network_link=None, port=None):
+    """Returns a game restored from the checkpoint at path.
+
+    The game is not started, and its server takes the remaining arguments,
+    see ServerGame.
+    """
+    with open(path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+            memoryview(data) as view:
+        magic, version, map_width, map_height, cell_width, cell_height, \
+            orb_seed, player_limit, target_orb_count, player_id, packet_id, orb_id, bot_id, \
+            leaders_version, player_count, orb_count, connection_count, \
+            orb_view_size = CHECKPOINT_HEADER.unpack_from(view)
+        assert(magic == CHECKPOINT_MAGIC and version == CHECKPOINT_VERSION)
+        map_size = (map_width, map_height)
+        game = ServerGame(player_limit, 0, target_orb_count, map_size, orb_seed,
+            headless, network_link, port)
+        game.server.player_id, game.server.packet_id = player_id, packet_id
+        game.orb_id, game.bot_id = orb_id, bot_id
+
+        offset = CHECKPOINT_HEADER.size
+        end = offset + player_count*PLAYER_RECORD.size
+        player_records = list(PLAYER_RECORD.iter_unpack(view[offset:end]))
+        players = []
+        for player_id, x, y, radius, scale, inputs_x, inputs_y, color_idx, \
+                name_length in player_records:
+            name = bytes(view[end:end + name_length]).decode()
+            end += name_length
+            player = Player(name, player_id, (x, y), radius)
+            player.scale, player.color_idx = scale, color_idx
+            player.inputs.x, player.inputs.y = inputs_x, inputs_y
+            players.append(player)
+
+        cell_count = len(game.orbs.cells)*len(game.orbs.cells[0])
+        offset, end = end, end + cell_count*CELL_SIZE.size
+        cell_sizes = [size for size, in CELL_SIZE.iter_unpack(view[offset:end])]
+        offset, end = end, end + orb_count*ORB_RECORD.size
+        orbs = [Orb((x, y), orb_id, radius, color_idx)
+            for orb_id, x, y, radius, color_idx in ORB_RECORD.iter_unpack(view[offset:end])]
+
+        offset, end = end, end + connection_count*CONNECTION_RECORD.size
+        connection_records = list(CONNECTION_RECORD.iter_unpack(view[offset:end]))
+        offset, end = end, end + orb_view_size*ORB_ID.size
+        orb_view_ids = [orb_id for orb_id, in ORB_ID.iter_unpack(view[offset:end])]
+
+    if (cell_width, cell_height) == cfg.MAP_CELL_SIZE:
+        column_count, first = len(game.orbs.cells[0]), 0
+        for cell_idx, size in enumerate(cell_sizes):
+            if size:
+                row, col = divmod(cell_idx, column_count)
+                game.orbs.fill_cell(row, col, orbs[first:first + size])
+                first += size
+        spanning_orbs = orbs[first:]
+    else:
+        spanning_orbs = orbs
+    for orb in spanning_orbs:
+        game.orbs.add(orb)
+    if game.view_pool:
+        game.view_pool.add_orbs(orbs)
+    orbs = {orb.id: orb for orb in orbs}
+    game.leaderboard = Leaderboard(cfg.LEADERBOARD_SIZE)
+    game.leaderboard.version = leaders_version + 1
+    for player in players:
+        game.id_to_player[player.id] = player
+        game.players.add(player)
+        game.leaderboard.add(player)
+        game.observers.append(player)
+
+    curr_time = time.time()
+    offset = 0
+    for ip, port, player_id, input_sequence, view_size in connection_records:
+        connection = Connection((socket.inet_ntoa(ip), port), curr_time)
+        connection.input_sequence = input_sequence
+        # Orbs that have since been eaten may still be in view
+        connection.orb_view = {orbs.get(orb_id) or
+                generate_orb(orb_seed, orb_id, map_size)
+            for orb_id in orb_view_ids[offset:offset + view_size]}
+        offset += view_size
+        game.server.adopt_connection(player_id, connection)
+    return game
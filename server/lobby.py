@@ -0,0 +1,112 @@
+"""Provides a lobby that spreads clients among several server processes.
+
+The servers run on the same host as the lobby, each on a port of its own,
+and report their load to the lobby, see Server.report_load. Clients
+connect to the lobby as if it were a server, and are answered with a
+REDIRECT_CODE message holding the port of the least loaded server, to
+which they then connect.
+"""
+
+import ipaddress
+import socket
+import threading
+import time
+import source.config as cfg
+import source.network
+from server.network_process import RateLimiter
+
+
+class ServerLoad:
+    """The most recent load reported by a server."""
+    def __init__(self, report_time, player_count, player_limit, load, bandwidth):
+        self.report_time = report_time
+        self.player_count = player_count
+        self.player_limit = player_limit
+        self.load = load  # Share of the time the server spends on its game loop
+        self.bandwidth = bandwidth  # Bytes per second sent and received by the server
+        self.redirected = set()  # Addresses of the clients redirected since the report
+
+    def get_score(self):
+        """Returns the largest of the shares of player slots, time, and bandwidth used"""
+        return max(self.player_count/max(1, self.player_limit), self.load,
+            self.bandwidth/cfg.LOBBY_SERVER_BANDWIDTH)
+
+
+class Lobby:
+    """Redirects connecting clients to the least loaded server.
+
+    Servers that have not reported for cfg.TIMEOUT_LIMIT are presumed
+    gone. Each redirected client is counted towards the players of its
+    server until the next report, so that clients connecting at once
+    are spread out as well. A client that repeats its connection attempt
+    before then is sent to the same server, without being counted again.
+    """
+    def __init__(self, port=None):
+        self.port = cfg.NETWORK_PORT if port is None else port
+        self.lobby_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.lobby_socket.bind(("", self.port))
+        self.lobby_socket.settimeout(1)
+        self.rate_limiter = RateLimiter(cfg.PACKET_RATE_LIMIT)
+        self.servers = {}  # Maps server ports to their ServerLoad
+        self.server_full_message = source.network.frame_message(
+            source.network.pack_message(cfg.DISCONNECT_CODE, cfg.SERVER_FULL_MESSAGE))
+        self.thread = threading.Thread(target=self._retrieve_messages)
+        self.run = False
+
+    def start(self):
+        if not self.run:
+            self.run = True
+            self.thread.start()
+            print("[LOBBY] Lobby started on port:", str(self.port))
+
+    def stop(self):
+        self.run = False
+        self.thread.join()
+        self.lobby_socket.close()
+
+    def is_running(self):
+        return self.run
+
+    def find_server(self, curr_time):
+        """Returns the port of the least loaded server with room, if any"""
+        best_port, best_score = None, 1
+        for port, server in list(self.servers.items()):
+            if curr_time - server.report_time > cfg.TIMEOUT_LIMIT:
+                del self.servers[port]
+            elif server.player_count < server.player_limit and server.get_score() < best_score:
+                best_port, best_score = port, server.get_score()
+        return best_port
+
+    def _retrieve_messages(self):
+        while self.run:
+            try:
+                data, addr = self.lobby_socket.recvfrom(2048)
+                if not self.rate_limiter.admit(addr): continue
+                code, message = source.network.decode_message(data)
+                if code == cfg.LOAD_REPORT_CODE:
+                    # Only servers on this host may report, as clients are
+                    # redirected by port alone
+                    if ipaddress.ip_address(addr[0]).is_loopback:
+                        self.servers[addr[1]] = ServerLoad(time.time(), *message)
+                elif code == cfg.CONNECT_CODE:
+                    self._redirect(addr)
+            except socket.timeout:
+                continue
+            except Exception as exc:
+                print("[LOBBY] Data reception failed for reasons:", exc)
+
+    def _redirect(self, addr):
+        port = next((port for port, server in list(self.servers.items())
+            if addr in server.redirected), None)
+        if port is None:
+            port = self.find_server(time.time())
+        if port is None:
+            data = self.server_full_message
+        else:
+            server = self.servers[port]
+            if addr not in server.redirected:
+                server.redirected.add(addr)
+                server.player_count += 1
+            data = source.network.frame_message(
+                source.network.pack_message(cfg.REDIRECT_CODE, port))
+        self.lobby_socket.sendto(data, addr)
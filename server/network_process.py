@@ -0,0 +1,362 @@
+"""Provides a separate process for the socket I/O of the server.
+
+The process receives, rate limits and decodes all incoming messages, and
+sends all outgoing messages, retransmitting reliable ones until they are
+acknowledged. It communicates with the server game process through a pair
+of ring buffers in shared memory, such that bursts of network traffic do
+not compete with the game simulation for the interpreter lock.
+
+The process may serve several server games, each through its own link,
+in which case every client is routed to the game that claimed it last.
+"""
+
+import collections
+import multiprocessing as mp
+import pickle
+import select
+import socket
+import struct
+import sys
+import time
+from multiprocessing import shared_memory
+import source.config as cfg
+import source.network
+
+# Event codes passed to the server game along with the message codes
+TIMEOUT_EVENT = -1
+STATS_EVENT = -2
+
+# Kinds of records passed to the network process
+SEND, SEND_RELIABLY, FORGET, ROUTE = 0, 1, 2, 3
+OUTBOUND_STRUCT = struct.Struct('<B4sHq')  # kind, ip, port, packet id
+
+
+class RateLimiter:
+    """Limits the rate at which packets are accepted from each address.
+
+    Each address is given a token bucket that refills at rate tokens per
+    second, up to cfg.PACKET_BURST_LIMIT. Packets arriving at an empty
+    bucket are to be dropped before decoding, so that a single flooding
+    address costs little and cannot crowd out other players.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowances = {}
+        self.last_prune_time = time.time()
+
+    def admit(self, addr):
+        curr_time = time.time()
+        if curr_time - self.last_prune_time > cfg.TIMEOUT_LIMIT:
+            self.last_prune_time = curr_time
+            self.allowances = {
+                a: allowance for a, allowance in self.allowances.items()
+                if curr_time - allowance[1] < cfg.TIMEOUT_LIMIT}
+        if addr not in self.allowances:
+            self.allowances[addr] = [cfg.PACKET_BURST_LIMIT, curr_time]
+        allowance = self.allowances[addr]
+        if curr_time > allowance[1]:
+            tokens = allowance[0] + (curr_time - allowance[1])*self.rate
+            allowance[0] = min(cfg.PACKET_BURST_LIMIT, tokens)
+            allowance[1] = curr_time
+        if allowance[0] < 1: return False
+        allowance[0] -= 1
+        return True
+
+
+class RingBuffer:
+    """A queue of byte records in shared memory.
+
+    There may be a single process writing and a single process reading.
+    The memory starts with the total nr of bytes written and read, which
+    only ever increase and are each updated by one side only, followed by
+    a ring of length prefixed records.
+    """
+    # The counters are native, since struct writes non-native integers one
+    # byte at a time, which the other process could observe half written
+    COUNTERS = struct.Struct('QQ')
+    COUNTER = struct.Struct('Q')
+    LENGTH = struct.Struct('I')
+
+    def __init__(self, name=None, size=0):
+        """Creates a ring buffer of size bytes, or attaches to one by name"""
+        if name is None:
+            self.memory = shared_memory.SharedMemory(
+                create=True, size=self.COUNTERS.size + size)
+            self.COUNTERS.pack_into(self.memory.buf, 0, 0, 0)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.ring = self.memory.buf[self.COUNTERS.size:]
+        self.capacity = len(self.ring)
+
+    def put(self, record):
+        """Appends the record, unless the ring is full"""
+        written, read = self.COUNTERS.unpack_from(self.memory.buf)
+        size = self.LENGTH.size + len(record)
+        if self.capacity - (written - read) < size: return False
+        self._write(written, self.LENGTH.pack(len(record)))
+        self._write(written + self.LENGTH.size, record)
+        self.COUNTER.pack_into(self.memory.buf, 0, written + size)
+        return True
+
+    def get(self):
+        """Removes and returns the oldest record, if any"""
+        written, read = self.COUNTERS.unpack_from(self.memory.buf)
+        if written == read: return None
+        length, = self.LENGTH.unpack(self._read(read, self.LENGTH.size))
+        record = self._read(read + self.LENGTH.size, length)
+        self.COUNTER.pack_into(self.memory.buf, self.COUNTER.size,
+            read + self.LENGTH.size + length)
+        return record
+
+    def is_empty(self):
+        written, read = self.COUNTERS.unpack_from(self.memory.buf)
+        return written == read
+
+    def close(self, unlink=False):
+        self.ring.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+    def _write(self, position, data):
+        start = position % self.capacity
+        split = min(len(data), self.capacity - start)
+        self.ring[start:start + split] = data[:split]
+        self.ring[:len(data) - split] = data[split:]
+
+    def _read(self, position, length):
+        start = position % self.capacity
+        split = min(length, self.capacity - start)
+        return bytes(self.ring[start:start + split]) + bytes(self.ring[:length - split])
+
+
+class NetworkLink:
+    """Handle through which a server game uses the network process.
+
+    Received messages are read through receive, except for acknowledgements
+    which the network process handles itself. Messages are sent already
+    encoded, and those sent with a packet id are retransmitted until
+    acknowledged. The network process reports clients that fail to
+    acknowledge in time as TIMEOUT_EVENT messages, and its statistics as
+    STATS_EVENT messages.
+
+    Records are passed on without waiting for the network process. While
+    its ring is full, unreliable messages are dropped, and every other
+    record is kept in order in a backlog until the ring frees up.
+    """
+    def __init__(self, inbound, outbound):
+        self.inbound, self.outbound = inbound, outbound
+        self.backlog = collections.deque()  # Records waiting for room in the ring
+
+    @classmethod
+    def attach(cls, names):
+        """Attaches to the ring buffers of a link created by another process"""
+        inbound_name, outbound_name = names
+        return cls(RingBuffer(inbound_name), RingBuffer(outbound_name))
+
+    def get_names(self):
+        return self.inbound.name, self.outbound.name
+
+    def close(self, unlink=False):
+        self.inbound.close(unlink)
+        self.outbound.close(unlink)
+
+    def send(self, addr, data, packet_id=None):
+        """Returns whether the message was passed on rather than dropped"""
+        kind = SEND if packet_id is None else SEND_RELIABLY
+        return self._put(kind, addr, data, packet_id or 0)
+
+    def forget(self, addr):
+        """Stops routing and retransmitting to the address"""
+        self._put(FORGET, addr, b'', 0)
+
+    def route(self, addr):
+        """Routes the messages from the address through this link"""
+        self._put(ROUTE, addr, b'', 0)
+
+    def receive(self):
+        """Yields the (addr, code, message) received since the last call"""
+        self.flush()
+        record = self.inbound.get()
+        while record is not None:
+            yield pickle.loads(record)
+            record = self.inbound.get()
+
+    def flush(self):
+        """Passes on the backlog for as long as the ring has room"""
+        while self.backlog and self.outbound.put(self.backlog[0]):
+            self.backlog.popleft()
+
+    def _put(self, kind, addr, data, packet_id):
+        ip, port = addr
+        record = OUTBOUND_STRUCT.pack(kind, socket.inet_aton(ip), port, packet_id) + data
+        self.flush()
+        if not self.backlog and self.outbound.put(record): return True
+        # Reliable messages, routes, and forgotten clients must not be lost,
+        # nor overtake one another
+        if kind == SEND: return False
+        self.backlog.append(record)
+        return True
+
+
+class NetworkProcess:
+    """Runs the network process with link_count links to server games."""
+    def __init__(self, port, link_count=1):
+        self.links = [NetworkLink(RingBuffer(size=cfg.NETWORK_RING_SIZE),
+            RingBuffer(size=cfg.NETWORK_RING_SIZE)) for _ in range(link_count)]
+        context = mp.get_context('spawn')
+        self.stop_event = context.Event()
+        self.process = context.Process(
+            target=run_network_process, daemon=True, args=(
+                [link.get_names() for link in self.links], port, self.stop_event))
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        for link in self.links:
+            link.close(unlink=True)
+
+
+def run_network_process(link_names, port, stop_event):
+    """Runs the network process until stop_event is set.
+
+    Clients are routed to a link once they connect through it, and to the
+    link that has routed them since. A new client is given the link of the
+    room id in its header, or else the link with the fewest clients.
+    Messages from clients without a route are answered by the network
+    process itself, and links without clients are not sent stats, so that
+    they are left idle. The stats of each link count the bytes received
+    from its own clients. The process also stops once its parent has died,
+    which frees the port for a standby, see server.standby.
+    """
+    links = [NetworkLink.attach(names) for names in link_names]
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_socket.bind(("", port))
+    server_socket.setblocking(False)
+    rate_limiter = RateLimiter(cfg.PACKET_RATE_LIMIT)
+    routes = {}  # Maps addresses to the index of their link
+    unacked_packets = {}  # Maps packet ids to their address, data, send times, and link
+    pings = {}  # Maps addresses to their most recent server pulse and round trip time
+    retransmits = {}  # Maps addresses to their nr of retransmissions
+    data_loads = [0]*len(links)  # Bytes received from the clients of each link
+    dropped_packets = 0
+    last_ack_time = last_probe_time = time.time()
+    not_connected_message = source.network.frame_message(source.network.pack_message(
+        cfg.DISCONNECT_CODE, cfg.NOT_CONNECTED_MESSAGE))
+    parent = mp.parent_process()
+
+    while not stop_event.is_set():
+        select.select([server_socket], [], [], 0.001)
+        while True:
+            try:
+                data, addr = server_socket.recvfrom(2048)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Such as when a previous message was refused by its recipient
+                continue
+            data_size = sys.getsizeof(data)+28
+            if addr in routes:
+                data_loads[routes[addr]] += data_size
+            if not rate_limiter.admit(addr):
+                dropped_packets += 1
+                continue
+            try:
+                room_id = source.network.get_room_id(data)
+                code, message = source.network.decode_message(data)
+                if code == cfg.ACK_CODE:
+                    if unacked_packets[message][0] == addr:
+                        del unacked_packets[message]
+                    continue
+                if code == cfg.PING_CODE:
+                    server_pulse = message[0]
+                    if server_pulse > pings.get(addr, (0, 0))[0]:
+                        pings[addr] = (server_pulse, time.time() - server_pulse)
+            except Exception:
+                continue
+            if addr in routes:
+                if room_id is not None and room_id != routes[addr]:
+                    continue
+            elif room_id is not None and room_id >= len(links):
+                _send(server_socket, not_connected_message, addr)
+                continue
+            else:
+                if code == cfg.CONNECT_CODE:
+                    loads = [0]*len(links)
+                    for link_idx in routes.values():
+                        loads[link_idx] += 1
+                    routes[addr] = loads.index(min(loads)) if room_id is None else room_id
+                    data_loads[routes[addr]] += data_size
+                else:
+                    if code != cfg.DISCONNECT_CODE:
+                        _send(server_socket, not_connected_message, addr)
+                    continue
+            if not links[routes[addr]].inbound.put(pickle.dumps((addr, code, message))):
+                dropped_packets += 1
+
+        curr_time = time.time()
+        for link_idx, link in enumerate(links):
+            record = link.outbound.get()
+            while record is not None:
+                kind, ip, port, packet_id = OUTBOUND_STRUCT.unpack_from(record)
+                addr = (socket.inet_ntoa(ip), port)
+                if kind == FORGET:
+                    if routes.get(addr) == link_idx:
+                        del routes[addr]
+                        for packet_id in [packet_id for packet_id, packet_info
+                                in unacked_packets.items() if packet_info[0] == addr]:
+                            del unacked_packets[packet_id]
+                        pings.pop(addr, None)
+                elif kind == ROUTE:
+                    routes[addr] = link_idx
+                else:
+                    data = record[OUTBOUND_STRUCT.size:]
+                    _send(server_socket, data, addr)
+                    if kind == SEND_RELIABLY:
+                        unacked_packets[packet_id] = [
+                            addr, data, curr_time, curr_time, link_idx]
+                record = link.outbound.get()
+
+        if curr_time - last_ack_time > cfg.ACK_INTERVAL:
+            last_ack_time = curr_time
+            if parent and not parent.is_alive(): break
+            for packet_id, packet_info in list(unacked_packets.items()):
+                addr, data, first_send_time, send_time, link_idx = packet_info
+                if curr_time - first_send_time > cfg.TIMEOUT_LIMIT:
+                    del unacked_packets[packet_id]
+                    link = links[routes.get(addr, link_idx)]
+                    link.inbound.put(pickle.dumps((addr, TIMEOUT_EVENT, None)))
+                elif curr_time - send_time >= 2*pings.get(addr, (0, 0))[1]:
+                    packet_info[3] = curr_time
+                    retransmits[addr] = retransmits.get(addr, 0) + 1
+                    _send(server_socket, data, addr)
+
+        if curr_time - last_probe_time > cfg.STATS_PROBE_INTERVAL:
+            last_probe_time = curr_time
+            link_retransmits = [{} for _ in links]
+            for addr, count in retransmits.items():
+                if addr in routes:
+                    link_retransmits[routes[addr]][addr] = count
+            routed_links = set(routes.values())
+            for link_idx, (link, retransmits) in enumerate(zip(links, link_retransmits)):
+                if link_idx not in routed_links: continue
+                stats = (data_loads[link_idx], dropped_packets, retransmits)
+                link.inbound.put(pickle.dumps((None, STATS_EVENT, stats)))
+            data_loads, retransmits = [0]*len(links), {}
+
+    server_socket.close()
+    for link in links:
+        link.close()
+
+
+def _send(server_socket, data, addr):
+    try:
+        server_socket.sendto(data, addr)
+    except OSError:
+        pass
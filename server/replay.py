@@ -0,0 +1,295 @@
+"""Provides recording and deterministic replay of server game sessions.
+
+A Recorder logs everything that a game takes from its clients to an
+append-only binary file: the joins, leaves, and inputs of players as the
+game applies them, the ids that the server gives respawning players, and
+the duration of every tick along with whether it synced. The file starts
+with REPLAY_HEADER, which holds the seed of the session, followed by
+records that each start with their kind:
+
+    JOIN_RECORD     a joining player, followed by its utf-8 name
+    PLAYER_RECORD   a leaving or respawning player
+    INPUTS_RECORD   the inputs applied to a player
+    TICK_RECORD     the end of a tick, to which the records before it belong
+
+The game is seeded by the session seed, both for its orbs and for the
+random module that drives bots and spawns, see record_game. A ReplayGame
+runs the same ticks as fast as possible, and may attribute its time to
+phases with a PhaseProfiler. Its joining players are served as clients
+at a made up address each, whose messages are encoded as in the session
+and sent to a socket that is never read. Since the order in
+which sets of entities are iterated over may differ between processes,
+the orb id after each tick is recorded, and replays report the first tick
+at which they diverged from the session.
+"""
+
+import collections
+import random
+import socket
+import struct
+import time
+import source.config as cfg
+from source.entities import UserInputs
+from server.server import Connection, Server
+from server.server_game import ServerGame
+
+
+REPLAY_MAGIC = b'NBRP'
+REPLAY_VERSION = 1
+# magic, version, seed, player limit, bot count, target orb count, map
+# width, and map height
+REPLAY_HEADER = struct.Struct('<4sHQIIIII')
+JOIN_KIND, LEAVE_KIND, RESPAWN_KIND, INPUTS_KIND, TICK_KIND = range(5)
+JOIN_RECORD = struct.Struct('<BiB')  # kind, player id, name length
+PLAYER_RECORD = struct.Struct('<Bi')  # kind, player id
+INPUTS_RECORD = struct.Struct('<Bihh')  # kind, player id, inputs
+TICK_RECORD = struct.Struct('<Bd?fI')  # kind, time delta, synced, duration, orb id
+
+# Maps phases of a game loop to the methods of ServerGame that make them up
+GAME_PHASES = {
+    'move': '_move_players',
+    'player collisions': '_handle_player_collisions',
+    'orb collisions': '_handle_orb_collisions',
+    'orb replenish': '_replenish_orbs',
+    'views': '_get_item_views',
+    'sync': '_sync_server_players',
+}
+# Maps phases of a game loop to the methods of Server that make them up
+SERVER_PHASES = {
+    'encode': ('_transmit_orbs', '_transmit_players', '_send_message'),
+}
+
+
+def record_game(path, player_limit, bot_count, target_orb_count, map_size,
+        headless=False, network_link=None, port=None):
+    """Returns a new game whose session is recorded to path, see ServerGame"""
+    seed = random.getrandbits(32)
+    random.seed(seed)
+    game = ServerGame(player_limit, bot_count, target_orb_count, map_size,
+        seed, headless, network_link, port)
+    game.recorder = Recorder(path, REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION,
+        seed, player_limit, bot_count, target_orb_count, *map_size))
+    return game
+
+
+class Recorder:
+    """Appends the records of a session to a file.
+
+    Records are buffered, and written every cfg.REPLAY_FLUSH_INTERVAL.
+    """
+    def __init__(self, path, header):
+        self.file = open(path, 'wb')
+        self.buffer = bytearray(header)
+        self.last_flush_time = time.time()
+
+    def record_join(self, player_id, player_name):
+        name = player_name.encode()[:255]
+        self.buffer += JOIN_RECORD.pack(JOIN_KIND, player_id, len(name))
+        self.buffer += name
+
+    def record_leave(self, player_id):
+        self.buffer += PLAYER_RECORD.pack(LEAVE_KIND, player_id)
+
+    def record_respawn(self, player_id):
+        self.buffer += PLAYER_RECORD.pack(RESPAWN_KIND, player_id)
+
+    def record_inputs(self, player_inputs):
+        for player_id, inputs in player_inputs.items():
+            self.buffer += INPUTS_RECORD.pack(INPUTS_KIND, player_id, inputs.x, inputs.y)
+
+    def record_tick(self, time_delta, synced, duration, orb_id):
+        self.buffer += TICK_RECORD.pack(TICK_KIND, time_delta, synced, duration, orb_id)
+        curr_time = time.time()
+        if curr_time - self.last_flush_time > cfg.REPLAY_FLUSH_INTERVAL:
+            self.last_flush_time = curr_time
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class ReplayLink:
+    """Stands in for the NetworkLink of a server that has no clients."""
+    def send(self, addr, data, packet_id=None):
+        return True
+
+    def forget(self, addr):
+        pass
+
+    def route(self, addr):
+        pass
+
+    def receive(self):
+        return ()
+
+
+class SinkLink:
+    """Sends the messages of a server to a local socket that is never read."""
+    def __init__(self):
+        self.sink_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sink_socket.bind(('127.0.0.1', 0))
+        self.sink_addr = self.sink_socket.getsockname()
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.send_socket.setblocking(False)
+
+    def send(self, addr, data, packet_id=None):
+        try:
+            self.send_socket.sendto(data, self.sink_addr)
+        except BlockingIOError:
+            return False
+        return True
+
+    def forget(self, addr):
+        pass
+
+    def route(self, addr):
+        pass
+
+    def receive(self):
+        return ()
+
+    def close(self):
+        self.sink_socket.close()
+        self.send_socket.close()
+
+
+class ReplayServer(Server):
+    """Plays back the recorded decisions of a server for a replayed game.
+
+    The game is told to sync on the ticks that synced in the session, when
+    every client is due, and respawning players are given their recorded
+    ids. Joins, leaves, and inputs are queued by the ReplayGame.
+    """
+    def __init__(self, map_size, orb_seed):
+        super().__init__(map_size, orb_seed, SinkLink())
+        self.synced = False
+        self.respawn_ids = collections.deque()
+
+    def stop(self):
+        super().stop()
+        self.network_link.close()
+
+    def add_player(self, player_id, player_name):
+        """Queues a recorded join, serving the player if it is new"""
+        if player_id not in self.id_map:
+            # Replayed clients never ack, nor time out
+            self.adopt_connection(player_id,
+                Connection(('127.0.0.1', player_id), float('Inf')))
+        self.player_add_queue.append((player_id, player_name))
+
+    def needs_sync(self):
+        return self.synced
+
+    def sync_player_death(self, player):
+        connection = self.id_map.pop(player.id)
+        player.id = self.respawn_ids.popleft()
+        self.addr_to_id[connection.addr] = player.id
+        self.id_map[player.id] = connection
+        self._send_reliably(player.id, connection, cfg.DEATH_CODE, player.id)
+
+    def _find_due_ids(self):
+        self.last_sync_time = self.server_time = time.time()
+        return set(self.id_map)
+
+
+class ReplayGame(ServerGame):
+    """Replays the session recorded at path, see replay."""
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.log = file.read()
+        magic, version, seed, player_limit, bot_count, target_orb_count, \
+            map_width, map_height = REPLAY_HEADER.unpack_from(self.log)
+        assert(magic == REPLAY_MAGIC and version == REPLAY_VERSION)
+        random.seed(seed)
+        map_size = (map_width, map_height)
+        super().__init__(player_limit, bot_count, target_orb_count, map_size,
+            seed, headless=True, server=ReplayServer(map_size, seed))
+
+    def replay(self):
+        """Runs the recorded ticks as fast as possible.
+
+        Returns:
+            The nr of ticks, the seconds that the replay took, the seconds
+            that the ticks took in the session, and the first tick after
+            which the replay differed from the session, or None.
+        """
+        server = self.server
+        tick_count, session_time, divergent_tick = 0, 0, None
+        offset = REPLAY_HEADER.size
+        start_time = time.perf_counter()
+        while offset < len(self.log):
+            kind = self.log[offset]
+            if kind == JOIN_KIND:
+                _, player_id, name_length = JOIN_RECORD.unpack_from(self.log, offset)
+                offset += JOIN_RECORD.size
+                name = self.log[offset:offset + name_length].decode()
+                offset += name_length
+                server.add_player(player_id, name)
+            elif kind == LEAVE_KIND:
+                _, player_id = PLAYER_RECORD.unpack_from(self.log, offset)
+                offset += PLAYER_RECORD.size
+                server.player_remove_queue.append(player_id)
+            elif kind == RESPAWN_KIND:
+                _, player_id = PLAYER_RECORD.unpack_from(self.log, offset)
+                offset += PLAYER_RECORD.size
+                server.respawn_ids.append(player_id)
+            elif kind == INPUTS_KIND:
+                _, player_id, inputs_x, inputs_y = INPUTS_RECORD.unpack_from(self.log, offset)
+                offset += INPUTS_RECORD.size
+                server.player_inputs[player_id] = UserInputs((inputs_x, inputs_y))
+            else:
+                _, time_delta, server.synced, duration, orb_id = \
+                    TICK_RECORD.unpack_from(self.log, offset)
+                offset += TICK_RECORD.size
+                self.main_loop(time_delta)
+                if self.orb_id != orb_id and divergent_tick is None:
+                    divergent_tick = tick_count
+                tick_count += 1
+                session_time += duration
+        return tick_count, time.perf_counter() - start_time, session_time, divergent_tick
+
+
+class PhaseProfiler:
+    """Attributes the time spent in methods of objects to named phases.
+
+    The methods are wrapped on their objects, and the time of a phase
+    excludes that of the phases called within it.
+    """
+    def __init__(self):
+        self.phase_times = {}  # Maps phases to the seconds spent in them
+        self.nested_times = []  # Seconds spent in the phases within each running phase
+
+    def wrap(self, obj, method_name, phase):
+        """Times the method of obj as part of phase"""
+        method = getattr(obj, method_name)
+        self.phase_times.setdefault(phase, 0)
+        def timed_method(*args, **kwargs):
+            start_time = time.perf_counter()
+            self.nested_times.append(0)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start_time
+                self.phase_times[phase] += duration - self.nested_times.pop()
+                if self.nested_times:
+                    self.nested_times[-1] += duration
+        setattr(obj, method_name, timed_method)
+
+    def wrap_game(self, game):
+        """Times the phases of the game loop, see GAME_PHASES and SERVER_PHASES.
+
+        The sends of the link of the server, if any, are timed as well.
+        """
+        for phase, method_name in GAME_PHASES.items():
+            self.wrap(game, method_name, phase)
+        for phase, method_names in SERVER_PHASES.items():
+            for method_name in method_names:
+                self.wrap(game.server, method_name, phase)
+        if game.server.network_link:
+            self.wrap(game.server.network_link, 'send', 'send')
@@ -0,0 +1,106 @@
+"""Provides a server that hosts several game rooms behind one socket.
+
+Each room is an independent ServerGame, whose server communicates through a
+link of a network process shared by all rooms. Clients name their room in
+the header of their messages, see source.network.frame_message, by which
+the network process routes them to the link of the room. The rooms are
+ticked in turn by a single loop, so that the rooms together are bounded by
+the time of one core. A room is only opened once a client connects to it,
+and is closed once it has been empty for a while, such that unused rooms
+cost no more than a glance at their link. The orbs of a new room are
+spawned over its first ticks, so that opening it does not stall the
+rooms already open.
+"""
+
+import time
+import source.config as cfg
+import source.network
+from server.network_process import NetworkProcess
+from server.server_game import ServerGame
+
+
+class Room:
+    """An open game room along with its tick times."""
+    def __init__(self, game, curr_time):
+        self.game = game
+        self.last_tick_time = curr_time
+        self.empty_since = curr_time
+
+
+class RoomManager:
+    """Runs up to room_count game rooms, with room ids 0 to room_count-1.
+
+    New rooms are refused while the open rooms use more than
+    cfg.ROOM_CPU_BUDGET of the time of the loop, and their clients are
+    told that the server is full.
+    """
+    def __init__(self, room_count, player_limit, target_orb_count, map_size):
+        self.player_limit = player_limit
+        self.target_orb_count = target_orb_count
+        self.map_size = map_size
+        self.network_process = NetworkProcess(cfg.NETWORK_PORT, room_count)
+        self.rooms = [None]*room_count
+        self.server_full_message = source.network.frame_message(
+            source.network.pack_message(cfg.DISCONNECT_CODE, cfg.SERVER_FULL_MESSAGE))
+        self.run = False
+
+    def start(self):
+        if not self.run:
+            self.run = True
+            self.network_process.start()
+            print("[SERVER] Room server started with", len(self.rooms),
+                "rooms on port:", str(cfg.NETWORK_PORT))
+
+    def stop(self):
+        self.run = False
+        for room_id, room in enumerate(self.rooms):
+            if room: self._close_room(room_id)
+        self.network_process.stop()
+
+    def is_running(self):
+        return self.run
+
+    def get_load(self):
+        """Returns the share of the time of the loop used by the open rooms"""
+        return sum(room.game.load for room in self.rooms if room)
+
+    def main_loop(self):
+        """Ticks the rooms that are due, and opens and closes rooms"""
+        tick_interval = 1/cfg.SERVER_GAME_REFRESH_RATE
+        curr_time = time.time()
+        for room_id, room in enumerate(self.rooms):
+            if room is None:
+                if not self.network_process.links[room_id].inbound.is_empty():
+                    self._open_room(room_id, curr_time)
+                continue
+            time_delta = curr_time - room.last_tick_time
+            if time_delta < tick_interval: continue
+            room.game.main_loop(time_delta)
+            room.last_tick_time = curr_time
+            if room.game.server.id_map:
+                room.empty_since = curr_time
+            elif curr_time - room.empty_since > cfg.ROOM_IDLE_TIMEOUT:
+                self._close_room(room_id)
+
+        next_tick_time = min([room.last_tick_time + tick_interval
+            for room in self.rooms if room], default=curr_time + cfg.ROOM_POLL_INTERVAL)
+        time.sleep(max(0, min(next_tick_time - time.time(), cfg.ROOM_POLL_INTERVAL)))
+
+    def _open_room(self, room_id, curr_time):
+        link = self.network_process.links[room_id]
+        if self.get_load() > cfg.ROOM_CPU_BUDGET:
+            for addr, code, _ in link.receive():
+                if addr is None: continue
+                if code == cfg.CONNECT_CODE:
+                    link.send(addr, self.server_full_message)
+                link.forget(addr)
+            return
+        game = ServerGame(self.player_limit, 0, self.target_orb_count,
+            self.map_size, headless=True, network_link=link)
+        game.orb_spawn_limit = cfg.ROOM_ORB_SPAWN_LIMIT
+        game.start()
+        self.rooms[room_id] = Room(game, curr_time)
+
+    def _close_room(self, room_id):
+        self.rooms[room_id].game.stop()
+        self.rooms[room_id] = None
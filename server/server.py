@@ -1,7 +1,8 @@
 """Provides a Server interface for communication with clients."""
 
 import collections
-import pickle
+import itertools
+import math
 import time
 import socket
 import sys
@@ -10,6 +11,105 @@ import pygame as pg
 import source.config as cfg
 from source.entities import UserInputs
 import source.network
+from server.network_process import NetworkProcess, RateLimiter, \
+    TIMEOUT_EVENT, STATS_EVENT
+
+
+class Connection:
+    """Stores the state that the server keeps for each connected client."""
+    def __init__(self, addr, heartbeat):
+        self.addr = addr
+        self.orb_view = set()
+        self.heartbeat = heartbeat
+        self.ping = 0
+        self.input_sequence = 0  # Most recent input sample applied
+        self.leaders_version = -1  # Most recent leaderboard known to the client
+        # Maps ids of players in view to their update priority, as well as
+        # their position and radius when last sent
+        self.player_priorities = {}
+        self.known_metadata = set()  # Ids of players whose metadata was sent
+        self.metadata_requests = collections.deque([], 256)
+        self.view_key = None  # Identifies the client to a ViewPool
+
+        # Congestion control state, see adjust_send_rate
+        self.send_interval = cfg.SERVER_SYNC_INTERVAL
+        self.update_budget = cfg.PLAYER_UPDATE_BUDGET
+        self.congested = False
+        self.base_ping = 0
+        self.reliable_sends, self.retransmits = 0, 0
+        self.last_send_time, self.last_adjust_time = 0, 0
+
+    def is_due(self, curr_time):
+        """Determines whether the client is due a sync at its send rate"""
+        # Syncs only take place every cfg.SERVER_SYNC_INTERVAL, so any sync
+        # that is closer than half an interval to being due is let through
+        if curr_time - self.last_send_time < self.send_interval - cfg.SERVER_SYNC_INTERVAL/2:
+            return False
+        self.last_send_time = curr_time
+        return True
+
+    def adjust_send_rate(self, curr_time):
+        """Backs off the send rate while congested, and recovers it gradually.
+
+        The client is considered congested when many reliable packets had to
+        be retransmitted, or its round trip time has risen well above its
+        baseline. The baseline follows the lowest round trip time, but drifts
+        upwards so that a lasting rise is eventually accepted.
+        """
+        if curr_time - self.last_adjust_time < cfg.CONGESTION_ADJUST_INTERVAL: return
+        self.last_adjust_time = curr_time
+        # A single retransmission is not taken as a sign of congestion
+        loss = (self.retransmits - 1)/max(1, self.reliable_sends + self.retransmits)
+        self.reliable_sends, self.retransmits = 0, 0
+        self.base_ping = min(self.ping, self.base_ping + cfg.CONGESTION_BASELINE_DRIFT)
+        self.congested = (loss > cfg.CONGESTION_LOSS_LIMIT or
+            self.ping > self.base_ping + cfg.CONGESTION_RTT_MARGIN)
+        if self.congested:
+            self.send_interval = min(cfg.CONGESTION_MAX_INTERVAL, 2*self.send_interval)
+            self.update_budget = max(cfg.CONGESTION_MIN_BUDGET, self.update_budget//2)
+        else:
+            self.send_interval = max(cfg.SERVER_SYNC_INTERVAL,
+                self.send_interval - cfg.SERVER_SYNC_INTERVAL/4)
+            self.update_budget = min(cfg.PLAYER_UPDATE_BUDGET,
+                self.update_budget + cfg.PLAYER_UPDATE_BUDGET//8)
+
+
+def prioritize_players(connection, viewer, player_view):
+    """Returns the players in view that are due an update.
+
+    Every sync, each player gains priority by its proximity to the
+    viewer, relative to the view range, or by how far it has moved since
+    it was last sent, whichever is greater. Players with a priority of
+    at least 1 are due, and are sent in order of priority until
+    the update budget of the connection runs out. The viewer is always sent
+    first, followed by players new to the view.
+    """
+    near_distance = cfg.PRIORITY_NEAR_FRACTION*viewer.scale*cfg.BASE_WIDTH/2
+    priorities = {}
+    for player in player_view:
+        if player.id in connection.player_priorities and player.id != viewer.id:
+            priority, sent_x, sent_y, sent_radius = \
+                connection.player_priorities[player.id]
+            distance = max(near_distance,
+                viewer.find_distance(player) - player.radius)
+            moved = math.hypot(player.x - sent_x, player.y - sent_y)
+            moved += abs(player.radius - sent_radius)
+            priority += max(near_distance/distance,
+                moved/cfg.PRIORITY_MOTION_DISTANCE)
+            priorities[player.id] = [priority, sent_x, sent_y, sent_radius]
+        else:
+            priorities[player.id] = [float('Inf'), 0, 0, 0]
+    connection.player_priorities = priorities
+
+    due_players = [player for player in player_view
+        if priorities[player.id][0] >= 1]
+    # The viewer ties with players new to the view, so it is ranked above them
+    due_players.sort(key=lambda player: (player.id == viewer.id,
+        priorities[player.id][0]), reverse=True)
+    del due_players[connection.update_budget//source.network.PLAYER_STRUCT.size:]
+    for player in due_players:
+        priorities[player.id] = [0, player.x, player.y, player.radius]
+    return due_players
 
 
 class Server:
@@ -20,19 +120,41 @@ class Server:
     Outgoing messages are received from the same ServerGame instance which
     calls function sync_state whenever updates are to be transmitted to
     clients.
+
+    With cfg.NETWORK_PROCESS, the socket is handled by a NetworkProcess
+    instead of threads, which leaves the interpreter lock of the game process
+    to the game. Received messages are then collected whenever needs_sync
+    is called. The same goes for a server given the link of a network process
+    that is shared with other servers, see server.sharding and server.rooms.
     """
-    def __init__(self, map_size):
-        """Initializes the server with a map size defined by map_size"""
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_socket.bind(("", cfg.NETWORK_PORT))
-        self.server_socket.settimeout(1)
+    def __init__(self, map_size, orb_seed, network_link=None, port=None):
+        """Initializes the server with a map size defined by map_size.
+
+        Clients are given orb_seed, from which they generate orbs by id. The
+        server binds port, or cfg.NETWORK_PORT if None.
+        """
+        self.port = cfg.NETWORK_PORT if port is None else port
+        self.network_process = None
+        self.network_link = network_link
+        self.server_socket = None
+        if network_link is None and cfg.NETWORK_PROCESS:
+            self.network_process = NetworkProcess(self.port)
+            self.network_link = self.network_process.links[0]
+        elif network_link is None:
+            # Bound once started, so that a standby may prepare its server
+            # while the primary holds the port, see server.standby
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server_socket.settimeout(1)
 
         self.run = False
         self.map_size = map_size
+        self.orb_seed = orb_seed
         self.threads = []
         self.server_time = time.time()
         self.packet_id, self.player_id = 0, 0
-        self.player_input_queue = collections.deque([], 4096)
+        self.id_step = 1  # Ids are spaced apart when several servers hand them out
+        self.player_inputs = {}  # Holds the most recent inputs of each player
+        self.input_lock = threading.Lock()
         self.player_add_queue = collections.deque([], 4096)
         self.player_remove_queue = collections.deque([], 4096)
         self.ack_transmission_queue = collections.deque([], 4096)
@@ -40,30 +162,56 @@ class Server:
 
         self.id_map = {}
         self.addr_to_id = {}
+        self.view_keys = itertools.count()
         self.connected_addresses = set()
         self.last_sync_time = self.server_time
+        self.last_report_time = 0
+        self.reliable_log = None  # Collects reliable sends while replicated
+
+        self.rate_limiter = RateLimiter(cfg.PACKET_RATE_LIMIT)
+
+        self.compression_threshold = cfg.COMPRESSION_THRESHOLD
+        # Maps message codes to their payload bytes, sent bytes, and cpu time
+        self.compression_load = collections.defaultdict(lambda: [0, 0, 0])
 
         self.data_load = 0
-        self.connection_statistics = [0]
+        self.dropped_packets = 0
+        self.unsent_packets = 0  # Messages dropped while the network process fell behind
+        self.coalesced_inputs = 0
+        # Compiles bandwidth, dropped_packets, coalesced_inputs, compression,
+        # and send rates into a list. Compression maps message codes to their
+        # payload bytes, sent bytes, and cpu seconds spent per second. Send
+        # rates holds the mean sync rate of clients and the nr congested.
+        self.connection_statistics = [0, 0, 0, {}, (0, 0)]
         self.last_probe_time = self.server_time
 
     def start(self):
         if not self.run:
+            if self.server_socket:
+                self.server_socket.bind(("", self.port))
             self.run = True
-            thread_1 = threading.Thread(target=self._handle_acknowledgements)
-            thread_2 = threading.Thread(target=self._retrieve_messages)
-            self.threads.extend([thread_1, thread_2])
-            for thread in self.threads:
-                thread.start()
+            if self.network_process:
+                self.network_process.start()
+            elif self.server_socket:
+                thread_1 = threading.Thread(target=self._handle_acknowledgements)
+                thread_2 = threading.Thread(target=self._retrieve_messages)
+                self.threads.extend([thread_1, thread_2])
+                for thread in self.threads:
+                    thread.start()
+            else:
+                return  # A shared network process is started by its owner
             local_addr = socket.gethostbyname(socket.gethostname())
             print("[SERVER] Server Started with local address:", local_addr)
             print("[SERVER] For players to connect by public IP, port",
-                "forwarding may be necessary on port:", str(cfg.NETWORK_PORT))
+                "forwarding may be necessary on port:", str(self.port))
 
     def stop(self):
         self.run = False
-        for t in self.threads: t.join()
-        self.server_socket.close()
+        if self.network_process:
+            self.network_process.stop()
+        elif self.server_socket:
+            for t in self.threads: t.join()
+            self.server_socket.close()
 
     def get_player_additions(self):
         return self.player_add_queue
@@ -72,109 +220,289 @@ class Server:
         return self.player_remove_queue
 
     def get_player_inputs(self):
-        return self.player_input_queue
+        """Returns the most recent inputs of each player since the last call"""
+        with self.input_lock:
+            player_inputs, self.player_inputs = self.player_inputs, {}
+        return player_inputs
 
     def approve_player_connection(self, player_id, player):
         if player_id not in self.id_map: return
-        player_addr = self.id_map[player_id][0]
-        encoded_player = source.network.encode_player(player)
-        message = (player_id, encoded_player, self.map_size)
+        connection = self.id_map[player_id]
+        connection.known_metadata.add(player_id)
+        encoded_metadata = source.network.encode_metadata(player)
+        origin = source.network.get_origin(player.x, player.y)
+        encoded_player = source.network.encode_players([player], origin)
+        message = (player_id, encoded_metadata, encoded_player,
+            self.map_size, self.orb_seed)
+        player_addr = connection.addr
         self._connect_player(message, player_addr)
 
     def drop_player_connection(self, player_id, message):
         if player_id not in self.id_map: return
-        player_addr = self.id_map[player_id][0]
+        player_addr = self.id_map[player_id].addr
         if player_addr in self.addr_to_id:
             del self.addr_to_id[player_addr]
         self.connected_addresses.discard(player_addr)
         del self.id_map[player_id]
         self._disconnect_player(message, player_addr)
+        if self.network_link:
+            self.network_link.forget(player_addr)
+
+    def release_connection(self, player_id):
+        """Stops serving the player, and returns its connection.
+
+        The connection is to be adopted by another server sharing the same
+        network process, see adopt_connection.
+        """
+        connection = self.id_map.pop(player_id)
+        del self.addr_to_id[connection.addr]
+        self.connected_addresses.discard(connection.addr)
+        with self.input_lock:
+            self.player_inputs.pop(player_id, None)
+        return connection
+
+    def adopt_connection(self, player_id, connection):
+        """Serves a player whose connection was released by another server"""
+        # Leaderboard versions are not comparable across servers
+        connection.leaders_version = -1
+        connection.view_key = None
+        self.id_map[player_id] = connection
+        self.addr_to_id[connection.addr] = player_id
+        self.connected_addresses.add(connection.addr)
+        if self.network_link:
+            self.network_link.route(connection.addr)
 
     def needs_sync(self):
+        if self.network_link:
+            self._poll_network_process()
         self.server_time = time.time()
         time_passed = self.server_time - self.last_sync_time
         return time_passed > cfg.SERVER_SYNC_INTERVAL
 
     def sync_state(
-        self, leaders, player_views, orb_views):
+        self, leaderboard, player_views, orb_views):
         """Transmit data, then add or removes players"""
-        self.last_sync_time = self.server_time = time.time()
-        self._transmit_orbs(orb_views)
-        self._transmit_players(leaders, player_views)
+        due_ids = self._find_due_ids()
+        self._transmit_orbs(
+            [view for view in orb_views if view[0] in due_ids])
+        self._transmit_players(leaderboard,
+            [view for view in player_views if view[0].id in due_ids])
+        self._update_connection_statistics()
+
+    def sync_pooled_state(self, leaderboard, players, view_pool):
+        """Transmits views computed by a ViewPool, see sync_state.
+
+        Args:
+            players: Maps the ids of all players in the game to the players.
+            view_pool: The ViewPool that computes and encodes the views of
+                the players that are due a sync.
+        """
+        view_tasks = []
+        for player_id in self._find_due_ids():
+            if player_id not in players: continue
+            connection = self.id_map[player_id]
+            if connection.view_key is None:
+                connection.view_key = next(self.view_keys)
+            view_tasks.append(
+                (connection.view_key, player_id, connection.update_budget))
+        for player_id, view_ids, player_ids, player_list, orb_updates \
+                in view_pool.compute_views(players.values(), view_tasks):
+            connection = self.id_map[player_id]
+            if orb_updates:
+                self._send_reliably(
+                    player_id, connection, cfg.UPD_ORBS_CODE, orb_updates)
+            player_view = [players[view_id] for view_id in player_ids]
+            self._transmit_view(leaderboard, connection, player_id,
+                player_view, view_ids, player_list)
         self._update_connection_statistics()
 
     def sync_player_death(self, player):
         player_info = self.id_map[player.id]
-        player_addr, _, player_time, player_ping = player_info
+        player_addr = player_info.addr
         self.id_map.pop(player.id)
-        self.player_id += 1
+        self.player_id += self.id_step
         player.id = self.player_id
         self.addr_to_id[player_addr] = player.id
         self.id_map[player.id] = player_info
-        self.packet_id += 1
-        update = (player.id, player_addr, self.packet_id,
-                self.server_time, cfg.DEATH_CODE, player.id)
-        self.ack_transmission_queue.append(update)
-        message = (self.packet_id, player.id)
-        self._send_message(cfg.DEATH_CODE, message, player_addr)
+        self._send_reliably(player.id, player_info, cfg.DEATH_CODE, player.id)
 
     def get_connection_statistics(self):
         return self.connection_statistics
 
+    def report_load(self, player_limit, load):
+        """Reports the load of the server to cfg.LOBBY_ADDRESS, if due.
+
+        Servers whose network process is shared by other servers are not
+        reported, since the lobby tells servers apart by port.
+        """
+        if cfg.LOBBY_ADDRESS is None or not (self.server_socket or self.network_process):
+            return
+        curr_time = time.time()
+        if curr_time - self.last_report_time < cfg.LOBBY_REPORT_INTERVAL: return
+        self.last_report_time = curr_time
+        report = (len(self.id_map), player_limit, load, self.connection_statistics[0])
+        self._send_message(cfg.LOAD_REPORT_CODE, report, cfg.LOBBY_ADDRESS)
+
+    def _find_due_ids(self):
+        """Adjusts the send rates of clients, and returns the ids of those due"""
+        self.last_sync_time = self.server_time = time.time()
+        due_ids = set()
+        for player_id, connection in list(self.id_map.items()):
+            connection.adjust_send_rate(self.server_time)
+            if connection.is_due(self.server_time):
+                due_ids.add(player_id)
+        return due_ids
+
     def _update_connection_statistics(self):
         if self.server_time - self.last_probe_time > cfg.STATS_PROBE_INTERVAL:
-            bw = self.data_load/(self.server_time - self.last_probe_time)
+            time_elapsed = self.server_time - self.last_probe_time
+            bw = self.data_load/time_elapsed
             self.data_load = 0
+            compression_load, self.compression_load = \
+                self.compression_load, collections.defaultdict(lambda: [0, 0, 0])
             self.connection_statistics[0] = bw
+            self.connection_statistics[1] = self.dropped_packets + self.unsent_packets
+            self.connection_statistics[2] = self.coalesced_inputs
+            self.connection_statistics[3] = {
+                code: tuple(value/time_elapsed for value in load)
+                for code, load in compression_load.items()}
+            connections = list(self.id_map.values())
+            if connections:
+                self.connection_statistics[4] = (
+                    sum(1/c.send_interval for c in connections)/len(connections),
+                    sum(c.congested for c in connections))
             self.last_probe_time = self.server_time
 
-    def _transmit_players(self, leaders, player_views):
-        for player_id, player_view in player_views:
-            player_list, leader_list = [], []
-            for player in player_view:
-                player_list.append(source.network.encode_player(player))
-            for player in leaders:
-                leader_list.append(player.name)
-            transmit = (leader_list, player_list, self.server_time)
-
-            player_addr, _, player_time, player_ping = self.id_map[player_id]
-            if self.server_time - player_time >= cfg.TIMEOUT_LIMIT:
-                self._remove_player(player_id)
-            else:
-                if self.server_time - player_time >= cfg.PLAYER_INTERRUPT_LIMIT:
-                    default_inputs = source.network.encode_inputs(UserInputs())
-                    self._update_commands(default_inputs, player_addr)
-            message = (transmit, player_ping)
-            self._send_message(cfg.UPD_PLAYERS_CODE, message, player_addr)
+    def _transmit_players(self, leaderboard, player_views):
+        """Transmits the players in view, and the leaders if they are news.
+
+        Players are referred to by id, with their names and colors sent
+        separately through _transmit_metadata. Every player in view is
+        listed by id, but only those due an update are sent in full, see
+        prioritize_players. The leaders are repeated until the client
+        confirms having received the current version.
+        """
+        for viewer, player_view in player_views:
+            connection = self.id_map[viewer.id]
+            origin = source.network.get_origin(viewer.x, viewer.y)
+            view_ids = source.network.encode_ids(player.id for player in player_view)
+            player_list = source.network.encode_players(
+                prioritize_players(connection, viewer, player_view), origin)
+            self._transmit_view(leaderboard, connection, viewer.id,
+                player_view, view_ids, player_list)
+
+    def _transmit_view(self, leaderboard, connection, player_id,
+            player_view, view_ids, player_list):
+        """Transmits an encoded view along with any news of its players"""
+        self._transmit_metadata(connection, player_id,
+            itertools.chain(player_view, leaderboard.leaders))
+        if connection.leaders_version == leaderboard.version:
+            transmit = (None, view_ids, player_list, self.server_time)
+        else:
+            leader_update = (leaderboard.version,
+                [player.id for player in leaderboard.leaders])
+            transmit = (leader_update, view_ids, player_list, self.server_time)
+
+        player_addr = connection.addr
+        if self.server_time - connection.heartbeat >= cfg.TIMEOUT_LIMIT:
+            self._remove_player(player_id)
+        else:
+            if self.server_time - connection.heartbeat >= cfg.PLAYER_INTERRUPT_LIMIT:
+                self._post_inputs(player_id, UserInputs())
+        message = (transmit, connection.ping)
+        self._send_message(cfg.UPD_PLAYERS_CODE, message, player_addr)
+
+    def _transmit_metadata(self, connection, player_id, players):
+        """Reliably transmits the metadata of players new to the client"""
+        while connection.metadata_requests:
+            connection.known_metadata.difference_update(
+                connection.metadata_requests.popleft())
+        players = {player.id: player for player in players}
+        if len(connection.known_metadata) > cfg.METADATA_CACHE_SIZE:
+            connection.known_metadata.intersection_update(players)
+        metadata = [source.network.encode_metadata(player)
+            for player in players.values()
+            if player.id not in connection.known_metadata]
+        if not metadata: return
+        connection.known_metadata.update(players)
+        self._send_reliably(player_id, connection, cfg.METADATA_CODE, metadata)
 
     def _transmit_orbs(self, orb_views):
         for player_id, new_orb_view in orb_views:
-            player_addr, curr_orb_view, _, _ = self.id_map[player_id]
-            orb_additions, orb_removals = [], []
-            for orb in new_orb_view ^ curr_orb_view:
-                if orb in new_orb_view:
-                    orb_additions.append(source.network.encode_orb(orb))
-                else:
-                    orb_removals.append(source.network.encode_orb(orb))
-            self.id_map[player_id][1] = new_orb_view
+            connection = self.id_map[player_id]
+            curr_orb_view = connection.orb_view
+            orb_additions = new_orb_view - curr_orb_view
+            orb_removals = curr_orb_view - new_orb_view
+            connection.orb_view = new_orb_view
             if orb_additions or orb_removals:
-                orb_updates = (orb_additions, orb_removals)
-                self.packet_id += 1
-                update = (player_id, player_addr, self.packet_id,
-                    self.server_time, cfg.UPD_ORBS_CODE, orb_updates)
-                self.ack_transmission_queue.append(update)
-                message = (self.packet_id, orb_updates)
-                self._send_message(cfg.UPD_ORBS_CODE, message, player_addr)
-
-    def _send_message(self, code, message, addr):
-        data = pickle.dumps((code, message))
+                orb_updates = (source.network.encode_orb_ids(orb_additions),
+                    source.network.encode_orb_ids(orb_removals))
+                self._send_reliably(
+                    player_id, connection, cfg.UPD_ORBS_CODE, orb_updates)
+
+    def resend_reliably(self, addr, packet_id, code, updates):
+        """Sends updates that another server sent under packet_id.
+
+        Clients acknowledge packets that they have already received without
+        applying them again, so recent packets may safely be sent twice.
+        """
+        if addr in self.addr_to_id:
+            player_id = self.addr_to_id[addr]
+            self._send_packet(player_id, self.id_map[player_id], packet_id, code, updates)
+
+    def _send_reliably(self, player_id, connection, code, updates):
+        """Sends updates that are retransmitted until acknowledged"""
+        self.packet_id += self.id_step
+        if self.reliable_log is not None:
+            self.reliable_log.append((connection.addr, self.packet_id, code, updates))
+        self._send_packet(player_id, connection, self.packet_id, code, updates)
+
+    def _send_packet(self, player_id, connection, packet_id, code, updates):
+        connection.reliable_sends += 1
+        update = (player_id, connection.addr, packet_id,
+            self.server_time, code, updates)
+        message = (packet_id, updates)
+        if self.network_link:
+            # The network process handles retransmission itself
+            self._send_message(code, message, connection.addr, packet_id)
+            return
+        self.ack_transmission_queue.append(update)
+        self._send_message(code, message, connection.addr)
+
+    def _send_message(self, code, message, addr, packet_id=None):
+        payload = source.network.pack_message(code, message)
+        start_time = time.perf_counter()
+        data = source.network.frame_message(payload, self.compression_threshold)
+        load = self.compression_load[code]
+        load[0] += len(payload)
+        load[1] += len(data)
+        load[2] += time.perf_counter() - start_time
         self.data_load += sys.getsizeof(data)+28
-        self.server_socket.sendto(data, addr)
+        if self.network_link:
+            if not self.network_link.send(addr, data, packet_id):
+                self.unsent_packets += 1
+        else:
+            self.server_socket.sendto(data, addr)
 
     def _handle_acknowledgements(self):
-        """d"""
+        """Retransmits reliable packets until they are acknowledged.
+
+        A packet is only retransmitted once it has gone unacknowledged for
+        longer than twice the round trip time of its client, such that slow
+        clients are not flooded with duplicates.
+        """
         unacked_packets = {}
         while self.run:
+            # Packets are registered before acknowledgements are processed,
+            # since a fast client may acknowledge a packet before it is
+            # registered, which would otherwise leave it to be retransmitted
+            curr_time = time.time()
+            while self.ack_transmission_queue:
+                player_id, player_addr, packet_id, server_time, \
+                    code, updates = self.ack_transmission_queue.popleft()
+                unacked_packets[packet_id] = (player_id, player_addr,
+                        code, updates, server_time, curr_time)
+
             while self.ack_reception_queue:
                 packet_id, player_addr = self.ack_reception_queue.popleft()
                 if packet_id in unacked_packets:
@@ -183,20 +511,20 @@ class Server:
 
             for packet_id, packet_info in list(unacked_packets.items()):
                 player_id, player_addr, code, updates, \
-                        past_server_time = packet_info
+                        past_server_time, send_time = packet_info
                 if self.server_time - past_server_time > cfg.TIMEOUT_LIMIT or \
                         player_addr not in self.connected_addresses:
                     self._remove_player(player_id)
                     del unacked_packets[packet_id]
-                else:
-                    message = (packet_id, updates)
-                    self._send_message(code, message, player_addr)
-
-            while self.ack_transmission_queue:
-                player_id, player_addr, packet_id, server_time, \
-                    code, updates = self.ack_transmission_queue.popleft()
-                unacked_packets[packet_id] = \
-                        (player_id, player_addr, code, updates, server_time)
+                    continue
+                connection = self.id_map.get(self.addr_to_id.get(player_addr))
+                if connection is None: continue
+                if curr_time - send_time < 2*connection.ping: continue
+                connection.retransmits += 1
+                unacked_packets[packet_id] = (player_id, player_addr, code,
+                        updates, past_server_time, curr_time)
+                message = (packet_id, updates)
+                self._send_message(code, message, player_addr)
 
             time.sleep(cfg.ACK_INTERVAL)
 
@@ -206,22 +534,47 @@ class Server:
             try:
                 data, addr = self.server_socket.recvfrom(2048)
                 self.data_load += sys.getsizeof(data)+28
-                code, data = pickle.loads(data)
-
-                if code == cfg.CONNECT_CODE:
-                    self._add_new_player(data, addr)
-                elif code == cfg.INPUTS_CODE:
-                    self._update_commands(data, addr)
-                elif code == cfg.ACK_CODE:
-                    self._update_acks(data, addr)
-                elif code == cfg.PING_CODE:
-                    self._update_ping(data, addr)
-                elif code == cfg.DISCONNECT_CODE:
-                    self._remove_player(data)
+                if not self.rate_limiter.admit(addr):
+                    self.dropped_packets += 1
+                    continue
+                code, data = source.network.decode_message(data)
+                self._handle_message(code, data, addr)
+            except Exception:
+                pass
 
+    def _poll_network_process(self):
+        """Handles the messages and events relayed by the network process"""
+        for addr, code, data in self.network_link.receive():
+            try:
+                if code == TIMEOUT_EVENT:
+                    if addr in self.addr_to_id:
+                        self._remove_player(self.addr_to_id[addr])
+                elif code == STATS_EVENT:
+                    data_load, self.dropped_packets, retransmits = data
+                    self.data_load += data_load
+                    for player_addr, count in retransmits.items():
+                        connection = self.id_map.get(self.addr_to_id.get(player_addr))
+                        if connection is not None:
+                            connection.retransmits += count
+                else:
+                    self._handle_message(code, data, addr)
             except Exception:
                 pass
 
+    def _handle_message(self, code, data, addr):
+        if code == cfg.CONNECT_CODE:
+            self._add_new_player(data, addr)
+        elif code == cfg.INPUTS_CODE:
+            self._update_commands(data, addr)
+        elif code == cfg.ACK_CODE:
+            self._update_acks(data, addr)
+        elif code == cfg.PING_CODE:
+            self._update_ping(data, addr)
+        elif code == cfg.METADATA_REQUEST_CODE:
+            self._update_metadata_requests(data, addr)
+        elif code == cfg.DISCONNECT_CODE:
+            self._remove_player(data)
+
     def _add_new_player(self, player_name, player_addr):
         """Adds a new player connecting from a unique address to the game.
         
@@ -232,34 +585,70 @@ class Server:
         player_name = source.network.decode_name(player_name)
         if player_addr not in self.connected_addresses:
             self.connected_addresses.add(player_addr)
-            self.player_id += 1
+            self.player_id += self.id_step
             self.addr_to_id[player_addr] = self.player_id
-            # Player info includes Ip address, orb_view, heartbeat, ping
-            player_info = [player_addr, set(), self.server_time, 0]
+            player_info = Connection(player_addr, self.server_time)
             self.id_map[self.player_id] = player_info
             update = (self.player_id, player_name)
         else:
-            update = (self.addr_to_id[player_addr], player_name)
+            # A reconnecting client restarts its input sequence and leaderboard
+            player_id = self.addr_to_id[player_addr]
+            self.id_map[player_id].input_sequence = 0
+            self.id_map[player_id].leaders_version = -1
+            self.id_map[player_id].known_metadata = set()
+            update = (player_id, player_name)
         self.player_add_queue.append(update)
 
-    def _update_commands(self, player_inputs, player_addr):
-        player_inputs = source.network.decode_inputs(player_inputs)
+    def _update_commands(self, input_history, player_addr):
+        """Posts the newest input sample that has not been received before.
+
+        Each message repeats the client's most recent input samples, so
+        that inputs lost in transit are recovered by the messages that
+        follow. Since a player only acts on its newest inputs, any older
+        unseen samples are coalesced into it.
+        """
+        input_history = source.network.decode_input_history(input_history)
         if player_addr in self.addr_to_id:
             player_id = self.addr_to_id[player_addr]
-            update = (player_id, player_inputs)
-            self.player_input_queue.append(update)
+            connection = self.id_map[player_id]
+            unseen = [(sequence, player_inputs) for sequence, player_inputs
+                    in input_history if sequence > connection.input_sequence]
+            if unseen:
+                connection.input_sequence, player_inputs = unseen[0]
+                self.coalesced_inputs += len(unseen) - 1
+                self._post_inputs(player_id, player_inputs)
         else:
-            self._disconnect_player(cfg.NOT_CONNECTED_MESSAGE, player_addr)
+            self._reject_address(player_addr)
+
+    def _post_inputs(self, player_id, player_inputs):
+        """Replaces any inputs of the player that have yet to be applied"""
+        with self.input_lock:
+            if player_id in self.player_inputs:
+                self.coalesced_inputs += 1
+            self.player_inputs[player_id] = player_inputs
 
-    def _update_ping(self, prev_server_pulse, player_addr):
+    def _update_ping(self, data, player_addr):
+        prev_server_pulse, leaders_version = data
         if player_addr in self.addr_to_id:
             player_id = self.addr_to_id[player_addr]
+            connection = self.id_map[player_id]
             # Only keep most recent round-trip-time
-            if prev_server_pulse > self.id_map[player_id][2]:
-                self.id_map[player_id][2] = prev_server_pulse
-                self.id_map[player_id][3] = time.time() - prev_server_pulse
+            if prev_server_pulse > connection.heartbeat:
+                connection.heartbeat = prev_server_pulse
+                connection.ping = time.time() - prev_server_pulse
+                connection.leaders_version = leaders_version
         else:
-            self._disconnect_player(cfg.NOT_CONNECTED_MESSAGE, player_addr)
+            self._reject_address(player_addr)
+
+    def _update_metadata_requests(self, player_ids, player_addr):
+        """Queues the metadata that the client lacks to be sent again"""
+        assert(len(player_ids) <= cfg.METADATA_CACHE_SIZE)
+        assert(all(isinstance(player_id, int) for player_id in player_ids))
+        if player_addr in self.addr_to_id:
+            connection = self.id_map[self.addr_to_id[player_addr]]
+            connection.metadata_requests.append(player_ids)
+        else:
+            self._reject_address(player_addr)
 
     def _update_acks(self, packet_id, player_addr):
         self.ack_reception_queue.append((packet_id, player_addr))
@@ -267,6 +656,13 @@ class Server:
     def _remove_player(self, player_id):
         self.player_remove_queue.append(player_id)
 
+    def _reject_address(self, player_addr):
+        """Tells a client that is not connected as much"""
+        # The network process answers clients that are not routed to any
+        # server, while those in the middle of a hand over are ignored
+        if not self.network_link:
+            self._disconnect_player(cfg.NOT_CONNECTED_MESSAGE, player_addr)
+
     def _connect_player(self, player_update, player_addr):
         self._send_message(cfg.CONNECT_CODE, player_update, player_addr)
 
@@ -3,81 +3,14 @@
 import collections
 import math
 import random
+import time
 import pygame as pg
 import source.config as cfg
-from source.entities import Player, Orb
+from source.entities import Player, generate_orb
+from source.containers import CellContainer, Leaderboard
 from source.animation import GameWindow
 from server.server import Server
-
-
-class CellContainer:
-    """Provides a container that stores items in a cell grid.
-
-    This type of container is useful for extracting neighboring items from
-    the local environments of items without iterating through the entire
-    collection of items. Note that each item may occupy several cells.
-
-    Attributes:
-        item_count: Tracks the number of items stored in the container.
-    """
-    def __init__(self, map_size):
-        """Initializes the container with a map size defined by map_size.
-        
-        The cell grid expands to fill in the entire map.
-        """
-        self.cell_width, self.cell_height = cfg.MAP_CELL_SIZE
-        self.item_count = 0
-        self.cells = []
-        map_width, map_height = map_size
-        for _ in range(map_height//self.cell_height + 1):
-            new_row = [set() for _ in range(map_width//self.cell_width + 1)]
-            self.cells.append(new_row)
-
-    def __iter__(self):
-        for row in self.cells:
-            for cell in row:
-                yield from cell
-
-    def find_cell(self, x, y):
-        row, col = int(y/self.cell_height), int(x/self.cell_width)
-        return (max(0, min(len(self.cells)-1, row)),
-                max(0, min(len(self.cells[0])-1, col)))
-
-    def add(self, item):
-        top, left = item.y - item.radius, item.x - item.radius
-        top_row, left_col = self.find_cell(left, top)
-        bot, right = item.y + item.radius, item.x + item.radius
-        bot_row, right_col = self.find_cell(right, bot)
-        self.item_count += 1
-        for row in range(top_row,bot_row+1):
-            for col in range(left_col,right_col+1):
-                cell = self.cells[row][col]
-                cell.add(item)
-
-    def remove(self, item):
-        top, left = item.y - item.radius, item.x - item.radius
-        top_row, left_col = self.find_cell(left, top)
-        bot, right = item.y + item.radius, item.x + item.radius
-        bot_row, right_col = self.find_cell(right, bot)
-        self.item_count -= 1
-        for row in range(top_row,bot_row+1):
-            for col in range(left_col,right_col+1):
-                cell = self.cells[row][col]
-                cell.discard(item)
-
-    def get_neighbours(self, item, x_range, y_range):
-        neighbours = set()
-        row, col = self.find_cell(item.x, item.y)
-        delta_x = int(x_range/self.cell_width)*cfg.FOV_MARGIN
-        delta_y = int(y_range/self.cell_height)*cfg.FOV_MARGIN
-        top, left = item.y - y_range, item.x - x_range
-        top_row, left_col = self.find_cell(left, top)
-        bot, right = item.y + y_range, item.x + x_range
-        bot_row, right_col = self.find_cell(right, bot)
-        for row in range(top_row,bot_row+1):
-            for col in range(left_col,right_col+1):
-                neighbours |= self.cells[row][col]
-        return neighbours
+from server.view_pool import ViewPool
 
 
 class ServerGame:
@@ -89,19 +22,45 @@ class ServerGame:
     client interactions. The game state consists of a collection of
     players and orbs at different coordinates within a game map.
     """
-    def __init__(self, player_limit, bot_count, target_orb_count, map_size):
+    def __init__(self, player_limit, bot_count, target_orb_count, map_size,
+            orb_seed=None, headless=False, network_link=None, port=None,
+            server=None):
+        """Initializes the game along with its server.
+
+        Args:
+            orb_seed: Seeds the orb field, which is random if None.
+            headless: Whether the game runs without a window.
+            network_link: A NetworkLink through which the server communicates,
+                see Server.
+            port: The port of the server, cfg.NETWORK_PORT if None.
+            server: The Server of the game, which is created from map_size,
+                the orb seed, network_link, and port if None.
+        """
         self.player_limit = player_limit
         self.target_orb_count = target_orb_count
         self.map_size = map_size
         self.bot_id = 0
-        self.server = Server(map_size)
+        self.orb_seed = random.getrandbits(32) if orb_seed is None else orb_seed
+        self.server = server
+        if server is None:
+            self.server = Server(map_size, self.orb_seed, network_link, port)
+        self.load = 0  # Smoothed share of the time spent in main_loop
+        self.replicator = None  # Streams the game to a standby, see server.standby
+        self.recorder = None  # Logs the session for replays, see server.replay
+        self.view_pool = None
+        if cfg.VIEW_WORKERS:
+            self.view_pool = ViewPool(cfg.VIEW_WORKERS, map_size, self.orb_seed)
         self.id_to_player = {}
-        self.leaders = []
+        self.leaderboard = Leaderboard(cfg.LEADERBOARD_SIZE)
         self.players = CellContainer(map_size)
         self.orbs = CellContainer(map_size)
         self.orb_id = 0
+        self.orb_spawn_limit = float('Inf')  # Most orbs replenished per frame
+        self.orb_additions, self.orb_removals = [], []  # Since the last frame
         self.server_observer = self._get_server_observer()
-        self.window = GameWindow(self.server_observer, "NetBlob - Server", map_size)
+        self.window = None
+        if not headless:
+            self.window = GameWindow(self.server_observer, "NetBlob - Server", map_size)
         self.observers = collections.deque([self.server_observer])
         self._generate_bots(bot_count)
         self.run = False
@@ -114,11 +73,11 @@ class ServerGame:
         return observer
 
     def _generate_bots(self, bot_count):
-        while self.bot_id > -bot_count:
-            self.bot_id -= 1
+        for _ in range(bot_count):
+            bot_id = self._next_bot_id()
             bot = Player(
-                cfg.BOT_NAMES[self.bot_id%len(cfg.BOT_NAMES)],
-                self.bot_id, self.map_size)
+                cfg.BOT_NAMES[bot_id%len(cfg.BOT_NAMES)],
+                bot_id, self.map_size)
             self._update_bot_inputs(bot)
             bot.radius = random.randint(cfg.START_RADIUS, cfg.MAX_RADIUS//3)
             bot.scale = math.pow(bot.radius/cfg.START_RADIUS, cfg.VIEW_GROWTH_RATE)
@@ -135,39 +94,62 @@ class ServerGame:
             -map_y-bias_y, map_y-bias_y)
 
     def _handle_bot_death(self, bot):
+        bot.id = self._next_bot_id()
+
+    def _next_bot_id(self):
+        """Bots are given negative ids to tell them apart from players"""
         self.bot_id -= 1
-        bot.id = self.bot_id
+        return self.bot_id
 
     def start(self):
         if not self.run:
-            self.run = True
             self.server.start()
+            self.run = True
 
     def stop(self):
         self.run = False
         self.server.stop()
+        if self.view_pool:
+            self.view_pool.stop()
+        if self.recorder:
+            self.recorder.close()
 
     def is_running(self):
         return self.run
 
     def main_loop(self, time_delta):
         """Main function that maintains and updates the game state"""
-        for player in self.id_to_player.values():
-            self.players.remove(player)
-            player.move(self.map_size, time_delta)
-            self.players.add(player)
-
+        start_time = time.perf_counter()
+        self._move_players(time_delta)
         self._handle_player_collisions()
         self._handle_orb_collisions()
-        if self.server.needs_sync():
+        synced = self.server.needs_sync()
+        if synced:
             self._sync_server_players()
             for player in self.id_to_player.values():
                 if player.id < 0 and random.randrange(15) == 0:
                     self._update_bot_inputs(player)
-        self._update_display(time_delta, self.id_to_player.values(), self.orbs)
-
-        for event in pg.event.get():
-            self._handle_event(event)
+        if self.window:
+            self._update_display(time_delta, self.players, self.orbs)
+            for event in pg.event.get():
+                self._handle_event(event)
+        if self.replicator:
+            self.replicator.replicate(self)
+        # Cleared every frame, as headless games such as shards and rooms
+        # have no display to consume the changes
+        self.orb_additions, self.orb_removals = [], []
+        duration = time.perf_counter() - start_time
+        if self.recorder:
+            self.recorder.record_tick(time_delta, synced, duration, self.orb_id)
+        cost = duration/max(time_delta, 1/cfg.SERVER_GAME_REFRESH_RATE)
+        self.load += cfg.LOAD_SMOOTHING*(cost - self.load)
+        self.server.report_load(self.player_limit, self.load)
+
+    def _move_players(self, time_delta):
+        for player in self.id_to_player.values():
+            self.players.remove(player)
+            player.move(self.map_size, time_delta)
+            self.players.add(player)
 
     def _handle_event(self, event):
         if event.type == pg.QUIT:
@@ -196,28 +178,40 @@ class ServerGame:
 
     def _handle_player_collisions(self):
         """Checks for player collisions and handles those collision"""
-        for player in self.id_to_player.values():
+        # Eaten players are given new ids, so the ids cannot be iterated over
+        for player in list(self.id_to_player.values()):
             neighbours = self.players.get_neighbours(
                 player, player.radius, player.radius)
-            for other_player in neighbours:
+            # Sets are ordered by object address, which differs between
+            # processes, so the eater is picked in order of id for replays
+            for other_player in sorted(neighbours, key=lambda other: other.id):
                 if other_player == player: continue
                 if player.radius >= other_player.radius: continue
+                # Only players simulated by this game may eat others
+                if other_player.id not in self.id_to_player: continue
                 dist = player.find_distance(other_player)
                 margin = player.radius*cfg.COLLISION_MARGIN
                 if dist < other_player.radius - margin:
                     other_player.eat(player)
-                    self._reset_player(player)
-                    self.players.remove(player)
-                    self._give_spawn_location(player)
-                    self.players.add(player)
-                    self.id_to_player.pop(player.id)
-                    if player.id > 0:
-                        self.server.sync_player_death(player)
-                    else:
-                        self._handle_bot_death(player)
-                    self.id_to_player[player.id] = player
+                    self.leaderboard.promote(other_player)
+                    self._kill_player(player)
                     break
 
+    def _kill_player(self, player):
+        """Respawns an eaten player under a new id"""
+        self.players.remove(player)
+        self._reset_player(player)
+        self._give_spawn_location(player)
+        self.players.add(player)
+        self.id_to_player.pop(player.id)
+        if player.id > 0:
+            self.server.sync_player_death(player)
+            if self.recorder:
+                self.recorder.record_respawn(player.id)
+        else:
+            self._handle_bot_death(player)
+        self.id_to_player[player.id] = player
+
     def _reset_player(self, player):
         player.color_idx = random.randrange(
             len(cfg.PLAYER_PALETTE))
@@ -225,32 +219,54 @@ class ServerGame:
         player.scale = math.pow(
             player.radius/cfg.START_RADIUS,
             cfg.VIEW_GROWTH_RATE)
+        self.leaderboard.demote(player)
 
     def _handle_orb_collisions(self):
         for player in self.id_to_player.values():
             neighbours = self.orbs.get_neighbours(
                 player, player.radius, player.radius)
             removed = []
-            for orb in neighbours:
+            for orb in sorted(neighbours, key=lambda orb: orb.id):
                 dist = player.find_distance(orb)
                 margin = orb.radius*cfg.COLLISION_MARGIN
                 if dist < player.radius - margin:
-                    player.eat(orb)
                     removed.append(orb)
-            for orb in removed:
-                self.orbs.remove(orb)
+            self._remove_orbs(removed)
+            if removed:
+                player.eat_all(removed)
+                self.leaderboard.promote(player)
             if removed and player.id < 0:
                 if random.randrange(3) == 0:
                     self._update_bot_inputs(player)
         self._replenish_orbs()
 
     def _replenish_orbs(self):
-        """Replenishes the orb population up to the target number of orbs"""
-        while self.orbs.item_count < self.target_orb_count:
+        """Replenishes the orb population up to the target number of orbs.
+
+        Orbs are generated from their ids, and ids of orbs that would spawn
+        inside a player are skipped. At most orb_spawn_limit orbs are added,
+        such that an empty map may be filled over several frames.
+        """
+        spawn_count = min(self.orb_spawn_limit, self.target_orb_count - self.orbs.item_count)
+        while spawn_count > 0:
             self.orb_id += 1
-            new_orb = Orb(orb_id = self.orb_id)
-            self._give_spawn_location(new_orb)
-            self.orbs.add(new_orb)
+            new_orb = generate_orb(self.orb_seed, self.orb_id, self.map_size)
+            if not self._is_clear(new_orb): continue
+            self._add_orb(new_orb)
+            spawn_count -= 1
+
+    def _add_orb(self, orb):
+        self.orbs.add(orb)
+        self.orb_additions.append(orb)
+        if self.view_pool:
+            self.view_pool.add_orbs([orb])
+
+    def _remove_orbs(self, orbs):
+        for orb in orbs:
+            self.orbs.remove(orb)
+        self.orb_removals.extend(orbs)
+        if orbs and self.view_pool:
+            self.view_pool.remove_orbs(orbs)
 
     def _give_spawn_location(self, obj):
         """Yields a spawn location outside the body of any other player"""
@@ -258,11 +274,15 @@ class ServerGame:
         field_width, field_height = self.map_size
         while True:
             obj.x, obj.y = random.randrange(field_width), random.randrange(field_height)
-            row, col = self.players.find_cell(obj.x, obj.y)
-            cell = self.players.cells[row][col]
-            if all(player.find_distance(obj) > player.radius for player in cell):
+            if self._is_clear(obj):
                 break
 
+    def _is_clear(self, obj):
+        """Determines whether the location of obj is outside every player"""
+        row, col = self.players.find_cell(obj.x, obj.y)
+        cell = self.players.cells[row][col]
+        return all(player.find_distance(obj) > player.radius for player in cell)
+
     def _get_item_views(self):
         player_views, orb_views = [], []
         for player in self.id_to_player.values():
@@ -273,7 +293,7 @@ class ServerGame:
                 player, x_range, y_range)
             orb_neighbours = self.orbs.get_neighbours(
                 player, x_range, y_range)
-            player_views.append((player.id, player_neighbours))
+            player_views.append((player, player_neighbours))
             orb_views.append((player.id, orb_neighbours))
         return player_views, orb_views
 
@@ -281,19 +301,27 @@ class ServerGame:
         self._give_spawn_location(new_player)
         self.id_to_player[new_player.id] = new_player
         self.players.add(new_player)
+        self.leaderboard.add(new_player)
         self.observers.append(new_player)
 
     def _sync_server_players(self):
         """f"""
-        player_views, orb_views = self._get_item_views()
-        self.server.sync_state(self.leaders, player_views, orb_views)
+        if self.view_pool:
+            self.server.sync_pooled_state(
+                self.leaderboard, self.id_to_player, self.view_pool)
+        else:
+            player_views, orb_views = self._get_item_views()
+            self.server.sync_state(self.leaderboard, player_views, orb_views)
 
         player_remove_queue = self.server.get_player_removals()
         while player_remove_queue:
             player_id = player_remove_queue.popleft()
+            if self.recorder:
+                self.recorder.record_leave(player_id)
             if player_id in self.id_to_player:
                 self.observers.remove(self.id_to_player[player_id])
                 self.players.remove(self.id_to_player[player_id])
+                self.leaderboard.remove(self.id_to_player[player_id])
                 del self.id_to_player[player_id]
                 self.server.drop_player_connection(
                     player_id, cfg.PLAYER_DISCONNECTED_MESSAGE)
@@ -301,6 +329,8 @@ class ServerGame:
         player_add_queue = self.server.get_player_additions()
         while player_add_queue:
             player_id, player_name = player_add_queue.popleft()
+            if self.recorder:
+                self.recorder.record_join(player_id, player_name)
             if player_id in self.id_to_player:
                 player = self.id_to_player[player_id]
                 self.server.approve_player_connection(player_id, player)
@@ -312,9 +342,10 @@ class ServerGame:
                 self.server.drop_player_connection(
                     player_id, cfg.SERVER_FULL_MESSAGE)
 
-        player_input_queue = self.server.get_player_inputs()
-        while player_input_queue:
-            player_id, player_inputs = player_input_queue.popleft()
+        player_inputs = self.server.get_player_inputs()
+        if self.recorder:
+            self.recorder.record_inputs(player_inputs)
+        for player_id, player_inputs in player_inputs.items():
             if player_id in self.id_to_player:
                 self.id_to_player[player_id].inputs = player_inputs
 
@@ -324,25 +355,30 @@ class ServerGame:
         if self.window.observer != self.observers[0]:
             self.window.set_observer(self.observers[0])
 
-        sort_players = sorted(players, key=lambda x: x.radius)
+        visible_area = self.window.get_visible_area()
+        sort_players = sorted(players.get_area(*visible_area), key=lambda x: x.radius)
         # Draw each player/orb/tracker
-        for orb in orbs:
-            self.window.draw_orb(orb)
+        if self.window.observer == self.server_observer and self.window.is_steady():
+            # The whole map is in view, so orbs are kept on a layer of their own
+            self.window.draw_orb_layer(orbs, self.orb_additions, self.orb_removals)
+        else:
+            self.window.release_orb_layer()
+            for orb in orbs.get_area(*visible_area):
+                self.window.draw_orb(orb)
         for player in sort_players:
             self.window.draw_player(player)
 
-        self._draw_scoreboard(sort_players)
+        self._draw_scoreboard()
         self._draw_statistics(time_delta)
-        pg.display.flip()
+        self.window.update_display()
 
-    def _draw_scoreboard(self, sort_players):
+    def _draw_scoreboard(self):
         """d"""
         # Sets the text position within the window in pixels
         top_left_x, top_left_y, delta_y = self.window.width-205, 15, 30
         for i, text in enumerate(cfg.SCOREBOARD_TEXTS):
             self.window.draw_text(text, top_left_x + 5, top_left_y + 5 + delta_y*i)
-        self.leaders = sort_players[-5:]
-        for i, player in enumerate(reversed(self.leaders)):
+        for i, player in enumerate(self.leaderboard.leaders):
             self.window.draw_text(player.scoreboard_surface, top_left_x + 30, 50 + delta_y*i)
 
     def _draw_statistics(self, time_delta):
@@ -351,10 +387,19 @@ class ServerGame:
         for i, text in enumerate(cfg.SERVER_STATISTICS_TEXTS):
             self.window.draw_text(text, top_left_x + 5, top_left_y + 5 + delta_y*i)
         texts = []
-        bandwidth, = self.server.get_connection_statistics()
+        bandwidth, dropped_packets, coalesced_inputs, compression, send_rates = \
+            self.server.get_connection_statistics()
+        payload_load, sent_load, cpu_load = (
+            sum(load[i] for load in compression.values()) for i in range(3))
         texts.append(str(len(self.id_to_player)))
         texts.append(str(int(1/(time_delta+0.001))))
         texts.append(str(int(bandwidth/100)/10) + " KB/S")
+        texts.append(str(dropped_packets))
+        texts.append(str(coalesced_inputs))
+        texts.append(str(int(100*sent_load/max(1, payload_load))) + "% "
+            + str(int(cpu_load*10000)/10) + " ms/s")
+        send_rate, congested_count = send_rates
+        texts.append(str(int(send_rate)) + " Hz, " + str(congested_count) + " slowed")
         # Sets the text position within the window in pixels
         for i, text in enumerate(texts):
             if i not in self.window.statistics_texts or self.window.statistics_texts[i][0] != text:
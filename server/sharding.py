@@ -0,0 +1,329 @@
+"""Provides a server whose map is split among several processes.
+
+The map is split into vertical strips of whole cells, see cfg.MAP_CELL_SIZE,
+each of which is simulated by a ShardGame in a process of its own. Players
+and orbs near the edge of a strip are mirrored to the neighbouring shard as
+ghosts, which its players can see and eat. Players that cross into another
+strip are handed over to its shard along with their connection. All shards
+share a single network process as their front door, which routes the
+packets of each client to the shard that currently has its player.
+"""
+
+import bisect
+import multiprocessing as mp
+import random
+import pygame as pg
+import source.config as cfg
+from source.entities import Player, generate_orb
+from server.network_process import NetworkLink, NetworkProcess
+from server.server_game import ServerGame
+
+
+class ShardLayout:
+    """Splits a map into strips of whole cells, one for each shard."""
+    def __init__(self, map_size, shard_count):
+        cell_width = cfg.MAP_CELL_SIZE[0]
+        column_count = map_size[0]//cell_width + 1
+        assert(1 <= shard_count <= column_count)
+        self.shard_count = shard_count
+        self.edges = [idx*column_count//shard_count*cell_width
+            for idx in range(shard_count)] + [map_size[0]]
+
+    def get_bounds(self, shard_idx):
+        """Returns the left and right edge of the strip of the shard"""
+        return self.edges[shard_idx], self.edges[shard_idx + 1]
+
+    def find_shard(self, x):
+        shard_idx = bisect.bisect_right(self.edges, x) - 1
+        return max(0, min(self.shard_count - 1, shard_idx))
+
+
+class ShardMessage:
+    """Holds what a shard tells a neighbouring shard each frame.
+
+    Players are described by the tuples of get_player_state, and orbs by
+    their ids.
+    """
+    def __init__(self):
+        self.ghosts = []  # Players near the edge, replacing the previous ones
+        self.orb_additions, self.orb_removals = [], []  # Orbs near the edge
+        self.eaten_orbs, self.eaten_players = [], []  # Ghosts that were eaten
+        self.handovers = []  # Pairs of players and connections, or None for bots
+
+
+def get_player_state(player):
+    return (player.id, player.name, player.color_idx, player.x, player.y,
+        player.radius, player.scale, player.inputs.x, player.inputs.y)
+
+def set_player_state(player, state):
+    _, _, player.color_idx, player.x, player.y, player.radius, \
+        player.scale, player.inputs.x, player.inputs.y = state
+
+
+class ShardGame(ServerGame):
+    """Simulates one strip of a map that is shared with other shards.
+
+    Players are only moved, and may only eat, within the shard that has
+    them. Collisions with ghosts are therefore decided by the shard of the
+    eater, which tells the shard of the ghost that it was eaten.
+    """
+    def __init__(self, layout, shard_idx, neighbour_pipes, player_limit,
+            bot_count, target_orb_count, map_size, orb_seed, network_link):
+        """Initializes the shard.
+
+        Args:
+            layout: The ShardLayout of the map.
+            shard_idx: The index of the strip of the shard within layout.
+            neighbour_pipes: Maps the indices of neighbouring shards to the
+                pipes through which they are reached.
+            target_orb_count: The nr of orbs within the whole map.
+        """
+        self.layout = layout
+        self.shard_idx = shard_idx
+        self.bounds = layout.get_bounds(shard_idx)
+        self.neighbour_pipes = neighbour_pipes
+        self.outboxes = {idx: ShardMessage() for idx in neighbour_pipes}
+        self.ghosts = {}  # Maps the ids of ghost players to them and their shard
+        self.ghost_orbs = {}  # Maps the ids of ghost orbs to them and their shard
+        self.own_orbs = {}  # Maps the ids of the orbs of this shard to them
+        left, right = self.bounds
+        super().__init__(player_limit, bot_count,
+            target_orb_count*(right - left)//map_size[0], map_size,
+            orb_seed=orb_seed, headless=True, network_link=network_link)
+        # Interleaves the ids handed out by each shard
+        self.server.player_id = self.server.packet_id = shard_idx
+        self.server.id_step = layout.shard_count
+
+    def main_loop(self, time_delta):
+        self._receive_shard_messages()
+        super().main_loop(time_delta)
+        self._hand_over_players()
+        self._send_shard_messages()
+
+    def _next_bot_id(self):
+        self.bot_id -= 1
+        return self.bot_id*self.layout.shard_count - self.shard_idx
+
+    def _give_spawn_location(self, obj):
+        """Yields a spawn location within the strip outside every player"""
+        left, right = self.bounds
+        while True:
+            obj.x = random.randrange(left, right)
+            obj.y = random.randrange(self.map_size[1])
+            if self._is_clear(obj):
+                break
+
+    def _replenish_orbs(self):
+        """Replenishes the orbs of the strip, see ServerGame._replenish_orbs.
+
+        Every shard goes through the same orb ids, but only keeps the orbs
+        within its strip, such that orb ids are unique across shards.
+        """
+        while len(self.own_orbs) < self.target_orb_count:
+            self.orb_id += 1
+            new_orb = generate_orb(self.orb_seed, self.orb_id, self.map_size)
+            if self.layout.find_shard(new_orb.x) != self.shard_idx: continue
+            if not self._is_clear(new_orb): continue
+            self._add_orb(new_orb)
+
+    def _add_orb(self, orb):
+        super()._add_orb(orb)
+        self.own_orbs[orb.id] = orb
+        for shard_idx in self._find_ghost_shards(orb):
+            self.outboxes[shard_idx].orb_additions.append(orb.id)
+
+    def _remove_orbs(self, orbs):
+        own_orbs = []
+        for orb in orbs:
+            if orb.id in self.ghost_orbs:
+                self.orbs.remove(orb)
+                _, shard_idx = self.ghost_orbs.pop(orb.id)
+                self.outboxes[shard_idx].eaten_orbs.append(orb.id)
+            else:
+                own_orbs.append(orb)
+                del self.own_orbs[orb.id]
+                for shard_idx in self._find_ghost_shards(orb):
+                    self.outboxes[shard_idx].orb_removals.append(orb.id)
+        super()._remove_orbs(own_orbs)
+
+    def _handle_player_collisions(self):
+        super()._handle_player_collisions()
+        for ghost, shard_idx in list(self.ghosts.values()):
+            neighbours = self.players.get_neighbours(
+                ghost, ghost.radius, ghost.radius)
+            for player in sorted(neighbours, key=lambda player: player.id):
+                if player.id not in self.id_to_player: continue
+                if ghost.radius >= player.radius: continue
+                dist = ghost.find_distance(player)
+                margin = ghost.radius*cfg.COLLISION_MARGIN
+                if dist < player.radius - margin:
+                    player.eat(ghost)
+                    self.leaderboard.promote(player)
+                    self._remove_ghost(ghost.id)
+                    self.outboxes[shard_idx].eaten_players.append(ghost.id)
+                    break
+
+    def _find_ghost_shards(self, entity):
+        """Returns the neighbouring shards that should see the entity"""
+        left, right = self.bounds
+        shard_indices = []
+        if entity.x < left + cfg.SHARD_GHOST_MARGIN and self.shard_idx > 0:
+            shard_indices.append(self.shard_idx - 1)
+        if entity.x >= right - cfg.SHARD_GHOST_MARGIN and \
+                self.shard_idx < self.layout.shard_count - 1:
+            shard_indices.append(self.shard_idx + 1)
+        return shard_indices
+
+    def _find_orb(self, orb):
+        """Returns the orb of this shard that has the same id, if any"""
+        if orb.id in self.own_orbs:
+            return self.own_orbs[orb.id]
+        if orb.id in self.ghost_orbs:
+            return self.ghost_orbs[orb.id][0]
+        return orb
+
+    def _remove_ghost(self, player_id):
+        ghost, _ = self.ghosts.pop(player_id)
+        self.players.remove(ghost)
+
+    def _hand_over_players(self):
+        """Hands the players that have left the strip to the next shard over"""
+        for player in list(self.id_to_player.values()):
+            shard_idx = self.layout.find_shard(player.x)
+            if shard_idx == self.shard_idx: continue
+            shard_idx = self.shard_idx + (1 if shard_idx > self.shard_idx else -1)
+            connection = None
+            if player.id in self.server.id_map:
+                connection = self.server.release_connection(player.id)
+            self.observers.remove(player)
+            self.players.remove(player)
+            self.leaderboard.remove(player)
+            del self.id_to_player[player.id]
+            self.outboxes[shard_idx].handovers.append(
+                (get_player_state(player), connection))
+
+    def _send_shard_messages(self):
+        for shard_idx, pipe in self.neighbour_pipes.items():
+            message = self.outboxes[shard_idx]
+            message.ghosts = [get_player_state(player)
+                for player in self.id_to_player.values()
+                if shard_idx in self._find_ghost_shards(player)]
+            pipe.send(message)
+            self.outboxes[shard_idx] = ShardMessage()
+
+    def _receive_shard_messages(self):
+        for shard_idx, pipe in self.neighbour_pipes.items():
+            while pipe.poll():
+                self._apply_shard_message(shard_idx, pipe.recv())
+
+    def _apply_shard_message(self, shard_idx, message):
+        ghost_ids = set()
+        for state in message.ghosts:
+            player_id, player_name = state[:2]
+            if player_id in self.id_to_player: continue
+            ghost_ids.add(player_id)
+            if player_id in self.ghosts:
+                ghost, _ = self.ghosts[player_id]
+                self.players.remove(ghost)
+            else:
+                ghost = Player(player_name, player_id)
+                self.ghosts[player_id] = (ghost, shard_idx)
+            set_player_state(ghost, state)
+            self.players.add(ghost)
+        for player_id, (_, ghost_shard_idx) in list(self.ghosts.items()):
+            if ghost_shard_idx == shard_idx and player_id not in ghost_ids:
+                self._remove_ghost(player_id)
+
+        for orb_id in message.orb_additions:
+            orb = generate_orb(self.orb_seed, orb_id, self.map_size)
+            self.ghost_orbs[orb_id] = (orb, shard_idx)
+            self.orbs.add(orb)
+        for orb_id in message.orb_removals:
+            if orb_id in self.ghost_orbs:
+                orb, _ = self.ghost_orbs.pop(orb_id)
+                self.orbs.remove(orb)
+        self._remove_orbs([self.own_orbs[orb_id]
+            for orb_id in message.eaten_orbs if orb_id in self.own_orbs])
+        for player_id in message.eaten_players:
+            if player_id in self.id_to_player:
+                self._kill_player(self.id_to_player[player_id])
+
+        for state, connection in message.handovers:
+            player_id, player_name = state[:2]
+            if player_id in self.ghosts:
+                self._remove_ghost(player_id)
+            player = Player(player_name, player_id)
+            set_player_state(player, state)
+            self.id_to_player[player_id] = player
+            self.players.add(player)
+            self.leaderboard.add(player)
+            self.observers.append(player)
+            if connection:
+                connection.orb_view = {self._find_orb(orb)
+                    for orb in connection.orb_view}
+                self.server.adopt_connection(player_id, connection)
+
+
+class ShardedServer:
+    """Runs a game whose map is split among shard_count processes.
+
+    The shards share a network process, which clients connect to as if it
+    were a single server.
+    """
+    def __init__(self, shard_count, player_limit, bot_count,
+            target_orb_count, map_size):
+        self.layout = ShardLayout(map_size, shard_count)
+        orb_seed = random.getrandbits(32)
+        self.network_process = NetworkProcess(cfg.NETWORK_PORT, shard_count)
+        context = mp.get_context('spawn')
+        self.stop_event = context.Event()
+        # Pipes between each shard and the shard to its right
+        pipes = [context.Pipe() for _ in range(shard_count - 1)]
+        self.processes = []
+        for shard_idx in range(shard_count):
+            neighbour_pipes = {}
+            if shard_idx > 0:
+                neighbour_pipes[shard_idx - 1] = pipes[shard_idx - 1][1]
+            if shard_idx < shard_count - 1:
+                neighbour_pipes[shard_idx + 1] = pipes[shard_idx][0]
+            shard_bot_count = bot_count//shard_count + (shard_idx < bot_count%shard_count)
+            self.processes.append(context.Process(target=run_shard, daemon=True,
+                args=(self.layout, shard_idx, neighbour_pipes,
+                    self.network_process.links[shard_idx].get_names(),
+                    player_limit, shard_bot_count, target_orb_count,
+                    map_size, orb_seed, self.stop_event)))
+
+    def start(self):
+        self.network_process.start()
+        for process in self.processes:
+            process.start()
+        print("[SERVER] Sharded server started with", len(self.processes),
+            "shards on port:", str(cfg.NETWORK_PORT))
+
+    def stop(self):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self.network_process.stop()
+
+    def is_running(self):
+        return all(process.is_alive() for process in self.processes)
+
+
+def run_shard(layout, shard_idx, neighbour_pipes, link_names, player_limit,
+        bot_count, target_orb_count, map_size, orb_seed, stop_event):
+    """Runs a ShardGame until stop_event is set"""
+    # The shards already run in parallel, and ghosts are unknown to ViewPool
+    cfg.VIEW_WORKERS = 0
+    network_link = NetworkLink.attach(link_names)
+    game = ShardGame(layout, shard_idx, neighbour_pipes, player_limit,
+        bot_count, target_orb_count, map_size, orb_seed, network_link)
+    game.start()
+    clock = pg.time.Clock()
+    while game.is_running() and not stop_event.is_set():
+        time_delta = clock.tick(cfg.SERVER_GAME_REFRESH_RATE)/1000
+        game.main_loop(time_delta)
+    game.stop()
+    network_link.close()
@@ -0,0 +1,260 @@
+"""Provides hot standby replication of a server game.
+
+A Replicator streams the state of the primary game to a Standby in another
+process every frame, as a compact delta: the players in the fixed size
+records of server.view_pool, the names of players new to the standby, the
+ids of orbs spawned and eaten, the id counters, the client addresses when
+they change, and the reliable packets sent since the last frame. The
+standby keeps a warm, unstarted copy of the game from these. Once the
+primary fails, the standby binds the port of the primary and carries on
+serving its clients, which keep their connections.
+
+The reliable packets of the last cfg.STANDBY_RESEND_WINDOW are sent again
+on taking over, since the primary may not have delivered them, and the
+orb views of clients are rebuilt from the orb updates among them. The
+primary never waits on the standby: the deltas are sent from a queue by
+a helper thread, and a standby too slow to keep up is dropped.
+"""
+
+import collections
+import queue
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+import source.config as cfg
+import source.network
+from source.containers import Leaderboard
+from source.entities import Player, generate_orb
+from server.server import Connection
+from server.server_game import ServerGame
+from server.view_pool import SNAPSHOT_PLAYER
+
+
+class StandbySender(threading.Thread):
+    """Connects to the standby at address, and sends it the queued messages.
+
+    Runs until it is sent None or the connection fails, in which case
+    failure holds the exception. Up to cfg.STANDBY_QUEUE_LENGTH messages are
+    queued, such that whoever queues them never waits on the standby.
+    """
+    def __init__(self, address):
+        super().__init__(daemon=True)
+        self.address = address
+        self.messages = queue.Queue(cfg.STANDBY_QUEUE_LENGTH)
+        self.connection = None
+        self.failure = None
+        self.lock = threading.Lock()  # Guards the closing of the connection
+
+    def run(self):
+        try:
+            self.connection = Client(self.address, authkey=cfg.STANDBY_AUTHKEY)
+            message = self.messages.get()
+            while message is not None:
+                self.connection.send(message)
+                message = self.messages.get()
+        except OSError as exc:
+            self.failure = exc
+        with self.lock:
+            if self.connection: self.connection.close()
+
+    def abort(self):
+        """Shuts down the connection, even while a send waits on the standby"""
+        with self.lock:
+            if self.connection is None or self.connection.closed: return
+            sock = socket.socket(fileno=self.connection.fileno())
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            finally:
+                sock.detach()
+
+
+class Replicator:
+    """Streams the state of a game to the standby at address.
+
+    The standby is connected to lazily, and reconnected to every
+    cfg.STANDBY_RETRY_INTERVAL until it accepts. The deltas are sent by a
+    StandbySender, and a standby that falls a full queue behind is dropped.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.sender = None
+        self.last_attempt_time = 0
+        self.player_ids = set()  # Players whose names the standby knows
+        self.addresses = {}  # Client addresses and player ids as last sent
+        self.replication_time = 0  # Seconds spent replicating in total
+
+    def replicate(self, game):
+        """Queues the changes to the game since the last frame"""
+        if self.sender and not self.sender.is_alive():
+            self._drop_standby(game, self.sender.failure)
+        orb_additions, orb_removals = game.orb_additions, game.orb_removals
+        if self.sender is None:
+            if not self._connect(game): return
+            # The standby is sent every orb as it connects
+            orb_additions, orb_removals = [], []
+        start_time = time.perf_counter()
+        server = game.server
+        players = game.id_to_player.values()
+        new_players = {player.id: (player.name, player.color_idx)
+            for player in players if player.id not in self.player_ids}
+        self.player_ids = set(game.id_to_player)
+        snapshot = b''.join(SNAPSHOT_PLAYER.pack(player.id, player.x, player.y,
+                player.radius, player.scale, player.inputs.x, player.inputs.y)
+            for player in players)
+        addresses = None
+        if server.addr_to_id != self.addresses:
+            addresses = self.addresses = dict(server.addr_to_id)
+        counters = (server.player_id, server.packet_id, game.orb_id,
+            game.bot_id, game.leaderboard.version)
+        delta = (counters, new_players, snapshot,
+            [orb.id for orb in orb_additions],
+            [orb.id for orb in orb_removals],
+            addresses, server.reliable_log)
+        server.reliable_log = []
+        try:
+            self.sender.messages.put_nowait(delta)
+        except queue.Full:
+            self._drop_standby(game, "the standby fell behind")
+        self.replication_time += time.perf_counter() - start_time
+
+    def _connect(self, game):
+        curr_time = time.time()
+        if curr_time - self.last_attempt_time < cfg.STANDBY_RETRY_INTERVAL:
+            return False
+        self.last_attempt_time = curr_time
+        orb_views = {connection.addr: [orb.id for orb in connection.orb_view]
+            for connection in game.server.id_map.values()}
+        self.sender = StandbySender(self.address)
+        self.sender.messages.put((game.player_limit, game.target_orb_count,
+            game.map_size, game.orb_seed, game.server.port,
+            {orb.id for orb in game.orbs}, orb_views))
+        self.sender.start()
+        self.player_ids, self.addresses = set(), {}
+        game.server.reliable_log = []
+        return True
+
+    def _drop_standby(self, game, reason):
+        # A standby that never accepted is retried without notice
+        if self.sender.connection is not None:
+            print("[SERVER] Replication to standby failed for reasons:", reason)
+        self.sender.abort()
+        self.sender = None
+        game.server.reliable_log = None
+
+
+class Standby:
+    """Mirrors a primary game streamed by a Replicator, see take_over."""
+    def __init__(self, address):
+        self.listener = Listener(address, authkey=cfg.STANDBY_AUTHKEY)
+        self.game = None
+        self.orbs = {}  # Maps orb ids to the orbs of the game
+        self.addresses = {}  # Maps client addresses to their player ids
+        self.orb_views = {}  # Maps client addresses to the orb ids they know
+        self.leaders_version = 0
+        self.recent_packets = collections.deque()  # Reliable packets and their receive times
+
+    def mirror(self):
+        """Mirrors the first primary to connect until it fails or goes silent"""
+        connection = self.listener.accept()
+        self.listener.close()
+        self._create_game(*connection.recv())
+        while connection.poll(cfg.STANDBY_TIMEOUT):
+            try:
+                delta = connection.recv()
+            except (EOFError, OSError):
+                break
+            self._apply(delta)
+        connection.close()
+
+    def take_over(self):
+        """Starts the mirrored game once the port of the primary is free.
+
+        Returns the game, along with the seconds taken to start it.
+        """
+        start_time = time.time()
+        game, server = self.game, self.game.server
+        for addr, player_id in self.addresses.items():
+            connection = Connection(addr, start_time)
+            connection.orb_view = {self.orbs.get(orb_id) or
+                    generate_orb(game.orb_seed, orb_id, game.map_size)
+                for orb_id in self.orb_views.get(addr, ())}
+            server.adopt_connection(player_id, connection)
+        game.leaderboard = Leaderboard(cfg.LEADERBOARD_SIZE)
+        game.leaderboard.version = self.leaders_version + 1
+        for player in game.id_to_player.values():
+            game.leaderboard.add(player)
+
+        while True:
+            try:
+                game.start()
+                break
+            except OSError:
+                # The port is freed once the primary process has exited
+                if time.time() - start_time > cfg.TIMEOUT_LIMIT: raise
+                time.sleep(0.01)
+        for _, (addr, packet_id, code, updates) in self.recent_packets:
+            server.resend_reliably(addr, packet_id, code, updates)
+        return game, time.time() - start_time
+
+    def _create_game(self, player_limit, target_orb_count, map_size, orb_seed,
+            port, orb_ids, orb_views):
+        self.game = ServerGame(player_limit, 0, target_orb_count, map_size,
+            orb_seed, headless=True, port=port)
+        for orb_id in orb_ids:
+            self._add_orb(orb_id)
+        self.orb_views = {addr: set(orb_ids) for addr, orb_ids in orb_views.items()}
+
+    def _apply(self, delta):
+        counters, new_players, snapshot, orb_additions, orb_removals, \
+            addresses, reliable_packets = delta
+        game = self.game
+        game.server.player_id, game.server.packet_id, game.orb_id, \
+            game.bot_id, self.leaders_version = counters
+
+        states = {state[0]: state for state in SNAPSHOT_PLAYER.iter_unpack(snapshot)}
+        for player_id in [player_id for player_id in game.id_to_player
+                if player_id not in states]:
+            player = game.id_to_player.pop(player_id)
+            game.players.remove(player)
+            game.observers.remove(player)
+        for player_id, x, y, radius, scale, inputs_x, inputs_y in states.values():
+            if player_id in game.id_to_player:
+                player = game.id_to_player[player_id]
+                game.players.remove(player)
+            else:
+                player_name, color_idx = new_players[player_id]
+                player = game.id_to_player[player_id] = Player(player_name, player_id)
+                player.color_idx = color_idx
+                game.observers.append(player)
+            player.x, player.y, player.radius, player.scale = x, y, radius, scale
+            player.inputs.x, player.inputs.y = inputs_x, inputs_y
+            game.players.add(player)
+
+        for orb_id in orb_additions:
+            self._add_orb(orb_id)
+        for orb_id in orb_removals:
+            game.orbs.remove(self.orbs.pop(orb_id))
+
+        if addresses is not None:
+            self.addresses = addresses
+            self.orb_views = {addr: self.orb_views.get(addr, set()) for addr in addresses}
+        curr_time = time.time()
+        for packet in reliable_packets:
+            addr, _, code, updates = packet
+            if code == cfg.UPD_ORBS_CODE and addr in self.orb_views:
+                additions, removals = updates
+                orb_view = self.orb_views[addr]
+                orb_view.update(source.network.decode_orb_ids(additions))
+                orb_view.difference_update(source.network.decode_orb_ids(removals))
+            self.recent_packets.append((curr_time, packet))
+        while self.recent_packets and \
+                curr_time - self.recent_packets[0][0] > cfg.STANDBY_RESEND_WINDOW:
+            self.recent_packets.popleft()
+
+    def _add_orb(self, orb_id):
+        orb = generate_orb(self.game.orb_seed, orb_id, self.game.map_size)
+        self.orbs[orb_id] = orb
+        self.game.orbs.add(orb)
@@ -0,0 +1,189 @@
+"""Provides a pool of processes that compute the views of clients.
+
+Computing what each client sees, and encoding it, is independent across
+clients, so the work is split across worker processes. Each worker serves
+a fixed slice of the clients, such that it can keep their view state
+between syncs. Every sync, the players are written to a snapshot in shared
+memory which the workers read from, while the orbs are passed as the ids
+added and removed since the previous sync. Workers rebuild the orbs from
+their ids, see generate_orb.
+"""
+
+import math
+import multiprocessing as mp
+import struct
+import time
+from multiprocessing import shared_memory
+import source.config as cfg
+import source.network
+from source.containers import CellContainer
+from source.entities import UserInputs, generate_orb
+from server.server import prioritize_players
+
+SNAPSHOT_PLAYER = struct.Struct('<iffffii')  # id, x, y, radius, scale, inputs
+
+
+class ViewState:
+    """Stores the state that a worker keeps for each client it serves."""
+    def __init__(self):
+        self.orb_view = set()
+        self.player_priorities = {}
+        self.update_budget = cfg.PLAYER_UPDATE_BUDGET
+        self.last_task_time = 0
+
+
+class SnapshotPlayer:
+    """Holds the attributes of a player that are read from a snapshot."""
+    def __init__(self, player_id, x, y, radius, scale, mouse_x, mouse_y):
+        self.id = player_id
+        self.x, self.y = x, y
+        self.radius = radius
+        self.scale = scale
+        self.inputs = UserInputs((mouse_x, mouse_y))
+
+    def find_distance(self, entity):
+        dx, dy = (self.x-entity.x), (self.y-entity.y)
+        return math.sqrt(dx*dx + dy*dy)
+
+
+class ViewPool:
+    """Computes the views of clients with a pool of worker processes.
+
+    The orbs of the game must be reported through add_orbs and remove_orbs
+    as they come and go. The views are then computed by compute_views.
+    """
+    def __init__(self, worker_count, map_size, orb_seed):
+        self.orb_additions, self.orb_removals = [], []
+        self.snapshot = None
+        self.pipes, self.processes = [], []
+        context = mp.get_context('spawn')
+        for _ in range(worker_count):
+            pipe, worker_pipe = context.Pipe()
+            process = context.Process(target=run_view_worker, daemon=True,
+                args=(worker_pipe, map_size, orb_seed))
+            process.start()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+
+    def stop(self):
+        for pipe in self.pipes:
+            pipe.send(None)
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        if self.snapshot:
+            self.snapshot.close()
+            self.snapshot.unlink()
+
+    def add_orbs(self, orbs):
+        self.orb_additions.extend(orb.id for orb in orbs)
+
+    def remove_orbs(self, orbs):
+        self.orb_removals.extend(orb.id for orb in orbs)
+
+    def compute_views(self, players, view_tasks):
+        """Computes the views of the clients given by view_tasks.
+
+        Args:
+            players: Every player in the game.
+            view_tasks: A list of (view_key, player_id, update_budget) tuples,
+                where view_key identifies the client over its lifetime.
+
+        Returns:
+            A list of (player_id, view_ids, player_ids, player_list,
+            orb_updates) tuples. view_ids and player_list are the encoded
+            players in view, player_ids lists the ids of those players, and
+            orb_updates holds the encoded orb ids that entered and left the
+            view, or None if there were none.
+        """
+        self._write_snapshot(players)
+        orb_updates = (self.orb_additions, self.orb_removals)
+        self.orb_additions, self.orb_removals = [], []
+        worker_tasks = [[] for _ in self.pipes]
+        for view_task in view_tasks:
+            worker_tasks[view_task[0] % len(self.pipes)].append(view_task)
+        for pipe, tasks in zip(self.pipes, worker_tasks):
+            pipe.send((self.snapshot.name, orb_updates, tasks))
+        views = []
+        for pipe in self.pipes:
+            views.extend(pipe.recv())
+        return views
+
+    def _write_snapshot(self, players):
+        data = b''.join(SNAPSHOT_PLAYER.pack(player.id, player.x, player.y,
+                player.radius, player.scale, player.inputs.x, player.inputs.y)
+            for player in players)
+        size = 4 + len(data)
+        if self.snapshot is None or self.snapshot.size < size:
+            if self.snapshot:
+                self.snapshot.close()
+                self.snapshot.unlink()
+            # Leaves room for the player count to grow
+            self.snapshot = shared_memory.SharedMemory(create=True, size=2*size)
+        struct.pack_into('<I', self.snapshot.buf, 0, len(data)//SNAPSHOT_PLAYER.size)
+        self.snapshot.buf[4:size] = data
+
+
+def run_view_worker(pipe, map_size, orb_seed):
+    """Computes the views of the clients it is given until told to stop"""
+    orbs, orb_container = {}, CellContainer(map_size)
+    view_states = {}  # Maps view keys to the state of the client
+    snapshot = None
+    while True:
+        task = pipe.recv()
+        if task is None: break
+        snapshot_name, (orb_additions, orb_removals), view_tasks = task
+        for orb_id in orb_additions:
+            orbs[orb_id] = generate_orb(orb_seed, orb_id, map_size)
+            orb_container.add(orbs[orb_id])
+        for orb_id in orb_removals:
+            orb_container.remove(orbs.pop(orb_id))
+
+        if snapshot is None or snapshot.name != snapshot_name:
+            if snapshot: snapshot.close()
+            snapshot = shared_memory.SharedMemory(name=snapshot_name)
+        player_count, = struct.unpack_from('<I', snapshot.buf)
+        players = {}
+        player_container = CellContainer(map_size)
+        for player_state in SNAPSHOT_PLAYER.iter_unpack(
+                snapshot.buf[4:4 + player_count*SNAPSHOT_PLAYER.size]):
+            player = SnapshotPlayer(*player_state)
+            players[player.id] = player
+            player_container.add(player)
+
+        curr_time = time.time()
+        views = []
+        for view_key, player_id, update_budget in view_tasks:
+            if view_key not in view_states:
+                view_states[view_key] = ViewState()
+            view_state = view_states[view_key]
+            view_state.update_budget = update_budget
+            view_state.last_task_time = curr_time
+
+            viewer = players[player_id]
+            x_range = (viewer.scale*cfg.BASE_WIDTH/2)
+            y_range = (viewer.scale*cfg.BASE_HEIGHT/2)
+            player_view = player_container.get_neighbours(viewer, x_range, y_range)
+            orb_view = orb_container.get_neighbours(viewer, x_range, y_range)
+            orb_additions = orb_view - view_state.orb_view
+            orb_removals = view_state.orb_view - orb_view
+            view_state.orb_view = orb_view
+            orb_updates = None
+            if orb_additions or orb_removals:
+                orb_updates = (source.network.encode_orb_ids(orb_additions),
+                    source.network.encode_orb_ids(orb_removals))
+
+            player_ids = [player.id for player in player_view]
+            origin = source.network.get_origin(viewer.x, viewer.y)
+            player_list = source.network.encode_players(
+                prioritize_players(view_state, viewer, player_view), origin)
+            views.append((player_id, source.network.encode_ids(player_ids),
+                player_ids, player_list, orb_updates))
+
+        # Forgets clients that have not been served for a while
+        view_states = {view_key: view_state
+            for view_key, view_state in view_states.items()
+            if curr_time - view_state.last_task_time < cfg.TIMEOUT_LIMIT}
+        pipe.send(views)
+    if snapshot: snapshot.close()
@@ -1,5 +1,6 @@
 """Barebones animation module. Provides an interface for the game display."""
 
+import collections
 import os
 import math
 import random
@@ -21,6 +22,20 @@ class GameWindow:
         self.observer_x = self.observer.x - self.width//2
         self.observer_y = self.observer.y - self.height//2
         self.drawings = []
+        self.updated_rects = []  # Regions changed since the display was last updated
+        self.full_update = True
+        self.backgrounds = collections.OrderedDict()
+        self.background = None
+        self.background_offset = (0, 0)
+        self.grid_rect = pg.Rect(0, 0, 0, 0)
+        self.grid_lines = []
+        self.orb_layer = None
+        self.orb_layer_view = None
+        self.points = []  # Small entities queued to be drawn as pixels
+        self.mapped_colors = {}
+        self.sprites = collections.OrderedDict()
+        self.sprite_bytes = 0  # Memory used by the cached sprites
+        self.sprite_ratio = self.ratio
         self.scoreboard_texts = {}
         self.statistics_texts = {}
         self._transition()
@@ -35,20 +50,84 @@ class GameWindow:
     def set_size(self, window_size):
         self.width, self.height = window_size
         self.window = self._get_window(window_size)
+        self.full_update = True
 
     def set_observer(self, observer):
         self.observer = observer
         self._transition()
 
     def clear(self, time_delta):
-        while self.drawings:
-            x, y, (width, height) = self.drawings.pop()
-            surface = pg.Rect(x-2, y-2, width+4, height+4)
-            pg.draw.rect(self.window, cfg.WHITE, surface)
+        """Restores the background over last frame's drawings and moves the camera.
+
+        The background is a cached grid layer, so erasing a drawing is a
+        single blit from that layer. After a small camera shift only the
+        old and new grid lines are restored, while larger shifts and zoom
+        changes redraw the entire background.
+        """
+        prev_x, prev_y = self.observer_x, self.observer_y
         self._update(time_delta)
+        self.background, tile_width, tile_height = self._get_background()
+        self.background_offset = self._get_background_offset(tile_width, tile_height)
+        self.grid_rect = self._get_grid_rect()
+
+        camera_shift = abs(self.observer_x - prev_x) + abs(self.observer_y - prev_y)
+        if camera_shift > cfg.DIRTY_RECT_CAMERA_THRESHOLD:
+            self.full_update = True
+        regions = []
+        if camera_shift and not self.full_update:
+            regions.extend(self.grid_lines)
+        self.grid_lines = self._get_grid_lines(tile_width, tile_height)
+        if camera_shift and not self.full_update:
+            regions.extend(self.grid_lines)
+        if len(regions) + len(self.drawings) > cfg.DIRTY_RECT_LIMIT:
+            # The display would be updated in full anyway
+            self.full_update = True
+
+        if self.full_update:
+            self.drawings.clear()
+            self._restore(self.window.get_rect())
+        else:
+            while self.drawings:
+                x, y, (width, height) = self.drawings.pop()
+                regions.append(pg.Rect(x-2, y-2, width+4, height+4))
+            for rect in regions:
+                self._restore(rect)
+            self.updated_rects.extend(regions)
+        self._draw_grid_border()
+
+    def update_display(self):
+        """Applies the changes made to the window since the last update.
+
+        In dirty-rect rendering mode only the regions that were cleared or
+        drawn are updated. A full update is made whenever the camera has
+        moved far, the zoom level has changed, or too many regions changed.
+        """
+        self._flush_points()
+        if self.full_update or not cfg.DIRTY_RECT_RENDERING:
+            pg.display.flip()
+        else:
+            for x, y, (width, height) in self.drawings:
+                self.updated_rects.append(pg.Rect(x-2, y-2, width+4, height+4))
+            if len(self.updated_rects) > cfg.DIRTY_RECT_LIMIT:
+                pg.display.flip()
+            else:
+                pg.display.update(self._merge_rects(self.updated_rects))
+        self.updated_rects = []
+        self.full_update = False
+
+    def _merge_rects(self, rects):
+        """Merges overlapping rects, such that no two returned rects overlap"""
+        merged = []
+        for rect in rects:
+            idx = rect.collidelist(merged)
+            while idx != -1:
+                rect = rect.union(merged.pop(idx))
+                idx = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
 
     def _update(self, time_delta):
-        self._draw_grid(cfg.WHITE)
+        prev_ratio = self.ratio
         observer_ratio = 1/self.observer.scale
         if self.transition_speed:
             self.ratio -= time_delta*self.transition_speed*cfg.VIEW_SCALE_RATE
@@ -56,26 +135,166 @@ class GameWindow:
                 or self.transition_speed < 0 and self.ratio > observer_ratio):
                 self.transition_speed = 0
                 self.ratio = observer_ratio
+                if self.ratio != self.sprite_ratio:
+                    # Sprites drawn at the previous zoom level are unlikely to be reused
+                    self.sprites.clear()
+                    self.sprite_bytes = 0
+                    self.sprite_ratio = self.ratio
         elif abs(self.ratio - observer_ratio) > 0.05*observer_ratio:
             self._transition()
         self.observer_x = int(self.observer.x*self.ratio - self.width/2)
         self.observer_y = int(self.observer.y*self.ratio - self.height/2)
-        self._draw_grid(cfg.LIGHT_GRAY)
+        if self.ratio != prev_ratio:
+            self.full_update = True
 
     def _transition(self):
         self.transition_speed = self.ratio - 1/self.observer.scale
 
-    def _draw_grid(self, color):
-        for i in range(self.map_size[0]//cfg.MAP_CELL_SIZE[0] + 2):
-            x, y = i*cfg.MAP_CELL_SIZE[0], i*cfg.MAP_CELL_SIZE[1]
-            x, _, thickness = self._adjust_values(x, 0, 0)
-            _, y, thickness = self._adjust_values(0, y, 0)
-            if 0 <= x < self.width:
-                pg.draw.line(self.window, color, (x,0), (x, self.height))
-            if 0 <= y < self.height and i <= self.map_size[1]//cfg.MAP_CELL_SIZE[1] + 1:
-                pg.draw.line(self.window, color, (0,y), (self.width, y))
+    def _get_background(self):
+        """Returns the grid layer for the current zoom level and window size.
+
+        The layer is a periodic grid pattern one cell larger than the
+        window in each direction, so that any camera position is covered
+        by blitting from an offset into it. Layers are cached, evicting
+        the least recently used once cfg.BACKGROUND_CACHE_BYTES is exceeded.
+        """
+        tile_width = max(2, round(cfg.MAP_CELL_SIZE[0]*self.ratio))
+        tile_height = max(2, round(cfg.MAP_CELL_SIZE[1]*self.ratio))
+        key = (tile_width, tile_height, self.width, self.height)
+        if key in self.backgrounds:
+            self.backgrounds.move_to_end(key)
+            return self.backgrounds[key], tile_width, tile_height
+
+        width, height = self.width + tile_width, self.height + tile_height
+        background = pg.Surface((width, height)).convert()
+        background.fill(cfg.WHITE)
+        for x in range(0, width, tile_width):
+            pg.draw.line(background, cfg.LIGHT_GRAY, (x, 0), (x, height))
+        for y in range(0, height, tile_height):
+            pg.draw.line(background, cfg.LIGHT_GRAY, (0, y), (width, y))
+        self.backgrounds[key] = background
+        cache_bytes = sum(
+            b.get_bytesize()*b.get_width()*b.get_height() for b in self.backgrounds.values())
+        while cache_bytes > cfg.BACKGROUND_CACHE_BYTES and len(self.backgrounds) > 1:
+            _, evicted = self.backgrounds.popitem(last=False)
+            cache_bytes -= evicted.get_bytesize()*evicted.get_width()*evicted.get_height()
+        return background, tile_width, tile_height
+
+    def _get_background_offset(self, tile_width, tile_height):
+        """Aligns the grid layer with the first grid line within the window"""
+        cell_width = cfg.MAP_CELL_SIZE[0]*self.ratio
+        cell_height = cfg.MAP_CELL_SIZE[1]*self.ratio
+        first_x = int(math.floor(self.observer_x/cell_width)*cell_width)
+        first_y = int(math.floor(self.observer_y/cell_height)*cell_height)
+        return ((self.observer_x - first_x) % tile_width,
+                (self.observer_y - first_y) % tile_height)
+
+    def _get_grid_rect(self):
+        """Returns the region of the window covered by the map grid"""
+        left, top, _ = self._adjust_values(0, 0, 0)
+        right, bottom, _ = self._adjust_values(
+            (self.map_size[0]//cfg.MAP_CELL_SIZE[0] + 1)*cfg.MAP_CELL_SIZE[0],
+            (self.map_size[1]//cfg.MAP_CELL_SIZE[1] + 1)*cfg.MAP_CELL_SIZE[1], 0)
+        return pg.Rect(left, top, right - left + 1, bottom - top + 1)
+
+    def _get_grid_lines(self, tile_width, tile_height):
+        """Returns the regions covered by the grid lines within the window"""
+        offset_x, offset_y = self.background_offset
+        lines = []
+        for x in range(-offset_x % tile_width, self.width, tile_width):
+            lines.append(pg.Rect(x, 0, 1, self.height))
+        for y in range(-offset_y % tile_height, self.height, tile_height):
+            lines.append(pg.Rect(0, y, self.width, 1))
+        lines.append(pg.Rect(self.grid_rect.right-1, 0, 1, self.height))
+        lines.append(pg.Rect(0, self.grid_rect.bottom-1, self.width, 1))
+        return lines
+
+    def _restore(self, rect):
+        """Restores the background, including any orb layer, within the rect"""
+        if self.orb_layer and self.orb_layer_view == self._get_view():
+            self.window.blit(self.orb_layer, rect, rect)
+        else:
+            self._restore_background(self.window, rect)
+
+    def _restore_background(self, surface, rect):
+        surface.fill(cfg.WHITE, rect)
+        grid_part = rect.clip(self.grid_rect)
+        if grid_part:
+            area = grid_part.move(self.background_offset)
+            surface.blit(self.background, grid_part, area)
+
+    def _draw_grid_border(self, surface = None):
+        """Closes the grid along the right and bottom edges of the map"""
+        surface = surface or self.window
+        left, top = self.grid_rect.topleft
+        right, bottom = self.grid_rect.right-1, self.grid_rect.bottom-1
+        pg.draw.line(surface, cfg.LIGHT_GRAY, (right, top), (right, bottom))
+        pg.draw.line(surface, cfg.LIGHT_GRAY, (left, bottom), (right, bottom))
+
+    def _get_view(self):
+        return (self.ratio, self.observer_x, self.observer_y, self.width, self.height)
+
+    def is_steady(self):
+        """Returns whether the zoom level is not in transition"""
+        return not self.transition_speed
+
+    def draw_orb_layer(self, orbs, orb_additions, orb_removals):
+        """Draws the orbs through a persistent layer beneath all other drawings.
+
+        The layer holds the background along with every orb in view and is
+        kept up to date with the orbs added and removed since the previous
+        frame, so that a steady view costs only as much as its changes.
+        The layer is rebuilt whenever the view changes.
+
+        Args:
+            orbs: The CellContainer holding every orb.
+            orb_additions: The orbs added since the previous call.
+            orb_removals: The orbs removed since the previous call.
+        """
+        if not self.orb_layer or self.orb_layer_view != self._get_view():
+            self.orb_layer_view = self._get_view()
+            self.orb_layer = pg.Surface((self.width, self.height)).convert()
+            layer_rect = self.orb_layer.get_rect()
+            self._restore_background(self.orb_layer, layer_rect)
+            self._draw_grid_border(self.orb_layer)
+            for orb in orbs.get_area(*self.get_visible_area()):
+                self._draw_orb_on(self.orb_layer, orb)
+            self._flush_points()
+            self.window.blit(self.orb_layer, (0, 0))
+            self.full_update = True
+            return
+
+        changed_rects = []
+        for orb in orb_additions:
+            rect = self._draw_orb_on(self.orb_layer, orb)
+            if rect: changed_rects.append(rect)
+        # Orbs drawn as points are only written once flushed
+        self._flush_points()
+        for orb in orb_removals:
+            x, y, radius = self._adjust_values(orb.x, orb.y, orb.radius)
+            rect = pg.Rect(x-radius-1, y-radius-1, 2*radius+3, 2*radius+3)
+            rect = rect.clip(self.orb_layer.get_rect())
+            if not rect: continue
+            self.orb_layer.set_clip(rect)
+            self._restore_background(self.orb_layer, rect)
+            self._draw_grid_border(self.orb_layer)
+            left, top = (self.observer_x + rect.x)/self.ratio, (self.observer_y + rect.y)/self.ratio
+            right, bottom = left + rect.width/self.ratio, top + rect.height/self.ratio
+            for other_orb in orbs.get_area(left, top, right, bottom):
+                self._draw_orb_on(self.orb_layer, other_orb)
+            self._flush_points()
+            self.orb_layer.set_clip(None)
+            changed_rects.append(rect)
+        for rect in changed_rects:
+            self.window.blit(self.orb_layer, rect, rect)
+        self.updated_rects.extend(changed_rects)
+
+    def release_orb_layer(self):
+        self.orb_layer = None
+        self.orb_layer_view = None
 
     def draw_text(self, text_surface, x, y, right_align = False):
+        self._flush_points()
         if right_align:
             self.drawings.append((self.width - x, y, text_surface.get_size()))
             self.window.blit(text_surface, (self.width - x, y))
@@ -84,30 +303,87 @@ class GameWindow:
             self.window.blit(text_surface, (x, y))
 
     def draw_player(self, player):
+        """Draws the player, with less detail the smaller it appears.
+
+        Players smaller than cfg.LOD_POINT_RADIUS pixels are drawn as points,
+        while those smaller than cfg.LOD_DETAIL_RADIUS are drawn without a
+        border or name.
+        """
         x, y, radius = self._adjust_values(player.x, player.y, player.radius)
-        if x < -radius or y < -radius or x > self.width + radius or y > self.width + radius: return
+        if x < -radius or y < -radius or x > self.width + radius or y > self.height + radius: return
+        radius = self._quantize_radius(radius)
         self.drawings.append((x-radius, y-radius, (2*radius,2*radius)))
+        body_color = cfg.PLAYER_PALETTE[player.color_idx]
+        if radius < cfg.LOD_POINT_RADIUS:
+            self._draw_point(self.window, x, y, radius, body_color)
+            return
+        self._flush_points()
+        if radius < cfg.LOD_DETAIL_RADIUS:
+            self.window.blit(self._get_sprite(radius, body_color), (x-radius, y-radius))
+            return
+
         sub_radius = max(0, radius - min(cfg.BORDER_SIZE, int(0.08*radius)+2))
         border_color = cfg.BORDER_PALETTE[player.color_idx]
-        body_color = cfg.PLAYER_PALETTE[player.color_idx]
-        self.draw_filled_circle(x, y, radius, border_color)
-        self.draw_filled_circle(x, y, sub_radius, body_color)
+        sprite = self._get_sprite(radius, border_color, sub_radius, body_color)
+        self.window.blit(sprite, (x-radius, y-radius))
 
         text_width, text_height = player.name_surface.get_size()
         self.draw_text(player.name_surface, x-text_width//2, y-text_height//2)
     
     def draw_tracker(self, tracker):
         if not tracker.active: return
+        self._flush_points()
         x, y, radius = self._adjust_values(tracker.x, tracker.y, tracker.radius)
         self.drawings.append((x-radius, y-radius, (2*radius,2*radius)))
         self.draw_circle(x, y, radius, tracker.color)
 
     def draw_orb(self, orb):
+        rect = self._draw_orb_on(self.window, orb)
+        if rect: self.drawings.append((rect.x, rect.y, rect.size))
+
+    def _draw_orb_on(self, surface, orb):
+        """Draws the orb onto the surface and returns the region it covers"""
         x, y, radius = self._adjust_values(orb.x, orb.y, orb.radius)
-        if x < -radius or y < -radius or x > self.width + radius or y > self.width + radius: return
-        self.drawings.append((x-radius, y-radius, (2*radius,2*radius)))
+        if x < -radius or y < -radius or x > self.width + radius or y > self.height + radius: return None
         body_color = cfg.ORB_PALETTE[orb.color_idx]
-        self.draw_filled_circle(x, y, radius, body_color)
+        if radius < cfg.LOD_POINT_RADIUS:
+            return self._draw_point(surface, x, y, radius, body_color)
+        sprite = self._get_sprite(radius, body_color)
+        return surface.blit(sprite, (x-radius, y-radius))
+
+    def _draw_point(self, surface, x, y, radius, color):
+        """Queues a small entity to be drawn as a square of pixels.
+
+        Queued points are written in one batch per surface by _flush_points,
+        which must be called before anything else is drawn on top of them.
+        """
+        self.points.append((surface, x, y, radius, color))
+        return pg.Rect(x-radius, y-radius, 2*radius+1, 2*radius+1)
+
+    def _flush_points(self):
+        if not self.points: return
+        pixel_arrays = {}
+        for surface, x, y, radius, color in self.points:
+            if surface not in pixel_arrays:
+                pixel_arrays[surface] = pg.PixelArray(surface)
+            pixels = pixel_arrays[surface]
+            if color not in self.mapped_colors:
+                self.mapped_colors[color] = surface.map_rgb(color)
+            if radius == 0:
+                if 0 <= x < pixels.shape[0] and 0 <= y < pixels.shape[1]:
+                    pixels[x, y] = self.mapped_colors[color]
+            else:
+                pixels[max(0, x-radius):x+radius+1, max(0, y-radius):y+radius+1] = \
+                    self.mapped_colors[color]
+        for pixels in pixel_arrays.values():
+            pixels.close()
+        self.points = []
+
+    def get_visible_area(self):
+        """Returns the map area covered by the window as left, top, right, bottom"""
+        left, top = self.observer_x/self.ratio, self.observer_y/self.ratio
+        return (left, top,
+                left + self.width/self.ratio, top + self.height/self.ratio)
 
     def _adjust_values(self, x, y, radius):
         adjusted_x = int(x*self.ratio) - self.observer_x
@@ -115,6 +391,41 @@ class GameWindow:
         adjusted_radius = int(radius*self.ratio)
         return adjusted_x, adjusted_y, adjusted_radius
 
+    def _quantize_radius(self, radius):
+        """Rounds large radii in pixels to a step of cfg.SPRITE_RADIUS_STEP.
+
+        Players grow continuously, so their exact radii would each need a
+        sprite of their own. The rounding is too small to be noticed at
+        radii beyond cfg.SPRITE_EXACT_RADIUS.
+        """
+        if radius <= cfg.SPRITE_EXACT_RADIUS: return radius
+        step = cfg.SPRITE_RADIUS_STEP
+        return (radius + step//2)//step*step
+
+    def _get_sprite(self, radius, color, inner_radius = 0, inner_color = None):
+        """Returns a pre-rendered circle, optionally with an inner circle.
+
+        Sprites are keyed by their radius in pixels, which already reflects
+        the zoom level, and their colors. The least recently used sprites are
+        evicted once the cache exceeds cfg.SPRITE_CACHE_BYTES.
+        """
+        key = (radius, color, inner_radius, inner_color)
+        if key in self.sprites:
+            self.sprites.move_to_end(key)
+            return self.sprites[key]
+        sprite = pg.Surface((2*radius+1, 2*radius+1), pg.SRCALPHA)
+        gdraw.aacircle(sprite, radius, radius, radius, color)
+        gdraw.filled_circle(sprite, radius, radius, radius, color)
+        if inner_color:
+            gdraw.aacircle(sprite, radius, radius, inner_radius, inner_color)
+            gdraw.filled_circle(sprite, radius, radius, inner_radius, inner_color)
+        self.sprites[key] = sprite
+        self.sprite_bytes += sprite.get_bytesize()*sprite.get_width()*sprite.get_height()
+        while self.sprite_bytes > cfg.SPRITE_CACHE_BYTES and len(self.sprites) > 1:
+            _, evicted = self.sprites.popitem(last=False)
+            self.sprite_bytes -= evicted.get_bytesize()*evicted.get_width()*evicted.get_height()
+        return sprite
+
     def draw_filled_circle(self, x, y, radius, color):
         gdraw.aacircle(self.window, x, y, radius, color)
         gdraw.filled_circle(self.window, x, y, radius, color)
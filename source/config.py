@@ -38,11 +38,13 @@ MENU_WINDOW_SIZE = (1024,720)
 DEFAULT_WINDOW_SIZE = (1366,768)
 
 TEXT_SPACING = 30
+LEADERBOARD_SIZE = 5  # Nr of players shown on the scoreboard
 SCOREBOARD_TEXTS = [SCORE_FONT.render("Scoreboard", 1, (0,0,0))]
-for i in range(1,6):
+for i in range(1,LEADERBOARD_SIZE+1):
     SCOREBOARD_TEXTS.append(SCORE_FONT.render(str(i) + ". ", 1, (0,0,0)))
 
-texts = ["Players: ", "Frame Rate: ", "Data Usage: "]
+texts = ["Players: ", "Frame Rate: ", "Data Usage: ", "Dropped: ", "Coalesced: ", "Compressed: ",
+         "Send Rate: "]
 SERVER_STATISTICS_TEXTS = []
 for i, text in enumerate(texts):
     SERVER_STATISTICS_TEXTS.append(SCORE_FONT.render(text, 1, (0,0,0)))
@@ -74,6 +76,16 @@ MAX_RADIUS = 1500
 BOT_NAMES = ["Google", "Apple", "Facebook", "Amazon", "Microsoft", "Twitter", "Netflix", "Uber"]
 BOT_INPUT_UPDATE_INTERVAL = 2
 
+SPRITE_CACHE_BYTES = 32*1024*1024  # Memory available to the pre-rendered circles of each game window
+SPRITE_EXACT_RADIUS = 32  # Sprites of larger radii in pixels are shared by nearby radii
+SPRITE_RADIUS_STEP = 4  # Step in pixels between the shared radii of large sprites
+DIRTY_RECT_RENDERING = True  # Update only the changed regions of the display
+DIRTY_RECT_CAMERA_THRESHOLD = 40  # Camera shift in pixels that forces a full update
+DIRTY_RECT_LIMIT = 400  # Nr of changed regions that forces a full update
+BACKGROUND_CACHE_BYTES = 48*1024*1024  # Memory available to cached grid layers
+LOD_POINT_RADIUS = 2  # Entities with a smaller radius in pixels are drawn as points
+LOD_DETAIL_RADIUS = 15  # Players with a smaller radius in pixels lack borders and names
+
 CLIENT_GAME_REFRESH_RATE = 0  # 0 means unlimited
 MENU_REFRESH_RATE = 30
 SERVER_GAME_REFRESH_RATE = 50
@@ -98,6 +110,22 @@ CLIENT_SYNC_INTERVAL = 1/60
 ACK_INTERVAL = 1/10
 PLAYER_LIMIT = 100
 CONNECTION_PROBE_INTERVAL = 0.2
+INPUT_HISTORY_LENGTH = 6  # Nr of recent input samples repeated in each inputs message
+PACKET_RATE_LIMIT = 200  # Packets accepted per second from each address
+PACKET_BURST_LIMIT = 100  # Packets accepted in a burst from each address
+METADATA_CACHE_SIZE = 1024  # Nr of player names and colors remembered per client
+METADATA_REQUEST_INTERVAL = 0.5  # Min time in seconds between requests for the same player
+COMPRESSION_THRESHOLD = 256  # Messages larger than this in bytes are compressed, None disables
+COMPRESSION_LEVEL = 6  # zlib level, from 1 (fastest) to 9 (smallest)
+PLAYER_UPDATE_BUDGET = 1400  # Bytes of player updates sent to each client per sync
+PRIORITY_NEAR_FRACTION = 1/4  # Players this close relative to the view range are updated every sync
+PRIORITY_MOTION_DISTANCE = 100  # Players that moved this far since their last update are updated
+CONGESTION_ADJUST_INTERVAL = 0.5  # Seconds between adjustments of the send rate of each client
+CONGESTION_MAX_INTERVAL = 0.4  # Longest interval in seconds between syncs of a congested client
+CONGESTION_MIN_BUDGET = 280  # Smallest player update budget in bytes of a congested client
+CONGESTION_LOSS_LIMIT = 0.1  # Share of reliable packets retransmitted that signals congestion
+CONGESTION_RTT_MARGIN = 0.1  # Rise in seconds of the round trip time that signals congestion
+CONGESTION_BASELINE_DRIFT = 0.01  # Rise in seconds of the baseline round trip time per adjustment
 
 CONNECT_CODE = 1
 INPUTS_CODE = 2
@@ -107,9 +135,37 @@ ACK_CODE = 5
 PING_CODE = 6
 DEATH_CODE = 7
 DISCONNECT_CODE = 8
+METADATA_CODE = 9
+METADATA_REQUEST_CODE = 10
+REDIRECT_CODE = 11
+LOAD_REPORT_CODE = 12
 
 PLAYER_DISCONNECTED_MESSAGE = "Player Disconnected."
 NOT_CONNECTED_MESSAGE = "Server Connection Interrupted."
 SERVER_FULL_MESSAGE = "Server is full. Try again later."
 
 NETWORK_PORT = 5562
+NETWORK_PROCESS = False  # Run the socket I/O of the server in a separate process
+NETWORK_RING_SIZE = 1 << 22  # Bytes of shared memory for messages in each direction
+VIEW_WORKERS = 0  # Processes that compute the views of clients, 0 computes them in the game loop
+SERVER_SHARDS = 1  # Processes that each simulate a strip of the map, see server.sharding
+SHARD_GHOST_MARGIN = BASE_WIDTH//2  # Entities this close to the edge of a strip are seen by the next shard
+SERVER_ROOMS = 0  # Game rooms hosted behind the server socket, see server.rooms
+ROOM_CPU_BUDGET = 0.8  # Share of a core the open rooms may use before new rooms are refused
+LOAD_SMOOTHING = 0.1  # Weight of each tick in the cpu load estimates of games
+ROOM_IDLE_TIMEOUT = 30  # Close a room once it has been empty for this interval (seconds)
+ROOM_POLL_INTERVAL = 0.01  # Longest sleep between checks for clients of closed rooms (seconds)
+ROOM_ORB_SPAWN_LIMIT = 200  # Most orbs spawned per tick of a room, which fills a new room gradually
+LOBBY_SERVERS = 0  # Server processes behind a lobby on the network port, see server.lobby
+LOBBY_ADDRESS = None  # (ip, port) of the lobby that the server reports its load to
+LOBBY_REPORT_INTERVAL = 1  # Seconds between load reports to the lobby
+LOBBY_SERVER_BANDWIDTH = 4*1024*1024  # Bytes per second that each server behind a lobby may use
+STANDBY_ADDRESS = None  # (ip, port) through which the server streams its state to a standby
+STANDBY_AUTHKEY = b'netblob-standby'  # Shared secret of the server and its standby
+STANDBY_TIMEOUT = 0.5  # Take over once the server has been silent for this interval (seconds)
+STANDBY_RETRY_INTERVAL = 1  # Seconds between attempts of the server to reach its standby
+STANDBY_RESEND_WINDOW = 1  # Reliable packets this recent are sent again on taking over (seconds)
+STANDBY_QUEUE_LENGTH = 25  # Deltas queued for the standby before it is dropped as too slow
+REPLAY_PATH = None  # File that the session of the server game is recorded to, see server.replay
+REPLAY_FLUSH_INTERVAL = 1  # Seconds between writes of the recorded session to its file
+CHECKPOINT_PATH = None  # File the server game is restored from on launch and saved to on exit, see server.checkpoint
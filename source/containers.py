@@ -0,0 +1,139 @@
+"""Provides containers for the indexing of game entities."""
+
+import heapq
+import source.config as cfg
+
+
+class CellContainer:
+    """Provides a container that stores items in a cell grid.
+
+    This type of container is useful for extracting neighboring items from
+    the local environments of items without iterating through the entire
+    collection of items. Note that each item may occupy several cells.
+
+    Attributes:
+        item_count: Tracks the number of items stored in the container.
+    """
+    def __init__(self, map_size):
+        """Initializes the container with a map size defined by map_size.
+        
+        The cell grid expands to fill in the entire map.
+        """
+        self.cell_width, self.cell_height = cfg.MAP_CELL_SIZE
+        self.item_count = 0
+        self.cells = []
+        map_width, map_height = map_size
+        for _ in range(map_height//self.cell_height + 1):
+            new_row = [set() for _ in range(map_width//self.cell_width + 1)]
+            self.cells.append(new_row)
+
+    def __iter__(self):
+        for row in self.cells:
+            for cell in row:
+                yield from cell
+
+    def find_cell(self, x, y):
+        row, col = int(y/self.cell_height), int(x/self.cell_width)
+        return (max(0, min(len(self.cells)-1, row)),
+                max(0, min(len(self.cells[0])-1, col)))
+
+    def find_cell_range(self, item):
+        """Returns the first and last row and column of the cells of item"""
+        top, left = item.y - item.radius, item.x - item.radius
+        top_row, left_col = self.find_cell(left, top)
+        bot, right = item.y + item.radius, item.x + item.radius
+        bot_row, right_col = self.find_cell(right, bot)
+        return top_row, left_col, bot_row, right_col
+
+    def add(self, item):
+        top_row, left_col, bot_row, right_col = self.find_cell_range(item)
+        self.item_count += 1
+        for row in range(top_row,bot_row+1):
+            for col in range(left_col,right_col+1):
+                cell = self.cells[row][col]
+                cell.add(item)
+
+    def fill_cell(self, row, col, items):
+        """Adds items that each occupy the single cell at row, col.
+
+        Saves finding the cells of each item, for restoring many items
+        whose cells are already known.
+        """
+        self.cells[row][col].update(items)
+        self.item_count += len(items)
+
+    def remove(self, item):
+        top_row, left_col, bot_row, right_col = self.find_cell_range(item)
+        self.item_count -= 1
+        for row in range(top_row,bot_row+1):
+            for col in range(left_col,right_col+1):
+                cell = self.cells[row][col]
+                cell.discard(item)
+
+    def get_neighbours(self, item, x_range, y_range):
+        return self.get_area(
+            item.x - x_range, item.y - y_range,
+            item.x + x_range, item.y + y_range)
+
+    def get_area(self, left, top, right, bottom):
+        """Returns the items occupying any cell that overlaps the area."""
+        items = set()
+        top_row, left_col = self.find_cell(left, top)
+        bot_row, right_col = self.find_cell(right, bottom)
+        for row in range(top_row,bot_row+1):
+            for col in range(left_col,right_col+1):
+                items |= self.cells[row][col]
+        return items
+
+
+class Leaderboard:
+    """Keeps track of the largest players as their radii change.
+
+    The leaders are kept up to date incrementally, such that the players
+    need only be searched when a leader shrinks or leaves the game.
+
+    Attributes:
+        leaders: The largest players in order of decreasing radius.
+        version: Incremented whenever the leaders or their order change.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.players = set()
+        self.leaders = []
+        self.version = 0
+
+    def add(self, player):
+        self.players.add(player)
+        self.promote(player)
+
+    def remove(self, player):
+        self.players.discard(player)
+        self.demote(player)
+
+    def promote(self, player):
+        """Updates the leaders after the radius of the player has grown"""
+        if player in self.leaders:
+            leaders = [leader for leader in self.leaders if leader != player]
+        elif len(self.leaders) < self.size or player.radius > self.leaders[-1].radius:
+            leaders = self.leaders[:]
+        else:
+            return
+        idx = 0
+        while idx < len(leaders) and leaders[idx].radius >= player.radius:
+            idx += 1
+        leaders.insert(idx, player)
+        self._set_leaders(leaders[:self.size])
+
+    def demote(self, player):
+        """Updates the leaders after the radius of the player has shrunk"""
+        if player in self.leaders:
+            self.leaders = heapq.nlargest(
+                self.size, self.players, key=lambda x: x.radius)
+            # Shrunken players are respawned, so even if the leaders are
+            # the same players, their ids may have changed
+            self.version += 1
+
+    def _set_leaders(self, leaders):
+        if leaders != self.leaders:
+            self.leaders = leaders
+            self.version += 1
@@ -27,10 +27,17 @@ class Player:
 
     def eat(self, other):
         """Server-side function."""
-        adjusted_radius = other.radius - cfg.EAT_VALUE_OFFSET
-        self.radius = math.sqrt(
-            self.radius*self.radius + adjusted_radius*adjusted_radius)
-        self.radius = min(self.radius, cfg.MAX_RADIUS)
+        self.eat_all([other])
+
+    def eat_all(self, others):
+        """Server-side function that eats several entities at once.
+
+        The areas are summed exactly, such that the resulting radius does
+        not depend on the order of others, which keeps replays exact.
+        """
+        area = math.fsum([self.radius*self.radius] + [
+            (other.radius - cfg.EAT_VALUE_OFFSET)**2 for other in others])
+        self.radius = min(math.sqrt(area), cfg.MAX_RADIUS)
         self.scale = math.pow(self.radius/cfg.START_RADIUS, cfg.VIEW_GROWTH_RATE)
 
     def move(self, map_size, time_delta):
@@ -78,8 +85,24 @@ class Tracker:
 
 
 class Orb:
-    def __init__(self, position = (0,0), orb_id = 0):
+    def __init__(self, position = (0,0), orb_id = 0, radius = None, color_idx = None):
         self.x, self.y = position
         self.id = orb_id
-        self.radius = random.randint(cfg.MIN_ORB_RADIUS, cfg.MAX_ORB_RADIUS)
-        self.color_idx = random.randrange(len(cfg.ORB_PALETTE))
+        if radius is None:
+            radius = random.randint(cfg.MIN_ORB_RADIUS, cfg.MAX_ORB_RADIUS)
+        if color_idx is None:
+            color_idx = random.randrange(len(cfg.ORB_PALETTE))
+        self.radius = radius
+        self.color_idx = color_idx
+
+
+def generate_orb(field_seed, orb_id, map_size):
+    """Returns the orb with the given id in the orb field given by field_seed.
+
+    The orb is determined by its id alone, such that clients which know the
+    field seed can rebuild any orb from its id.
+    """
+    rng = random.Random(field_seed << 32 | orb_id)
+    position = (rng.randrange(map_size[0]), rng.randrange(map_size[1]))
+    radius = rng.randint(cfg.MIN_ORB_RADIUS, cfg.MAX_ORB_RADIUS)
+    return Orb(position, orb_id, radius, rng.randrange(len(cfg.ORB_PALETTE)))
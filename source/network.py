@@ -1,47 +1,212 @@
 """Provides encoding and decoding functions.
 
-These are used for transmission of game objects over the network.
+These are used for transmission of game objects over the network. Players
+are packed into fixed size binary fields, with their positions given
+relative to an origin near the receiving player, such that they fit into
+16 bits. Orbs are sent by id alone, see source.entities.generate_orb.
 """
 
+import pickle
+import struct
+import zlib
 import source.config as cfg
-from source.entities import Player, Orb, UserInputs
+from source.entities import Player, UserInputs, generate_orb
 
 
+INPUTS_STRUCT = struct.Struct('<hh')  # x, y
+SEQUENCE_STRUCT = struct.Struct('<I')
+PLAYER_STRUCT = struct.Struct('<ihhHhh')  # id, x, y, radius, inputs x, inputs y
+INT16_MAX = 32767
+RAW_FLAG, COMPRESSED_FLAG = b'\x00', b'\x01'  # Message header values
+ROOM_FLAG = 2  # Header bit set when a room id follows the header
+ROOM_STRUCT = struct.Struct('<H')
+MAX_MESSAGE_SIZE = 1 << 16  # Bounds the size of decompressed messages
+
+
+def get_origin(x, y):
+    """Returns the corner of the map cell at (x, y), see cfg.MAP_CELL_SIZE.
+
+    Every entity in view of a player lies within 16 bits of this origin.
+    """
+    cell_width, cell_height = cfg.MAP_CELL_SIZE
+    return (int(x)//cell_width*cell_width, int(y)//cell_height*cell_height)
+
 def decode_name(player_name):
     assert(isinstance(player_name, str))
     assert(len(player_name) <= cfg.MAX_NAME_LENGTH)
     return player_name
 
 def encode_inputs(inputs):
-    return (inputs.x, inputs.y)
+    """Quantizes the inputs to 16 bits, preserving their direction"""
+    mouse_x, mouse_y = inputs.x, inputs.y
+    largest = max(abs(mouse_x), abs(mouse_y))
+    if largest > INT16_MAX:
+        mouse_x, mouse_y = mouse_x*INT16_MAX/largest, mouse_y*INT16_MAX/largest
+    return (round(mouse_x), round(mouse_y))
 
 def decode_inputs(encoded_inputs):
     mouse_x, mouse_y = encoded_inputs
     assert(isinstance(mouse_x,int) and isinstance(mouse_y,int))
     return UserInputs((mouse_x, mouse_y))
 
-def encode_player(player):
-    return (
-        player.name, player.id, int(player.x), int(player.y),
-        player.color_idx, int(player.radius), encode_inputs(player.inputs))
+def encode_input_history(sequence, input_history):
+    """Packs the most recent encoded input samples, newest first.
+
+    Sample i carries the sequence number sequence - i.
+    """
+    return SEQUENCE_STRUCT.pack(sequence) + b''.join(
+        INPUTS_STRUCT.pack(*inputs) for inputs in input_history)
+
+def decode_input_history(encoded_history):
+    """Returns a list of (sequence, UserInputs) pairs, newest first."""
+    sequence, = SEQUENCE_STRUCT.unpack_from(encoded_history)
+    samples = encoded_history[SEQUENCE_STRUCT.size:]
+    assert(sequence > 0)
+    assert(0 < len(samples) <= cfg.INPUT_HISTORY_LENGTH*INPUTS_STRUCT.size)
+    return [(sequence - i, decode_inputs(inputs))
+        for i, inputs in enumerate(INPUTS_STRUCT.iter_unpack(samples))]
 
-def decode_player(player):
-    name, player_id, x, y, color_idx, radius, inputs = player
+def encode_metadata(player):
+    """Encodes the attributes of a player that are fixed for its id"""
+    return (player.id, player.name, player.color_idx)
+
+def decode_metadata(encoded_metadata):
+    """Returns the player id along with a (name, color_idx) pair"""
+    player_id, name, color_idx = encoded_metadata
     assert(isinstance(player_id, int))
-    assert(isinstance(name, str))
-    assert(isinstance(x, int) and isinstance(y, int))
     assert(isinstance(color_idx, int))
     assert(0 <= color_idx < len(cfg.PLAYER_PALETTE))
-    assert(isinstance(radius, int) and cfg.START_RADIUS <= radius <= cfg.MAX_RADIUS)
+    return player_id, (decode_name(name), color_idx)
+
+def encode_players(players, origin):
+    """Packs the changing attributes of players, see encode_metadata.
+
+    Positions and radii are rounded to whole units, which is the most
+    detail the client renders, since its window never magnifies the map.
+    """
+    origin_x, origin_y = origin
+    return (origin, b''.join(PLAYER_STRUCT.pack(
+        player.id, round(player.x) - origin_x, round(player.y) - origin_y,
+        round(player.radius), *encode_inputs(player.inputs))
+        for player in players))
+
+def decode_players(encoded_players):
+    """Returns a list of (id, x, y, radius, inputs) tuples"""
+    (origin_x, origin_y), data = encoded_players
+    assert(isinstance(origin_x, int) and isinstance(origin_y, int))
+    players = []
+    for player_id, x, y, radius, mouse_x, mouse_y in PLAYER_STRUCT.iter_unpack(data):
+        assert(cfg.START_RADIUS <= radius <= cfg.MAX_RADIUS)
+        players.append((player_id, origin_x + x, origin_y + y,
+            radius, decode_inputs((mouse_x, mouse_y))))
+    return players
+
+def decode_player(player, metadata):
+    """Creates a player from a decoded player and its metadata"""
+    player_id, x, y, radius, inputs = player
+    name, color_idx = metadata
     decoded_player = Player(name, player_id, (x,y), radius)
-    decoded_player.inputs = decode_inputs(inputs)
+    decoded_player.inputs = inputs
     decoded_player.color_idx = color_idx
     return decoded_player
 
-def encode_orb(orb):
-    return (orb.x, orb.y, orb.id)
+def encode_ids(ids):
+    """Packs the ids in increasing order.
+
+    Each id is sent as its difference from the previous id, zigzag encoded
+    into a varint of 7 bits per byte, such that nearby ids take up a single
+    byte. The zigzag encoding allows for negative ids.
+    """
+    data = bytearray()
+    prev_id = 0
+    for entity_id in sorted(ids):
+        delta, prev_id = entity_id - prev_id, entity_id
+        delta = 2*delta if delta >= 0 else -2*delta - 1
+        while delta >= 0x80:
+            data.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        data.append(delta)
+    return bytes(data)
+
+def decode_ids(encoded_ids):
+    """Returns the ids packed by encode_ids in increasing order"""
+    ids = []
+    entity_id, delta, shift = 0, 0, 0
+    for byte in encoded_ids:
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            entity_id += delta >> 1 if delta & 1 == 0 else -(delta >> 1) - 1
+            ids.append(entity_id)
+            delta, shift = 0, 0
+    assert(shift == 0)
+    return ids
+
+def encode_orb_ids(orbs):
+    return encode_ids(orb.id for orb in orbs)
+
+def decode_orb_ids(encoded_ids):
+    return decode_ids(encoded_ids)
+
+def pack_message(code, message):
+    return pickle.dumps((code, message))
+
+def frame_message(payload, compression_threshold=None, room_id=None):
+    """Prefixes the payload with a header flag, compressing it if large.
+
+    Payloads above compression_threshold bytes are compressed with a preset
+    dictionary of typical messages, unless the threshold is None. A room id
+    is placed after the flag if given, for the server to route by.
+    """
+    flag, room = RAW_FLAG, b''
+    if compression_threshold is not None and len(payload) > compression_threshold:
+        compressor = zlib.compressobj(
+            cfg.COMPRESSION_LEVEL, zdict=COMPRESSION_DICTIONARY)
+        flag = COMPRESSED_FLAG
+        payload = compressor.compress(payload) + compressor.flush()
+    if room_id is not None:
+        flag, room = bytes([flag[0] | ROOM_FLAG]), ROOM_STRUCT.pack(room_id)
+    return flag + room + payload
+
+def get_room_id(data):
+    """Returns the room id in the header of a framed message, if any"""
+    if data[0] & ROOM_FLAG:
+        return ROOM_STRUCT.unpack_from(data, 1)[0]
+    return None
+
+def decode_message(data):
+    """Returns the code and message of a framed message"""
+    flag, payload = data[:1], data[1:]
+    if flag[0] & ROOM_FLAG:
+        flag = bytes([flag[0] ^ ROOM_FLAG])
+        payload = payload[ROOM_STRUCT.size:]
+    if flag == COMPRESSED_FLAG:
+        decompressor = zlib.decompressobj(zdict=COMPRESSION_DICTIONARY)
+        payload = decompressor.decompress(payload, MAX_MESSAGE_SIZE)
+        assert(decompressor.eof and not decompressor.unconsumed_tail)
+    else:
+        assert(flag == RAW_FLAG)
+    code, message = pickle.loads(payload)
+    return code, message
+
+def _build_compression_dictionary():
+    """Returns the pickled bytes of typical player and orb updates.
+
+    Both ends of a connection must build the same dictionary, so the
+    messages are made up of fixed values and pickled with a fixed protocol.
+    """
+    players = []
+    for i in range(12):
+        player = Player('', i+1, (i*120, i*80), cfg.START_RADIUS + i)
+        player.inputs = UserInputs((-i*40, i*30))
+        players.append(player)
+    orbs = [generate_orb(0, i*i + 1, (600, 600)) for i in range(24)]
+    origin = (600, 600)
+    samples = [
+        (cfg.UPD_PLAYERS_CODE, (((0, [1, 2, 3]), encode_players(players, origin), 0.0), 0.0)),
+        (cfg.UPD_ORBS_CODE, (1, (encode_orb_ids(orbs), encode_orb_ids(orbs[:8])))),
+    ]
+    return b''.join(pickle.dumps(sample, protocol=4) for sample in samples)
 
-def decode_orb(encoded_orb):
-    x, y, orb_id = encoded_orb
-    assert(isinstance(x, int) and isinstance(y, int) and isinstance(orb_id, int))
-    return Orb((x,y), orb_id)
+COMPRESSION_DICTIONARY = _build_compression_dictionary()
@@ -0,0 +1,308 @@
+#!/usr/bin/python
+"""Loads a server with a swarm of simulated clients over real UDP sockets.
+
+Each client has a socket and address of its own, and runs the protocol of
+the client game: it connects, follows any redirection by a lobby, streams
+its inputs, decodes the updates of the server, echoes their pings, and
+acknowledges reliable packets. Loss and latency are simulated in either
+direction. The clients run as asyncio datagram endpoints in a single
+process, driven by one task that paces their connection attempts and
+inputs.
+
+Once done, the swarm prints a JSON report of the admission of its clients,
+the rate of player updates received, the bandwidth per client, and the
+delay of player updates from the server snapshot until they are handled.
+The server must run on the same host, as the delays are taken from the
+server time stamped on each update, for example:
+
+    python swarm.py --clients 1000 --duration 30 --loss 0.02 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import random
+import sys
+import time
+import source.config as cfg
+import source.network
+from source.entities import UserInputs
+
+
+INPUTS_CHANGE_INTERVAL = 1  # Seconds between new inputs of each client
+
+
+def get_percentiles(samples, scale=1):
+    """Returns the median, tail percentiles, and maximum of samples"""
+    if not samples: return {}
+    samples = sorted(samples)
+    return {name: scale*samples[min(len(samples) - 1, int(share*len(samples)))]
+        for name, share in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+            ('p99.9', 0.999), ('max', 1))}
+
+
+class SwarmClient(asyncio.DatagramProtocol):
+    """A simulated client, see Swarm."""
+    def __init__(self, swarm, name):
+        self.swarm = swarm
+        self.name = name
+        self.transport = None
+        self.server_address = swarm.server_address
+        self.state = 'connecting'  # Or 'connected', 'refused', 'timed out', or 'dropped'
+        self.attempts = 0
+        self.next_attempt_time = 0
+        self.start_time = time.time()
+        self.connect_time = None
+        self.refusal = None  # The reason given by the server for refusing the client
+        self.player_id = 0
+        self.heartbeat = 0
+        self.leaders_version = -1
+        self.input_sequence = 0
+        self.input_history = collections.deque([], cfg.INPUT_HISTORY_LENGTH)
+        self.inputs = UserInputs()
+        self.last_inputs_change = 0
+        self.snapshots = 0
+        self.bytes_in, self.bytes_out = 0, 0
+        self.delays = []  # Seconds from server snapshot to handling of each player update
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.swarm.rng.random() < self.swarm.loss: return
+        if self.swarm.latency:
+            self.swarm.loop.call_later(self.swarm.latency/2, self._handle_datagram, data, addr)
+        else:
+            self._handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        pass
+
+    def tick(self, curr_time):
+        """Sends connection attempts or inputs, as they are due"""
+        if self.state == 'connecting' and curr_time >= self.next_attempt_time:
+            if self.attempts == cfg.CONNECTION_ATTEMPTS:
+                self.state = 'timed out'
+                return
+            self.attempts += 1
+            self.next_attempt_time = curr_time + cfg.CONNECTION_ATTEMPT_INTERVAL
+            self._send(cfg.CONNECT_CODE, self.name)
+        elif self.state == 'connected':
+            if curr_time - self.last_inputs_change > INPUTS_CHANGE_INTERVAL:
+                self.last_inputs_change = curr_time
+                self.inputs = UserInputs((
+                    self.swarm.rng.randint(-cfg.BASE_WIDTH//2, cfg.BASE_WIDTH//2),
+                    self.swarm.rng.randint(-cfg.BASE_HEIGHT//2, cfg.BASE_HEIGHT//2)))
+            self.input_sequence += 1
+            self.input_history.appendleft(source.network.encode_inputs(self.inputs))
+            self._send(cfg.INPUTS_CODE, source.network.encode_input_history(
+                self.input_sequence, self.input_history))
+
+    def disconnect(self):
+        if self.state == 'connected':
+            for _ in range(3):
+                self._send(cfg.DISCONNECT_CODE, self.player_id)
+        self.transport.close()
+
+    def _send(self, code, message):
+        data = source.network.frame_message(source.network.pack_message(code, message),
+            cfg.COMPRESSION_THRESHOLD, self.swarm.room_id)
+        self.bytes_out += len(data)
+        if self.swarm.rng.random() < self.swarm.loss: return
+        if self.swarm.latency:
+            self.swarm.loop.call_later(self.swarm.latency/2, self._send_datagram,
+                data, self.server_address)
+        else:
+            self._send_datagram(data, self.server_address)
+
+    def _send_datagram(self, data, addr):
+        if not self.transport.is_closing():
+            self.transport.sendto(data, addr)
+
+    def _handle_datagram(self, data, addr):
+        self.bytes_in += len(data)
+        try:
+            code, message = source.network.decode_message(data)
+            if code == cfg.CONNECT_CODE:
+                self._accept_connection(message)
+            elif code == cfg.UPD_PLAYERS_CODE:
+                self._update_players(message)
+            elif code in (cfg.UPD_ORBS_CODE, cfg.METADATA_CODE, cfg.DEATH_CODE):
+                self._update_reliably(code, message)
+            elif code == cfg.DISCONNECT_CODE:
+                self._accept_disconnection(message)
+            elif code == cfg.REDIRECT_CODE and self.state == 'connecting' and \
+                    addr == self.server_address:
+                self.server_address = (self.server_address[0], message)
+                self.next_attempt_time = 0
+        except Exception as exc:
+            self.swarm.errors[type(exc).__name__] += 1
+
+    def _accept_connection(self, message):
+        if self.state != 'connecting': return
+        self.player_id = message[0]
+        self.state = 'connected'
+        self.connect_time = time.time()
+
+    def _update_players(self, message):
+        if self.state != 'connected': return
+        (leader_update, view_ids, players, server_pulse), _ = message
+        source.network.decode_ids(view_ids)
+        source.network.decode_players(players)
+        if server_pulse <= self.heartbeat: return
+        self.heartbeat = server_pulse
+        if leader_update is not None:
+            self.leaders_version = leader_update[0]
+        self.snapshots += 1
+        self.delays.append(time.time() - server_pulse)
+        self._send(cfg.PING_CODE, (server_pulse, self.leaders_version))
+
+    def _update_reliably(self, code, message):
+        packet_id, updates = message
+        if code == cfg.UPD_ORBS_CODE:
+            source.network.decode_orb_ids(updates[0])
+            source.network.decode_orb_ids(updates[1])
+        elif code == cfg.METADATA_CODE:
+            for entry in updates:
+                source.network.decode_metadata(entry)
+        elif code == cfg.DEATH_CODE:
+            self.player_id = updates
+        self._send(cfg.ACK_CODE, packet_id)
+
+    def _accept_disconnection(self, message):
+        if self.state == 'connecting':
+            self.state, self.refusal = 'refused', message
+        elif self.state == 'connected':
+            self.state = 'dropped'
+
+
+class Swarm:
+    """Runs client_count simulated clients of the server at server_address.
+
+    Args:
+        loss: The share of packets lost in either direction.
+        latency: The round trip time added to every packet, in seconds.
+        input_rate: The nr of inputs messages sent by each client per second.
+        room_id: The room of the server that the clients connect to, if any.
+    """
+    def __init__(self, server_address, client_count, loss=0, latency=0,
+            input_rate=1/cfg.CLIENT_SYNC_INTERVAL, room_id=None, seed=0):
+        self.server_address = server_address
+        self.client_count = client_count
+        self.loss = loss
+        self.latency = latency
+        self.input_rate = input_rate
+        self.room_id = room_id
+        self.rng = random.Random(seed)
+        self.clients = []
+        self.errors = collections.Counter()  # Counts messages that failed to decode by error
+        self.loop = None
+
+    async def run(self, duration, ramp_time):
+        """Connects the clients over ramp_time, and runs them for duration seconds"""
+        self.loop = asyncio.get_running_loop()
+        start_time = time.time()
+        end_time = start_time + duration
+        driver = asyncio.create_task(self._drive(end_time))
+        for idx in range(self.client_count):
+            await asyncio.sleep(max(0, start_time + idx*ramp_time/self.client_count - time.time()))
+            client = SwarmClient(self, f"swarm{idx}")
+            await self.loop.create_datagram_endpoint(lambda: client,
+                local_addr=('127.0.0.1', 0))
+            self.clients.append(client)
+        await driver
+        for client in self.clients:
+            client.disconnect()
+        # Lets the disconnection messages out
+        await asyncio.sleep(self.latency/2 + 0.1)
+
+    async def _drive(self, end_time):
+        interval = 1/self.input_rate
+        next_tick_time = time.time()
+        while next_tick_time < end_time:
+            curr_time = time.time()
+            for client in self.clients:
+                client.tick(curr_time)
+            next_tick_time += interval
+            await asyncio.sleep(max(0, next_tick_time - time.time()))
+
+    def report(self):
+        """Returns the statistics of the clients as a dict"""
+        end_time = time.time()
+        states = collections.Counter(client.state for client in self.clients)
+        connected = [client for client in self.clients if client.connect_time]
+        durations = [end_time - client.connect_time for client in connected]
+        return {
+            'clients': len(self.clients),
+            'loss': self.loss,
+            'latency_ms': 1000*self.latency,
+            'admission': {
+                'admitted': len(connected),
+                'refused': dict(collections.Counter(client.refusal
+                    for client in self.clients if client.state == 'refused')),
+                'timed_out': states['timed out'],
+                'dropped': states['dropped'],
+                'connect_ms': get_percentiles([client.connect_time - client.start_time
+                    for client in connected], 1000),
+            },
+            'snapshot_rate': get_percentiles([client.snapshots/duration
+                for client, duration in zip(connected, durations)]),
+            'bandwidth_per_client': {
+                'in_bytes_per_s': get_percentiles([client.bytes_in/duration
+                    for client, duration in zip(connected, durations)]),
+                'out_bytes_per_s': get_percentiles([client.bytes_out/duration
+                    for client, duration in zip(connected, durations)]),
+            },
+            'snapshot_delay_ms': get_percentiles(
+                [delay for client in connected for delay in client.delays], 1000),
+            'decode_errors': dict(self.errors),
+        }
+
+
+def raise_file_limit(file_count):
+    """Raises the limit of open files of the process, as far as permitted"""
+    try:
+        import resource
+    except ImportError:
+        return  # Not limited in this way on Windows
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit != resource.RLIM_INFINITY and soft_limit < file_count:
+        if hard_limit != resource.RLIM_INFINITY:
+            file_count = min(file_count, hard_limit)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (file_count, hard_limit))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', default='127.0.0.1', help="ip of the server or lobby")
+    parser.add_argument('--port', type=int, default=cfg.NETWORK_PORT)
+    parser.add_argument('--room', type=int, help="room of the server to connect to")
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=20, help="seconds to run for")
+    parser.add_argument('--ramp', type=float, default=5,
+        help="seconds over which the clients are started")
+    parser.add_argument('--loss', type=float, default=0,
+        help="share of packets lost in either direction")
+    parser.add_argument('--latency', type=float, default=0,
+        help="round trip time added to every packet, in seconds")
+    parser.add_argument('--input-rate', type=float, default=1/cfg.CLIENT_SYNC_INTERVAL,
+        help="inputs messages sent by each client per second")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="file to write the report to")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    raise_file_limit(args.clients + 64)
+    swarm = Swarm((args.server, args.port), args.clients, args.loss, args.latency,
+        args.input_rate, args.room, args.seed)
+    asyncio.run(swarm.run(args.duration, args.ramp))
+    report = swarm.report()
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,528 @@
+"""Tests the encoding of game objects for transmission over the network.
+
+Run with pytest. The byte count comparison can also be printed by running
+this module directly.
+"""
+
+import json
+import os
+import pickle
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Listener
+import source.config as cfg
+import source.network
+from source.entities import Player, Orb, UserInputs, generate_orb
+from server.network_process import NetworkLink, RingBuffer, OUTBOUND_STRUCT, \
+    SEND_RELIABLY, FORGET, ROUTE
+from server.server import Connection, prioritize_players
+from server.server_game import ServerGame
+from server.lobby import Lobby, ServerLoad
+from server.rooms import RoomManager
+from server.sharding import ShardGame, ShardLayout, ShardMessage, get_player_state
+from server.checkpoint import load_checkpoint, save_checkpoint
+from server.replay import PhaseProfiler, ReplayGame, ReplayLink, record_game
+from server.standby import Replicator
+import benchmark
+import swarm
+
+
+def random_view(player_count, orb_count, seed=0):
+    """Returns a viewing player along with the players and orbs in its view.
+
+    The entities are spread over the largest range that a player can view,
+    which occurs at the maximum radius.
+    """
+    rng = random.Random(seed)
+    max_scale = (cfg.MAX_RADIUS/cfg.START_RADIUS)**cfg.VIEW_GROWTH_RATE
+    x_range, y_range = max_scale*cfg.BASE_WIDTH/2, max_scale*cfg.BASE_HEIGHT/2
+    viewer = Player('viewer', 1, (rng.uniform(0, 40000), rng.uniform(0, 40000)))
+    players, orbs = [viewer], []
+    for i in range(player_count):
+        player = Player(str(i), i+2, (
+            viewer.x + rng.uniform(-x_range, x_range),
+            viewer.y + rng.uniform(-y_range, y_range)),
+            rng.uniform(cfg.START_RADIUS, cfg.MAX_RADIUS))
+        player.inputs = UserInputs((rng.randint(-60000, 60000), rng.randint(-800, 800)))
+        players.append(player)
+    for i in range(orb_count):
+        orbs.append(Orb((
+            int(viewer.x + rng.uniform(-x_range, x_range)),
+            int(viewer.y + rng.uniform(-y_range, y_range))), i+1))
+    return viewer, players, orbs
+
+def pickled_size(message):
+    return len(pickle.dumps(message))
+
+def test_player_round_trip():
+    viewer, players, _ = random_view(200, 0)
+    origin = source.network.get_origin(viewer.x, viewer.y)
+    encoded = pickle.loads(pickle.dumps(source.network.encode_players(players, origin)))
+    decoded = source.network.decode_players(encoded)
+    assert len(decoded) == len(players)
+    for player, (player_id, x, y, radius, inputs) in zip(players, decoded):
+        assert player_id == player.id
+        assert abs(x - player.x) <= 0.5 and abs(y - player.y) <= 0.5
+        assert abs(radius - player.radius) <= 0.5
+
+def test_inputs_keep_direction():
+    _, players, _ = random_view(200, 0)
+    for player in players:
+        mouse_x, mouse_y = source.network.encode_inputs(player.inputs)
+        assert max(abs(mouse_x), abs(mouse_y)) <= source.network.INT16_MAX
+        # The cross product bounds the change in direction
+        cross = mouse_x*player.inputs.y - mouse_y*player.inputs.x
+        length = max(abs(player.inputs.x), abs(player.inputs.y))
+        assert abs(cross) <= length
+        if length <= source.network.INT16_MAX:
+            assert (mouse_x, mouse_y) == (player.inputs.x, player.inputs.y)
+
+def test_orb_id_round_trip():
+    _, _, orbs = random_view(0, 500)
+    orbs.append(Orb(orb_id = 2**40))
+    encoded_ids = source.network.encode_orb_ids(orbs)
+    assert source.network.decode_orb_ids(encoded_ids) == [orb.id for orb in orbs]
+    assert len(encoded_ids) < 2*len(orbs)
+
+def test_signed_id_round_trip():
+    ids = [-2**33, -70, -1, 0, 1, 2, 200, 2**40]
+    assert source.network.decode_ids(source.network.encode_ids(reversed(ids))) == ids
+
+def test_generated_orbs_match():
+    field_size = (4*cfg.BASE_WIDTH, 4*cfg.BASE_HEIGHT)
+    game = ServerGame(100, 0, 500, field_size, orb_seed=1234, headless=True)
+    game._replenish_orbs()
+    # Clients rebuild the orbs of the server from their ids alone
+    encoded_ids = pickle.loads(pickle.dumps(source.network.encode_orb_ids(game.orbs)))
+    rebuilt_orbs = [generate_orb(game.orb_seed, orb_id, field_size)
+        for orb_id in source.network.decode_orb_ids(encoded_ids)]
+    assert sorted((orb.id, orb.x, orb.y, orb.radius, orb.color_idx) for orb in rebuilt_orbs) == \
+        sorted((orb.id, orb.x, orb.y, orb.radius, orb.color_idx) for orb in game.orbs)
+    assert all(0 <= orb.x < field_size[0] and 0 <= orb.y < field_size[1]
+        for orb in rebuilt_orbs)
+
+    other_orbs = [generate_orb(4321, orb.id, field_size) for orb in rebuilt_orbs]
+    assert sum((orb.x, orb.y) == (other_orb.x, other_orb.y)
+        for orb, other_orb in zip(rebuilt_orbs, other_orbs)) < 5
+    # Fields must be the same across versions, as clients and servers may differ
+    orb = generate_orb(1234, 1, (5000, 3000))
+    assert (orb.x, orb.y, orb.radius, orb.color_idx) == (2653, 1736, 19, 6)
+
+def test_viewer_is_prioritized():
+    viewer, players, _ = random_view(400, 0)
+    connection = Connection(('127.0.0.1', 5000), 0)
+    # Every player is new to the view, which ties them with the viewer
+    due_players = prioritize_players(connection, viewer, players[::-1])
+    assert due_players[0] is viewer
+    assert len(due_players) == connection.update_budget//source.network.PLAYER_STRUCT.size
+
+def test_input_history_round_trip():
+    history = [(i*7 - 300, -i*5) for i in range(cfg.INPUT_HISTORY_LENGTH)]
+    encoded = source.network.encode_input_history(42, history)
+    decoded = source.network.decode_input_history(encoded)
+    assert [sequence for sequence, _ in decoded] == \
+        list(range(42, 42 - len(history), -1))
+    assert [(inputs.x, inputs.y) for _, inputs in decoded] == history
+
+def test_room_header_round_trip():
+    payload = source.network.pack_message(cfg.CONNECT_CODE, 'x'*500)
+    for room_id in [None, 0, 3, 65535]:
+        for threshold in [None, 100]:
+            data = source.network.frame_message(payload, threshold, room_id)
+            assert source.network.get_room_id(data) == room_id
+            assert source.network.decode_message(data) == (cfg.CONNECT_CODE, 'x'*500)
+
+def test_ring_buffer_wraps_around():
+    ring = RingBuffer(size=64)
+    reader = RingBuffer(ring.name)
+    try:
+        for i in range(50):
+            record = bytes([i])*random.randrange(1, 30)
+            assert ring.put(record)
+            assert reader.get() == record
+        assert reader.get() is None
+        assert ring.put(bytes(60))
+        assert not ring.put(b'full')
+    finally:
+        reader.close()
+        ring.close(unlink=True)
+
+def test_network_link_keeps_control_records():
+    link = NetworkLink(RingBuffer(size=256), RingBuffer(size=256))
+    reader = RingBuffer(link.outbound.name)
+    addr = ('127.0.0.1', 5000)
+    try:
+        # Each of these records takes up a quarter of the ring
+        for _ in range(4):
+            assert link.send(addr, bytes(64 - RingBuffer.LENGTH.size - OUTBOUND_STRUCT.size))
+        assert not link.send(addr, b'')
+        assert link.send(addr, b'reliable', 7)
+        link.route(addr)
+        link.forget(addr)
+        assert len(link.backlog) == 3
+        while reader.get() is not None: pass
+        assert list(link.receive()) == []
+        kinds = [OUTBOUND_STRUCT.unpack_from(record)[0]
+            for record in iter(reader.get, None)]
+        assert kinds == [SEND_RELIABLY, ROUTE, FORGET] and not link.backlog
+    finally:
+        reader.close()
+        link.close(unlink=True)
+
+def create_shards(shard_count, bot_count=5):
+    """Returns the layout of a map along with a ShardGame for each strip"""
+    field_size = (6*cfg.BASE_WIDTH, 2*cfg.BASE_HEIGHT)
+    layout = ShardLayout(field_size, shard_count)
+    shards = []
+    for shard_idx in range(shard_count):
+        neighbour_pipes = {idx: None for idx in (shard_idx - 1, shard_idx + 1)
+            if 0 <= idx < shard_count}
+        shards.append(ShardGame(layout, shard_idx, neighbour_pipes, 100,
+            bot_count, 3000, field_size, 7, ReplayLink()))
+    return layout, shards
+
+def test_shard_layout_covers_map():
+    field_size = (6*cfg.BASE_WIDTH, 2*cfg.BASE_HEIGHT)
+    layout = ShardLayout(field_size, 4)
+    assert layout.get_bounds(0)[0] == 0 and layout.get_bounds(3)[1] == field_size[0]
+    for shard_idx in range(4):
+        left, right = layout.get_bounds(shard_idx)
+        assert left%cfg.MAP_CELL_SIZE[0] == 0 and left < right
+        assert layout.find_shard(left) == layout.find_shard(right - 1) == shard_idx
+        if shard_idx < 3:
+            assert layout.get_bounds(shard_idx + 1)[0] == right
+    assert layout.find_shard(-10) == 0 and layout.find_shard(field_size[0] + 10) == 3
+
+def test_shard_ids_are_interleaved():
+    _, shards = create_shards(3)
+    bot_ids, player_ids = [], []
+    for shard in shards:
+        assert all(shard.layout.find_shard(bot.x) == shard.shard_idx
+            for bot in shard.id_to_player.values())
+        bot_ids.extend(shard.id_to_player)
+        bot_ids.extend(shard._next_bot_id() for _ in range(20))
+        for port in range(20):
+            shard.server._add_new_player('player', ('127.0.0.1', port))
+        player_ids.extend(player_id for player_id, _ in shard.server.player_add_queue)
+    assert len(set(bot_ids)) == len(bot_ids) and max(bot_ids) < 0
+    assert len(set(player_ids)) == len(player_ids) and min(player_ids) > 0
+
+def test_shard_message_is_applied():
+    layout, (_, shard, _) = create_shards(3, bot_count=1)
+    shard._replenish_orbs()
+    left, _ = layout.get_bounds(1)
+    ghost = Player('ghost', 40, (left - 100, 500), 400)
+    message = ShardMessage()
+    message.ghosts = [get_player_state(ghost)]
+    message.orb_additions = [1001, 1002]
+    shard._apply_shard_message(0, message)
+    assert shard.ghosts[40][0].x == left - 100 and 1001 in shard.ghost_orbs
+
+    # Ghosts are replaced by each message, and removed once left out
+    ghost.x -= 50
+    message = ShardMessage()
+    message.ghosts = [get_player_state(ghost)]
+    message.orb_removals = [1001]
+    shard._apply_shard_message(0, message)
+    assert shard.ghosts[40][0].x == left - 150
+    assert [player.id for player in set(shard.players)].count(40) == 1
+    assert 1001 not in shard.ghost_orbs and 1002 in shard.ghost_orbs
+    shard._apply_shard_message(0, ShardMessage())
+    assert not shard.ghosts and all(player.id != 40 for player in shard.players)
+
+    # Entities of this shard that were eaten as ghosts of another
+    eaten_orb = next(iter(shard.own_orbs.values()))
+    bot = next(iter(shard.id_to_player.values()))
+    bot.radius, bot_id = 300, bot.id
+    message = ShardMessage()
+    message.eaten_orbs = [eaten_orb.id]
+    message.eaten_players = [bot.id]
+    shard._apply_shard_message(2, message)
+    assert eaten_orb.id not in shard.own_orbs and eaten_orb in shard.orb_removals
+    assert bot.id < bot_id and bot.radius == cfg.START_RADIUS
+    assert shard.id_to_player[bot.id] is bot
+
+    # A handed over player keeps its connection and the orbs in its view
+    player = Player('player', 43, (left + 100, 500))
+    connection = Connection(('127.0.0.1', 5000), 0)
+    view_orbs = list(shard.own_orbs.values())[:10]
+    connection.orb_view = {generate_orb(shard.orb_seed, orb.id, shard.map_size)
+        for orb in view_orbs}
+    message = ShardMessage()
+    message.handovers = [(get_player_state(player), connection)]
+    shard._apply_shard_message(0, message)
+    assert shard.id_to_player[43].x == left + 100
+    assert shard.server.id_map[43] is connection
+    assert shard.server.addr_to_id[connection.addr] == 43
+    assert {id(orb) for orb in connection.orb_view} == {id(orb) for orb in view_orbs}
+
+def test_headless_game_clears_orb_changes():
+    field_size = (4*cfg.BASE_WIDTH, 4*cfg.BASE_HEIGHT)
+    game = ServerGame(100, 30, 2000, field_size, orb_seed=7, headless=True,
+        network_link=ReplayLink())
+    for _ in range(100):
+        game.main_loop(1/cfg.SERVER_GAME_REFRESH_RATE)
+    # Without a window to draw them, the changes would pile up every tick
+    assert game.orb_id > 2000
+    assert game.orb_additions == [] and game.orb_removals == []
+
+def connect_to_room(client_socket, manager, room_id, timeout=10):
+    """Runs the rooms while the client connects, and returns the response.
+
+    Connection attempts are repeated, as a client would, since the network
+    process may not have bound its port yet.
+    """
+    data = source.network.frame_message(source.network.pack_message(
+        cfg.CONNECT_CODE, 'player'), None, room_id)
+    client_socket.setblocking(False)
+    end_time = time.time() + timeout
+    attempt_time = 0
+    while time.time() < end_time:
+        if time.time() - attempt_time > cfg.CONNECTION_ATTEMPT_INTERVAL:
+            attempt_time = time.time()
+            client_socket.sendto(data, ('127.0.0.1', cfg.NETWORK_PORT))
+        manager.main_loop()
+        try:
+            response, _ = client_socket.recvfrom(16384)
+        except BlockingIOError:
+            continue
+        code, message = source.network.decode_message(response)
+        if code in (cfg.CONNECT_CODE, cfg.DISCONNECT_CODE):
+            return code, message
+    return None
+
+def test_rooms_route_and_refuse(monkeypatch):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe_socket:
+        probe_socket.bind(('127.0.0.1', 0))
+        port = probe_socket.getsockname()[1]
+    monkeypatch.setattr(cfg, 'NETWORK_PORT', port)
+    manager = RoomManager(3, 10, 20000, (2*cfg.BASE_WIDTH, 2*cfg.BASE_HEIGHT))
+    client_sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(3)]
+    manager.start()
+    try:
+        code, _ = connect_to_room(client_sockets[0], manager, 1)
+        assert code == cfg.CONNECT_CODE
+        assert manager.rooms[0] is None and manager.rooms[2] is None
+        room = manager.rooms[1]
+        assert len(room.game.server.id_map) == 1
+        # The orbs of the new room are spawned over several ticks
+        assert 0 < room.game.orbs.item_count < 20000
+        assert connect_to_room(client_sockets[1], manager, 7) == \
+            (cfg.DISCONNECT_CODE, cfg.NOT_CONNECTED_MESSAGE)
+
+        monkeypatch.setattr(cfg, 'ROOM_CPU_BUDGET', -1)
+        assert connect_to_room(client_sockets[2], manager, 2) == \
+            (cfg.DISCONNECT_CODE, cfg.SERVER_FULL_MESSAGE)
+        assert manager.rooms[2] is None
+    finally:
+        manager.stop()
+        for client_socket in client_sockets:
+            client_socket.close()
+
+def test_lobby_balances_servers():
+    lobby = Lobby(port=0)
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        curr_time = time.time()
+        lobby.servers = {
+            6001: ServerLoad(curr_time, 5, 10, 0.1, 0),
+            6002: ServerLoad(curr_time, 2, 10, 0.1, 0),
+            6003: ServerLoad(curr_time, 0, 10, 0.9, 0),
+            6004: ServerLoad(curr_time, 0, 10, 0.1, cfg.LOBBY_SERVER_BANDWIDTH),
+            6005: ServerLoad(curr_time - 2*cfg.TIMEOUT_LIMIT, 0, 10, 0, 0),
+        }
+        assert lobby.find_server(curr_time) == 6002 and 6005 not in lobby.servers
+
+        # Repeated attempts of a client are sent to the same server, and counted once
+        client_socket.bind(('127.0.0.1', 0))
+        for _ in range(3):
+            lobby._redirect(client_socket.getsockname())
+            data, _ = client_socket.recvfrom(2048)
+            assert source.network.decode_message(data) == (cfg.REDIRECT_CODE, 6002)
+        assert lobby.servers[6002].player_count == 3
+
+        lobby.servers[6002] = ServerLoad(curr_time, 10, 10, 0.1, 0)
+        assert lobby.find_server(curr_time) == 6001
+        lobby.servers[6001] = ServerLoad(curr_time, 10, 10, 0.1, 0)
+        # A server that uses all of its bandwidth is as good as full
+        assert lobby.find_server(curr_time) == 6003
+        lobby.servers[6003] = ServerLoad(curr_time, 0, 10, 1, 0)
+        assert lobby.find_server(curr_time) is None
+    finally:
+        client_socket.close()
+        lobby.lobby_socket.close()
+
+def test_replicator_drops_stalled_standby():
+    field_size = (4*cfg.BASE_WIDTH, 4*cfg.BASE_HEIGHT)
+    game = ServerGame(100, 300, 2000, field_size, orb_seed=7, headless=True,
+        network_link=ReplayLink())
+    listener = Listener(('127.0.0.1', 0), authkey=cfg.STANDBY_AUTHKEY)
+    standby_connections = []
+    accepter = threading.Thread(target=lambda: standby_connections.append(listener.accept()))
+    accepter.start()
+    replicator = Replicator(listener.address)
+    try:
+        # The standby accepts but never reads, so the socket buffers fill up
+        # and then the queue, which is given a while to drain every frame
+        for frame_count in range(10000):
+            start_time = time.perf_counter()
+            replicator.replicate(game)
+            assert time.perf_counter() - start_time < 0.1
+            sender = replicator.sender or sender
+            if replicator.sender is None: break
+            while not sender.messages.empty() and time.perf_counter() - start_time < 0.01:
+                time.sleep(0.001)
+        assert replicator.sender is None and frame_count > cfg.STANDBY_QUEUE_LENGTH
+        assert game.server.reliable_log is None
+        # The send that waited on the standby was aborted
+        sender.join(1)
+        assert not sender.is_alive() and isinstance(sender.failure, OSError)
+    finally:
+        accepter.join()
+        for connection in standby_connections:
+            connection.close()
+        listener.close()
+
+def test_checkpoint_round_trip(tmp_path):
+    field_size = (4*cfg.BASE_WIDTH, 4*cfg.BASE_HEIGHT)
+    game = ServerGame(100, 10, 2000, field_size, orb_seed=7, headless=True)
+    game._replenish_orbs()
+    player_id = next(iter(game.id_to_player))
+    connection = Connection(('127.0.0.1', 5000), 0)
+    connection.orb_view = set(list(game.orbs)[:20])
+    game.server.adopt_connection(player_id, connection)
+    path = str(tmp_path/'game.checkpoint')
+    save_checkpoint(game, path)
+
+    restored = load_checkpoint(path, headless=True)
+    assert restored.orb_seed == game.orb_seed and restored.orb_id == game.orb_id
+    assert restored.orbs.item_count == game.orbs.item_count
+    assert [[{orb.id for orb in cell} for cell in row] for row in restored.orbs.cells] == \
+        [[{orb.id for orb in cell} for cell in row] for row in game.orbs.cells]
+    assert {(p.id, p.name, p.x, p.y, p.radius) for p in restored.id_to_player.values()} == \
+        {(p.id, p.name, p.x, p.y, p.radius) for p in game.id_to_player.values()}
+    restored_connection = restored.server.id_map[player_id]
+    assert restored_connection.addr == connection.addr
+    assert {orb.id for orb in restored_connection.orb_view} == \
+        {orb.id for orb in connection.orb_view}
+
+def record_session(path, bot_count=30, map_factor=4):
+    """Records a session of 300 ticks, in which a player joins every 50"""
+    field_size = (map_factor*cfg.BASE_WIDTH, map_factor*cfg.BASE_HEIGHT)
+    game = record_game(path, 100, bot_count, 2000, field_size, headless=True,
+        network_link=ReplayLink())
+    rng = random.Random(0)
+    for tick in range(300):
+        if tick%50 == 0:
+            player_id = tick + 1
+            game.server.player_add_queue.append((player_id, str(player_id)))
+            game.server.adopt_connection(player_id, Connection(('127.0.0.1', player_id), 0))
+        for player_id in game.server.id_map:
+            game.server._post_inputs(player_id,
+                UserInputs((rng.randint(-500, 500), rng.randint(-500, 500))))
+        game.server.last_sync_time = 0  # Syncs every tick
+        game.main_loop(1/60)
+    game.stop()
+    return game
+
+def test_replay_matches_session(tmp_path):
+    path = str(tmp_path/'session.replay')
+    game = record_session(path)
+    replay = ReplayGame(path)
+    profiler = PhaseProfiler()
+    profiler.wrap_game(replay)
+    tick_count, _, _, divergent_tick = replay.replay()
+    replay.stop()
+    assert tick_count == 300 and divergent_tick is None
+    assert {(p.id, p.x, p.y, p.radius) for p in replay.id_to_player.values()} == \
+        {(p.id, p.x, p.y, p.radius) for p in game.id_to_player.values()}
+    # The joined players were served as clients
+    assert set(replay.server.id_map) == set(game.server.id_map)
+    assert profiler.phase_times['encode'] > 0 and profiler.phase_times['send'] > 0
+
+def test_replay_matches_in_new_process(tmp_path):
+    path = str(tmp_path/'session.replay')
+    # Crowded, so that players are often overlapped by several larger ones
+    game = record_session(path, bot_count=80, map_factor=2)
+    script = ("import json, sys\n"
+        "from server.replay import ReplayGame\n"
+        "game = ReplayGame(sys.argv[1])\n"
+        "divergent_tick = game.replay()[3]\n"
+        "game.stop()\n"
+        "print(json.dumps([divergent_tick, game.orb_id, sorted((p.id, p.x, p.y, p.radius)\n"
+        "    for p in game.id_to_player.values())]))\n")
+    output = subprocess.run([sys.executable, '-c', script, path], check=True,
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    divergent_tick, orb_id, players = json.loads(output.splitlines()[-1])
+    assert divergent_tick is None and orb_id == game.orb_id
+    assert players == sorted([p.id, p.x, p.y, p.radius] for p in game.id_to_player.values())
+
+def test_benchmark_is_reproducible():
+    workload = {'map_factor': 2, 'orb_density': 50, 'player_count': 5,
+        'bot_count': 5, 'radii': 'skewed'}
+    results = [benchmark.run_workload(workload, 3, 10, 40) for _ in range(2)]
+    assert results[0]['orb_id'] == results[1]['orb_id']
+    assert {'move', 'views', 'encode', 'send'} <= set(results[0]['phase_ms'])
+
+    baseline = {'results': results[:1]}
+    slower = {'results': [dict(results[0], phase_ms=dict(results[0]['phase_ms'],
+        encode=results[0]['phase_ms']['encode'] + 1))]}
+    assert benchmark.compare_to_baseline(baseline, baseline, 0.1) == []
+    assert len(benchmark.compare_to_baseline(slower, baseline, 0.1)) == 1
+
+class SentMessages(list):
+    """Collects the decoded messages sent through it, as a transport would"""
+    def is_closing(self):
+        return False
+
+    def sendto(self, data, addr):
+        self.append(source.network.decode_message(data))
+
+def test_swarm_client_follows_protocol():
+    client = swarm.SwarmClient(swarm.Swarm(('127.0.0.1', cfg.NETWORK_PORT), 1), 'swarm0')
+    client.transport = sent = SentMessages()
+    def receive(code, message):
+        client.datagram_received(source.network.frame_message(
+            source.network.pack_message(code, message)), None)
+
+    client.tick(1)
+    assert sent.pop() == (cfg.CONNECT_CODE, 'swarm0')
+    receive(cfg.CONNECT_CODE, (7, None, None, None, None))
+    client.tick(2)
+    assert client.state == 'connected' and sent.pop()[0] == cfg.INPUTS_CODE
+    receive(cfg.UPD_ORBS_CODE, (3, (source.network.encode_orb_ids([]),)*2))
+    assert sent.pop() == (cfg.ACK_CODE, 3)
+    players = source.network.encode_players([], (0, 0))
+    receive(cfg.UPD_PLAYERS_CODE, (((1, []), source.network.encode_ids([]), players, 5.0), 0))
+    assert sent.pop() == (cfg.PING_CODE, (5.0, 1)) and client.snapshots == 1
+    receive(cfg.DISCONNECT_CODE, cfg.PLAYER_DISCONNECTED_MESSAGE)
+    assert client.state == 'dropped' and not client.swarm.errors
+
+def compare_byte_counts(player_count=40, orb_count=400):
+    """Returns the pickled sizes of a view before and after quantization.
+
+    The previous encoding sent each player and orb as a tuple of ints,
+    while orbs are now sent by id alone.
+    """
+    viewer, players, orbs = random_view(player_count, orb_count)
+    origin = source.network.get_origin(viewer.x, viewer.y)
+    previous = pickled_size((
+        [(p.id, int(p.x), int(p.y), int(p.radius), (p.inputs.x, p.inputs.y))
+            for p in players],
+        [(orb.x, orb.y, orb.id) for orb in orbs]))
+    quantized = pickled_size((
+        source.network.encode_players(players, origin),
+        source.network.encode_orb_ids(orbs)))
+    return previous, quantized
+
+def test_byte_count():
+    previous, quantized = compare_byte_counts()
+    assert quantized < previous
+
+
+if __name__ == '__main__':
+    print("Pickled bytes before and after quantization:", compare_byte_counts())
@@ -8,9 +8,10 @@ to orb density, player count, and map size.
 import math
 import matplotlib.pyplot as pyplot
 import multiprocessing as mp
-import pickle
+import os
 import random
 import socket
+import statistics
 import sys
 import time
 import pygame as pg
@@ -19,7 +20,10 @@ import source.entities
 import source.network
 import source.animation
 import client.client_game
+import server.server
 import server.server_game
+import server.standby
+import server.checkpoint
 
 
 def simulate_game(game, cycle_count, player_count):
@@ -44,6 +48,7 @@ def simulate_game(game, cycle_count, player_count):
     game._sync_server_players()
     for player in game.id_to_player.values():
         player.radius = random.randrange(cfg.START_RADIUS, 800)
+        game.leaderboard.promote(player)
     game._sync_server_players()
 
     count = 0
@@ -63,7 +68,7 @@ def simulate_game(game, cycle_count, player_count):
         game._sync_server_players()
 
         # Remove this line to simulated performance w/o displaying the game.
-        game._update_display(time_delta, game.id_to_player.values(), game.orbs)
+        game._update_display(time_delta, game.players, game.orbs)
 
         count += 1
         if count == 300:
@@ -110,14 +115,15 @@ def add_players(game, players):
     local_address = (socket.gethostbyname(socket.gethostname()), 11332)
     game.server.addr_to_id[local_address] = game.server.player_id
     game.server.connected_addresses.add(local_address)
+    # The shared address carries the traffic of every simulated player
+    game.server.rate_limiter.rate = float('Inf')
     for player in players:
         game.server.player_id += 1
-        player_info = [local_address, set(), float('Inf'), 0]
+        player_info = server.server.Connection(local_address, float('Inf'))
         game.server.id_map[game.server.player_id] = player_info
         player_update = (game.server.player_id, player.name)
         game.server.player_add_queue.append(player_update)
-        input_update = (game.server.player_id, player.inputs)
-        game.server.player_input_queue.append(input_update)
+        game.server.player_inputs[game.server.player_id] = player.inputs
 
 def dummy_client():
     """Creates a dummy client for basic input/output.
@@ -135,14 +141,199 @@ def dummy_client():
     while True:
         try:
             data, addr = dummy_socket.recvfrom(12096)
-            code, data = pickle.loads(data)
-            if code in (cfg.UPD_ORBS_CODE, cfg.DEATH_CODE):
+            code, data = source.network.decode_message(data)
+            if code in (cfg.UPD_ORBS_CODE, cfg.DEATH_CODE, cfg.METADATA_CODE):
                 packet_id, update = data
-                message = pickle.dumps((cfg.ACK_CODE, packet_id))
+                message = source.network.frame_message(
+                    source.network.pack_message(cfg.ACK_CODE, packet_id))
                 dummy_socket.sendto(message, server_address)
         except: 
             pass
 
+def packet_flood(address_count, packet_rate):
+    """Floods the server with input messages from many unknown addresses.
+
+    Every address is within its packet rate limit, such that each message
+    is decoded by the server, which then replies that it is not connected.
+    """
+    local_ip = socket.gethostbyname(socket.gethostname())
+    server_address = (local_ip, cfg.NETWORK_PORT)
+    flood_sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for _ in range(address_count)]
+    input_history = [source.network.encode_inputs(
+        source.entities.UserInputs())]*cfg.INPUT_HISTORY_LENGTH
+    message = source.network.frame_message(source.network.pack_message(
+        cfg.INPUTS_CODE, source.network.encode_input_history(1, input_history)))
+    send_time = time.time()
+    while True:
+        for flood_socket in flood_sockets:
+            flood_socket.sendto(message, server_address)
+        send_time += address_count/packet_rate
+        time.sleep(max(0, send_time - time.time()))
+
+def measure_tick_jitter(network_process, flood, cycle_count=600):
+    """Measures the duration of server game ticks.
+
+    Args:
+        network_process: Whether the server runs its socket I/O in a
+            separate process, see cfg.NETWORK_PROCESS.
+        flood: Whether the server is flooded by packet_flood meanwhile.
+
+    Returns:
+        The mean, standard deviation, and 99th percentile of the tick
+        durations in milliseconds.
+    """
+    cfg.NETWORK_PROCESS = network_process
+    field_size = (4*cfg.BASE_WIDTH, 4*cfg.BASE_HEIGHT)
+    game = server.server_game.ServerGame(400, 30, 50*16, field_size)
+    game.start()
+    if flood:
+        flood_process = mp.Process(target=packet_flood, args=(100, 10000))
+        flood_process.start()
+    tick_times = []
+    clock = pg.time.Clock()
+    for _ in range(cycle_count):
+        time_delta = clock.tick(cfg.SERVER_GAME_REFRESH_RATE)/1000
+        start_time = time.perf_counter()
+        game.main_loop(time_delta)
+        tick_times.append(1000*(time.perf_counter() - start_time))
+    if flood:
+        flood_process.terminate()
+    game.stop()
+    tick_times.sort()
+    return (statistics.mean(tick_times), statistics.stdev(tick_times),
+        tick_times[int(0.99*len(tick_times))])
+
+def compare_tick_jitter():
+    """Prints the tick durations with and without a network process"""
+    mp.set_start_method("spawn")
+    for network_process in (False, True):
+        for flood in (False, True):
+            mean, stdev, p99 = measure_tick_jitter(network_process, flood)
+            print(f"network process: {network_process!s:5}  flood: {flood!s:5}  "
+                f"mean: {mean:.2f} ms  stdev: {stdev:.2f} ms  p99: {p99:.2f} ms")
+
+def measure_sync_time(view_workers, player_count, cycle_count=100):
+    """Measures the duration of syncs with player_count connected players.
+
+    Args:
+        view_workers: The nr of processes computing views, see
+            cfg.VIEW_WORKERS.
+
+    Returns:
+        The mean and 99th percentile of the sync durations in milliseconds.
+    """
+    cfg.VIEW_WORKERS = view_workers
+    factor = int(math.sqrt(player_count))
+    field_size = (factor*cfg.BASE_WIDTH, factor*cfg.BASE_HEIGHT)
+    game = server.server_game.ServerGame(1000, 0, 50*factor*factor, field_size)
+    game.start()
+    new_players = []
+    for i in range(player_count):
+        new_player = source.entities.Player(str(i), i)
+        new_player.inputs.x = random.randrange(-cfg.MAX_RADIUS,cfg.MAX_RADIUS)
+        new_player.inputs.y = random.randrange(-cfg.MAX_RADIUS,cfg.MAX_RADIUS)
+        new_players.append(new_player)
+    add_players(game, new_players)
+    game._replenish_orbs()
+    game._sync_server_players()
+
+    sync_times = []
+    clock = pg.time.Clock()
+    for _ in range(cycle_count):
+        time_delta = clock.tick(1/cfg.SERVER_SYNC_INTERVAL)/1000
+        for player in game.id_to_player.values():
+            game.players.remove(player)
+            player.move(game.map_size, time_delta)
+            game.players.add(player)
+        game._handle_player_collisions()
+        game._handle_orb_collisions()
+        start_time = time.perf_counter()
+        game._sync_server_players()
+        sync_times.append(1000*(time.perf_counter() - start_time))
+    game.stop()
+    sync_times.sort()
+    return statistics.mean(sync_times), sync_times[int(0.99*len(sync_times))]
+
+def compare_sync_times(player_count=200):
+    """Prints the sync durations for different numbers of view workers"""
+    mp.set_start_method("spawn")
+    mp.Process(target=dummy_client, daemon=True).start()
+    time.sleep(0.5)
+    for view_workers in (0, 1, 2, 4):
+        mean, p99 = measure_sync_time(view_workers, player_count)
+        print(f"view workers: {view_workers}  players: {player_count}  "
+            f"mean: {mean:.2f} ms  p99: {p99:.2f} ms")
+
+def run_standby(address):
+    standby = server.standby.Standby(address)
+    standby.mirror()
+
+def measure_tick_time(standby_address, bot_count, cycle_count=500):
+    """Measures the duration of server loops with bot_count bots.
+
+    Args:
+        standby_address: The address of a standby that the game is
+            replicated to, or None.
+
+    Returns:
+        The mean and 99th percentile of the loop durations, and the mean
+        time spent replicating per loop, in milliseconds.
+    """
+    factor = int(math.sqrt(bot_count))
+    field_size = (factor*cfg.BASE_WIDTH, factor*cfg.BASE_HEIGHT)
+    game = server.server_game.ServerGame(
+        1000, bot_count, 50*factor*factor, field_size, headless=True)
+    if standby_address:
+        game.replicator = server.standby.Replicator(standby_address)
+    game.start()
+    game.main_loop(0)
+
+    tick_times = []
+    clock = pg.time.Clock()
+    for _ in range(cycle_count):
+        time_delta = clock.tick(cfg.SERVER_GAME_REFRESH_RATE)/1000
+        start_time = time.perf_counter()
+        game.main_loop(time_delta)
+        tick_times.append(1000*(time.perf_counter() - start_time))
+    replication_time = game.replicator.replication_time if game.replicator else 0
+    game.stop()
+    tick_times.sort()
+    return (statistics.mean(tick_times), tick_times[int(0.99*len(tick_times))],
+        1000*replication_time/(cycle_count + 1))
+
+def compare_replication_overhead(bot_count=200):
+    """Prints the server loop durations with and without a standby"""
+    mp.set_start_method("spawn")
+    standby_address = ('127.0.0.1', cfg.NETWORK_PORT + 1)
+    mp.Process(target=run_standby, args=(standby_address,), daemon=True).start()
+    time.sleep(1)
+    for address in (None, standby_address):
+        mean, p99, replication = measure_tick_time(address, bot_count)
+        print(f"standby: {address is not None}  bots: {bot_count}  "
+            f"mean: {mean:.2f} ms  p99: {p99:.2f} ms  "
+            f"replication: {replication:.3f} ms")
+
+def compare_restart_times(bot_count=200, orb_count=20000, path='benchmark.checkpoint'):
+    """Prints the time to set up a game afresh and to restore it from a checkpoint"""
+    factor = int(math.sqrt(orb_count/50))
+    field_size = (factor*cfg.BASE_WIDTH, factor*cfg.BASE_HEIGHT)
+    start_time = time.perf_counter()
+    game = server.server_game.ServerGame(1000, bot_count, orb_count, field_size, headless=True)
+    game._replenish_orbs()
+    fresh_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    server.checkpoint.save_checkpoint(game, path)
+    save_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    server.checkpoint.load_checkpoint(path, headless=True)
+    restore_time = time.perf_counter() - start_time
+    print(f"orbs: {orb_count}  bots: {bot_count}  fresh: {1000*fresh_time:.1f} ms  "
+        f"save: {1000*save_time:.1f} ms  restore: {1000*restore_time:.1f} ms  "
+        f"size: {os.path.getsize(path)//1024} KB")
+    os.remove(path)
+
 def main():
     """Initializes a ServerGame instance for simulation purposes."""
     mp.set_start_method("spawn")
@@ -170,6 +361,15 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['jitter']:
+        compare_tick_jitter()
+    elif sys.argv[1:] == ['sync']:
+        compare_sync_times()
+    elif sys.argv[1:] == ['standby']:
+        compare_replication_overhead()
+    elif sys.argv[1:] == ['checkpoint']:
+        compare_restart_times()
+    else:
+        main()
     pg.quit()
     sys.exit()